@@ -1,7 +1,11 @@
 from django.contrib import admin
 
 from books.models import DebtLoan
+from books.models import RecurringTransaction
+from books.models import Tag
 from books.models import Transaction
 
 admin.site.register(Transaction)
 admin.site.register(DebtLoan)
+admin.site.register(RecurringTransaction)
+admin.site.register(Tag)
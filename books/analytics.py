@@ -0,0 +1,174 @@
+"""
+Income and expense of a user bucketed by day, week, month or year
+
+Buckets are computed by the database in the current timezone and the
+periods without transactions are filled with zeros. Weeks start on Monday;
+Django 1.11 has no ``TruncWeek``, so they are summed up from day buckets.
+Months and years are read from ``MonthlySummary`` whenever summaries are
+kept in the current timezone, which keeps long histories cheap.
+"""
+from datetime import date
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Case
+from django.db.models import DecimalField
+from django.db.models import Q
+from django.db.models import Sum
+from django.db.models import When
+from django.db.models.functions import TruncDay
+from django.db.models.functions import TruncMonth
+from django.db.models.functions import TruncYear
+from django.utils import timezone
+
+from books.models import MonthlySummary
+from books.models import SUMMARY_TIMEZONE
+from books.models import Transaction
+from books import services
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+YEAR = 'year'
+GRANULARITIES = (DAY, WEEK, MONTH, YEAR)
+
+# a chart does not need more points, and zero-filling is done in Python
+MAX_BUCKETS = 1000
+
+_TRUNCS = {
+    DAY: TruncDay,
+    WEEK: TruncDay,
+    MONTH: TruncMonth,
+    YEAR: TruncYear,
+}
+
+
+def get_bucket_start(day, granularity):
+    "Returns the first day of the bucket ``day`` belongs to"
+    if granularity == WEEK:
+        return day - timedelta(days=day.weekday())
+    if granularity == MONTH:
+        return day.replace(day=1)
+    if granularity == YEAR:
+        return day.replace(month=1, day=1)
+    return day
+
+
+def get_next_bucket_start(start, granularity):
+    if granularity == DAY:
+        return start + timedelta(days=1)
+    if granularity == WEEK:
+        return start + timedelta(days=7)
+    if granularity == MONTH:
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start.replace(year=start.year + 1)
+
+
+def iter_bucket_starts(start, end, granularity):
+    "Yields starts of buckets, which cover days from ``start`` to ``end``"
+    current = get_bucket_start(start, granularity)
+    while current <= end:
+        yield current
+        current = get_next_bucket_start(current, granularity)
+
+
+def count_buckets(start, end, granularity):
+    if granularity == DAY:
+        return (end - start).days + 1
+    if granularity == WEEK:
+        return (get_bucket_start(end, WEEK)
+                - get_bucket_start(start, WEEK)).days // 7 + 1
+    if granularity == MONTH:
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return end.year - start.year + 1
+
+
+def get_first_day(user):
+    "Returns local date of user's first transaction, today if there is none"
+    created = Transaction.objects \
+        .filter(user=user, active=True) \
+        .order_by('created') \
+        .values_list('created', flat=True) \
+        .first()
+    if created is None:
+        return timezone.localdate()
+    return timezone.localtime(created).date()
+
+
+def _sum_of(category, field):
+    return Sum(Case(
+        When(category=category, then=field),
+        output_field=DecimalField(max_digits=14, decimal_places=2),
+    ))
+
+
+def _query_transactions(user, start, end, granularity):
+    "Returns ``{local date: (income, expense)}`` of non-empty buckets"
+    tz = timezone.get_current_timezone()
+    qs = services.filter_period(
+        Transaction.objects.filter(user=user, active=True),
+        services.get_date_range(start, end))
+    rows = qs \
+        .annotate(bucket=_TRUNCS[granularity]('created', tzinfo=tz)) \
+        .values('bucket') \
+        .annotate(income=_sum_of(Transaction.INCOME, 'amount'),
+                  expense=_sum_of(Transaction.EXPENSE, 'amount')) \
+        .order_by()
+    return {
+        timezone.localtime(row['bucket'], tz).date():
+            (row['income'], row['expense'])
+        for row in rows
+    }
+
+
+def _query_summaries(user, start, end):
+    "Same as ``_query_transactions`` for months, read from summaries"
+    rows = MonthlySummary.objects \
+        .filter(user=user) \
+        .filter(Q(year__gt=start.year) |
+                Q(year=start.year, month__gte=start.month)) \
+        .filter(Q(year__lt=end.year) |
+                Q(year=end.year, month__lte=end.month)) \
+        .values('year', 'month') \
+        .annotate(income=_sum_of(Transaction.INCOME, 'sum'),
+                  expense=_sum_of(Transaction.EXPENSE, 'sum')) \
+        .order_by()
+    return {
+        date(row['year'], row['month'], 1): (row['income'], row['expense'])
+        for row in rows
+    }
+
+
+def summaries_match_timezone():
+    "Tells if ``MonthlySummary`` months are months of the current timezone"
+    return str(SUMMARY_TIMEZONE) == str(timezone.get_current_timezone())
+
+
+def get_buckets(user, granularity, start, end):
+    """
+    Returns list of buckets from ``start`` to ``end`` (dates, inclusive)
+
+    Every bucket is a dict with ``start`` date, ``income`` and ``expense``.
+    ``start`` and ``end`` are widened to whole buckets.
+    """
+    first = get_bucket_start(start, granularity)
+    last = get_next_bucket_start(get_bucket_start(end, granularity),
+                                 granularity) - timedelta(days=1)
+
+    if granularity in (MONTH, YEAR) and summaries_match_timezone():
+        totals = _query_summaries(user, first, last)
+    else:
+        totals = _query_transactions(user, first, last, granularity)
+
+    zero = Decimal('0.00')
+    buckets = [{'start': bucket, 'income': zero, 'expense': zero}
+               for bucket in iter_bucket_starts(first, last, granularity)]
+    by_start = {bucket['start']: bucket for bucket in buckets}
+    for day, (income, expense) in totals.items():
+        # weeks come as days, years may come as months
+        bucket = by_start[get_bucket_start(day, granularity)]
+        bucket['income'] += income or 0
+        bucket['expense'] += expense or 0
+    return buckets
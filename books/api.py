@@ -0,0 +1,208 @@
+"""
+JSON API over user's transactions and debts/loans
+
+Every kind of rows has a collection URL, which lists active rows (GET) and
+creates new ones (POST), and an item URL, which updates (POST) and
+deactivates (DELETE) a row. Writes are validated by the forms HTML views
+use and take form encoded or JSON bodies; updates may leave out fields,
+which keep their values.
+
+Lists are paged with the cursors HTML lists use and read through
+``values()``, ``?fields=id,amount`` selects returned fields. Responses carry
+an ``ETag`` derived from ``modified`` of user's rows, so an unchanged
+collection is answered with 304 after a single aggregate query. There is
+no ``Last-Modified``: with whole seconds, a client would miss a write made
+in the same second as the one it has seen.
+
+Offline clients sync through the changes URL instead: it returns rows
+created, changed or deactivated since the token of the previous sync.
+"""
+from collections import namedtuple
+from functools import wraps
+
+import hashlib
+import json
+
+from django.db.models import Count
+from django.db.models import Max
+from django.forms.models import model_to_dict
+from django.http import HttpResponse
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_http_methods
+
+from books.models import DebtLoan
+from books.models import Transaction
+from books import cache
+from books import forms
+from books import services
+from finance import db
+
+Resource = namedtuple('Resource', 'model form fields')
+
+TRANSACTIONS = Resource(
+    Transaction, forms.TransactionForm,
+    ('id', 'title', 'amount', 'category', 'created', 'modified'))
+DEBT_LOANS = Resource(
+    DebtLoan, forms.DebtLoanForm,
+    ('id', 'with_who', 'title', 'amount', 'category', 'created', 'modified'))
+
+
+def _error(message, status=400, **extra):
+    return JsonResponse(dict(extra, error=message), status=status)
+
+
+def _form_error(form):
+    return _error("Invalid data.", errors={
+        name: list(errors) for name, errors in form.errors.items()})
+
+
+def api_login_required(view):
+    "Answers anonymous requests with 401 instead of redirecting to login"
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return _error("Authentication required.", status=401)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def get_fields(request, resource):
+    "Returns fields selected by ``?fields=``, ``None`` if any is unknown"
+    value = request.GET.get('fields')
+    if not value:
+        return resource.fields
+    fields = tuple(value.split(','))
+    if not set(fields).issubset(resource.fields):
+        return None
+    return fields
+
+
+def get_data(request):
+    "Returns submitted form or JSON object, ``None`` if JSON is invalid"
+    if request.content_type != 'application/json':
+        return request.POST
+    try:
+        data = json.loads(request.body.decode())
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _serialize(obj, fields):
+    return {field: getattr(obj, field) for field in fields}
+
+
+def list_rows(request, resource):
+    fields = get_fields(request, resource)
+    if fields is None:
+        return _error("Unknown field requested.")
+    cursor = request.GET.get('cursor')
+
+    qs = resource.model.objects.filter(user=request.user)
+    # deactivated rows are counted too, deactivation changes ``modified``
+    state = qs.aggregate(last_modified=Max('modified'), count=Count('id'))
+    etag = '"{}"'.format(hashlib.md5('{}:{}:{}:{}:{}'.format(
+        resource.model.__name__, state['last_modified'], state['count'],
+        ','.join(fields), cursor).encode()).hexdigest())
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        # cursors need ``created`` and ``id`` of the last row
+        values = set(fields).union(('created', 'id'))
+        rows, next_cursor = services.get_page(
+            qs.filter(active=True).values(*values), cursor)
+        response = JsonResponse({
+            'results': [{field: row[field] for field in fields}
+                        for row in rows],
+            'next': next_cursor,
+        })
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=0)
+    return response
+
+
+def create_row(request, resource):
+    data = get_data(request)
+    if data is None:
+        return _error("Body is not a JSON object.")
+    form = resource.form(data)
+    if not form.is_valid():
+        return _form_error(form)
+    form.instance.user = request.user
+    obj = form.save()
+    cache.bump_version(request.user.id)
+    return JsonResponse(_serialize(obj, resource.fields), status=201)
+
+
+def update_row(request, resource, obj):
+    data = get_data(request)
+    if data is None:
+        return _error("Body is not a JSON object.")
+    # fields left out keep their values
+    values = model_to_dict(obj, fields=resource.form._meta.fields)
+    values.update(data.items())
+    form = resource.form(values, instance=obj)
+    if not form.is_valid():
+        return _form_error(form)
+    obj = form.save()
+    cache.bump_version(request.user.id)
+    return JsonResponse(_serialize(obj, resource.fields))
+
+
+def list_changes(request, resource):
+    since = request.GET.get('since')
+    if since and services.decode_cursor(since) is None:
+        return _error("Invalid token.")
+    fields = resource.fields + ('active',)
+    rows, token, more = services.get_changes(
+        resource.model.objects.filter(user=request.user).values(*fields),
+        since)
+    return JsonResponse({'changes': rows, 'next': token, 'more': more})
+
+
+def _collection(resource):
+    @db.replica_reads
+    @api_login_required
+    @require_http_methods(['GET', 'POST'])
+    def view(request):
+        if request.method == 'POST':
+            return create_row(request, resource)
+        return list_rows(request, resource)
+    return view
+
+
+def _item(resource):
+    @api_login_required
+    @require_http_methods(['POST', 'DELETE'])
+    def view(request, pk):
+        rows = resource.model.objects.filter(pk=pk, user=request.user,
+                                             active=True)
+        if request.method == 'DELETE':
+            if not rows.deactivate():
+                return _error("Not found.", status=404)
+            cache.bump_version(request.user.id)
+            return HttpResponse(status=204)
+        obj = rows.first()
+        if obj is None:
+            return _error("Not found.", status=404)
+        return update_row(request, resource, obj)
+    return view
+
+
+def _changes(resource):
+    # not read from replicas, a lagging one could make a client skip rows
+    @api_login_required
+    @require_http_methods(['GET'])
+    def view(request):
+        return list_changes(request, resource)
+    return view
+
+
+transactions = _collection(TRANSACTIONS)
+transaction = _item(TRANSACTIONS)
+transaction_changes = _changes(TRANSACTIONS)
+debt_loans = _collection(DEBT_LOANS)
+debt_loan = _item(DEBT_LOANS)
+debt_loan_changes = _changes(DEBT_LOANS)
@@ -0,0 +1,81 @@
+"""
+Per user versioned cache of list page totals and rendered rows
+
+Every key embeds user's data version. Bumping the version on a write makes
+all entries cached for the user unreachable without looking them up, they
+simply expire with the cache timeout.
+
+Hits and misses are counted in process memory, like request metrics, and
+served by ``finance.metrics``; every process (e.g. uwsgi worker) counts its
+own lookups only.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _version_key(user_id):
+    return 'books:{}:version'.format(user_id)
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _key_part(part):
+    if part is None:
+        return ''
+    if hasattr(part, 'isoformat'):
+        # ``str`` of datetime has a space, which memcached does not allow
+        return part.isoformat()
+    return str(part)
+
+
+def get_version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        # start from current time, so an evicted version is never reused
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(user_id):
+    "Invalidates everything cached for the user"
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        # user without a version has nothing cached yet
+        pass
+
+
+def get_or_set(user_id, name, compute, *parts):
+    """
+    Returns cached value of ``compute()`` for the user's current data
+
+    ``parts`` are whatever else the value depends on, like filter or cursor.
+    """
+    key = 'books:{}:{}:{}:{}'.format(
+        user_id, get_version(user_id), name,
+        ':'.join(_key_part(part) for part in parts),
+    )
+    value = cache.get(key)
+    if value is None:
+        _count('misses')
+        value = compute()
+        cache.set(key, value)
+    else:
+        _count('hits')
+    return value
+
+
+def get_stats():
+    "Returns hit and miss counts of this process"
+    with _stats_lock:
+        return dict(_stats)
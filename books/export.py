@@ -0,0 +1,82 @@
+"""
+Streaming export of user's transactions and debts/loans
+
+Rows are read as tuples through ``values_list().iterator()``, which uses a
+server side cursor on postgres, and every row is written out as soon as
+it's read, so memory use does not depend on the number of exported rows.
+"""
+from datetime import datetime
+
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+
+from books.models import DebtLoan
+from books.models import Transaction
+from books import services
+
+FIELDS = {
+    'transactions': ('id', 'created', 'title', 'category', 'amount'),
+    'debt_loans': ('id', 'created', 'with_who', 'title', 'category',
+                   'amount'),
+}
+
+MODELS = {
+    'transactions': Transaction,
+    'debt_loans': DebtLoan,
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class _Echo:
+    "File-like object, which returns written value instead of buffering it"
+    def write(self, value):
+        return value
+
+
+def get_export_queryset(user, kind, period=None, start=None, end=None):
+    """
+    Returns user's active rows in a named ``period`` or a date range
+
+    ``start`` and ``end`` are dates in the current timezone, both inclusive.
+    """
+    qs = MODELS[kind].objects.filter(user=user, active=True)
+    if period:
+        qs = services.filter_period(qs, services.get_period_range(period))
+    qs = services.filter_period(qs, services.get_date_range(start, end))
+    return qs.order_by('created', 'id')
+
+
+def _serialize(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (int, str)):
+        return value
+    # decimals are exported as strings to keep them exact
+    return str(value)
+
+
+def iter_csv(qs, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in qs.values_list(*fields).iterator():
+        yield writer.writerow([_serialize(value) for value in row])
+
+
+def iter_ndjson(qs, fields):
+    for row in qs.values_list(*fields).iterator():
+        yield json.dumps(dict(zip(fields, map(_serialize, row)))) + '\n'
+
+
+def export_response(qs, kind, fmt):
+    fields = FIELDS[kind]
+    rows = iter_csv(qs, fields) if fmt == 'csv' else iter_ndjson(qs, fields)
+    response = StreamingHttpResponse(rows, content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+        kind, fmt)
+    return response
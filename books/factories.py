@@ -1,3 +1,5 @@
+from django.utils import timezone
+
 import factory
 
 from accounts.factories import UserFactory
@@ -23,3 +25,14 @@ class DebtLoanFactory(factory.DjangoModelFactory):
 
     class Meta:
         model = models.DebtLoan
+
+
+class RecurringTransactionFactory(factory.DjangoModelFactory):
+    title = factory.Sequence(lambda n: 'recurring_%d' % n)
+    amount = 100
+    category = models.Transaction.EXPENSE
+    start = factory.LazyFunction(timezone.localdate)
+    user = factory.SubFactory(UserFactory)
+
+    class Meta:
+        model = models.RecurringTransaction
@@ -1,15 +1,182 @@
 from django import forms
 
 from books import models
+from books import services
+
+
+class TagsField(forms.CharField):
+    "Comma separated tag names (or a list of them in JSON), cleaned to a list"
+    def to_python(self, value):
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(name) for name in value)
+        names = [models.normalize_name(name)
+                 for name in super().to_python(value).split(',')]
+        return [name for name in names if name]
+
+    def validate(self, value):
+        super().validate(value)
+        max_length = models.Tag._meta.get_field('name').max_length
+        if any(len(name) > max_length for name in value):
+            raise forms.ValidationError(
+                "Tags must not be longer than {} characters.".format(
+                    max_length), code='max_length')
 
 
 class TransactionForm(forms.ModelForm):
+    tags = TagsField(required=False, help_text="comma separated")
+
     class Meta:
         model = models.Transaction
         fields = ['title', 'amount', 'category']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.is_bound and self.instance.pk is not None:
+            self.initial['tags'] = ', '.join(
+                tag.name for tag in self.instance.tags.all())
+
+    def save(self, *args, **kwargs):
+        adding = self.instance._state.adding
+        instance = super().save(*args, **kwargs)
+        tags = self.cleaned_data.get('tags')
+        # tags are left as they are, unless they are submitted, and a new
+        # transaction has none to remove
+        if 'tags' in self.data and (tags or not adding):
+            instance.set_tags(tags)
+        return instance
+
 
 class DebtLoanForm(forms.ModelForm):
     class Meta:
         model = models.DebtLoan
         fields = ['with_who', 'title', 'amount', 'category']
+
+
+class IdListField(forms.Field):
+    "Ids of selected rows, submitted as repeated inputs of the same name"
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        try:
+            return [int(pk) for pk in value or []]
+        except (TypeError, ValueError):
+            raise forms.ValidationError("Ids must be integers.",
+                                        code='invalid')
+
+
+class BulkActionForm(forms.Form):
+    DEACTIVATE = 'deactivate'
+    RESTORE = 'restore'
+    SET_CATEGORY = 'set_category'
+    ACTION_CHOICES = (
+        (DEACTIVATE, 'delete'),
+        (RESTORE, 'restore'),
+        (SET_CATEGORY, 'change category'),
+    )
+
+    action = forms.ChoiceField(choices=ACTION_CHOICES)
+    ids = IdListField()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('action') == self.SET_CATEGORY and \
+                cleaned_data.get('category') in (None, ''):
+            self.add_error('category', "Category is required.")
+        return cleaned_data
+
+    def apply(self, qs):
+        "Applies the action to selected rows of ``qs`` in a single UPDATE"
+        qs = qs.filter(pk__in=self.cleaned_data['ids'])
+        action = self.cleaned_data['action']
+        if action == self.DEACTIVATE:
+            return qs.deactivate()
+        elif action == self.RESTORE:
+            return qs.restore()
+        return qs.set_category(self.cleaned_data['category'])
+
+
+class TransactionBulkForm(BulkActionForm):
+    category = forms.ChoiceField(choices=models.Transaction.CATEGORY_CHOICES,
+                                 required=False)
+
+
+class DebtLoanBulkForm(BulkActionForm):
+    category = forms.TypedChoiceField(choices=models.DebtLoan.CATEGORY_CHOICES,
+                                      coerce=int, empty_value=None,
+                                      required=False)
+
+
+class DateRangeForm(forms.Form):
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False, help_text="inclusive")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end and start > end:
+            self.add_error('end', "End must not be before start.")
+        return cleaned_data
+
+
+class PeriodForm(DateRangeForm):
+    "Named period and a date range, either of them or both"
+    period = forms.ChoiceField(choices=[(p, p) for p in services.PERIODS],
+                               required=False)
+
+    def get_range(self):
+        "Returns ``PeriodRange`` of days, which are in both"
+        ranges = [services.get_date_range(self.cleaned_data['start'],
+                                          self.cleaned_data['end'])]
+        if self.cleaned_data['period']:
+            ranges.append(
+                services.get_period_range(self.cleaned_data['period']))
+        starts = [r.start for r in ranges if r.start is not None]
+        ends = [r.end for r in ranges if r.end is not None]
+        return services.PeriodRange(max(starts) if starts else None,
+                                    min(ends) if ends else None)
+
+
+class ExportForm(PeriodForm):
+    TRANSACTIONS = 'transactions'
+    DEBT_LOANS = 'debt_loans'
+    KIND_CHOICES = (
+        (TRANSACTIONS, 'transactions'),
+        (DEBT_LOANS, 'debts/loans'),
+    )
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+    FORMAT_CHOICES = (
+        (CSV, 'CSV'),
+        (NDJSON, 'newline delimited JSON'),
+    )
+
+    kind = forms.ChoiceField(choices=KIND_CHOICES, required=False)
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, required=False)
+
+    def clean_kind(self):
+        return self.cleaned_data['kind'] or self.TRANSACTIONS
+
+    def clean_format(self):
+        return self.cleaned_data['format'] or self.CSV
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField(max_length=100, required=False)
+    kind = forms.ChoiceField(choices=ExportForm.KIND_CHOICES, required=False)
+    period = forms.ChoiceField(choices=[(p, p) for p in services.PERIODS],
+                               required=False)
+    page = forms.IntegerField(min_value=1, required=False)
+
+    def clean_kind(self):
+        return self.cleaned_data['kind'] or ExportForm.TRANSACTIONS
+
+    def clean_period(self):
+        return self.cleaned_data['period'] or 'all_time'
+
+    def clean_page(self):
+        return self.cleaned_data['page'] or 1
+
+
+class ImportForm(forms.Form):
+    file = forms.FileField(
+        help_text="CSV with title, amount, category and created columns")
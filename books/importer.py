@@ -0,0 +1,136 @@
+"""
+Bulk import of transactions from CSV files, e.g. bank statement dumps
+
+CSV is parsed row by row, every row is validated by ``TransactionForm``
+fields and valid rows are inserted with ``bulk_create`` in batches. Invalid
+rows are reported and skipped, they do not abort the import.
+
+Recognized columns are ``title``, ``amount``, ``category`` and optional
+``created``. When ``category`` is empty, it's taken from the sign of
+``amount``: negative amounts are expenses.
+"""
+from datetime import datetime
+from datetime import time
+
+import codecs
+import csv
+
+from django.core.exceptions import ValidationError
+from django.db.transaction import atomic
+from django.utils import dateparse
+from django.utils import timezone
+
+import pytz
+
+from books.forms import TransactionForm
+from books.models import MonthlySummary
+from books.models import Transaction
+
+BATCH_SIZE = 1000
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        # list of ``(line number, {field: [messages]})``
+        self.errors = []
+
+
+def decode_lines(chunks, encoding='utf-8-sig'):
+    "Lazily decodes lines of an uploaded file (or any iterable of bytes)"
+    return codecs.iterdecode(chunks, encoding)
+
+
+def _parse_created(value):
+    created = dateparse.parse_datetime(value)
+    if created is None:
+        date = dateparse.parse_date(value)
+        if date is None:
+            raise ValidationError("Enter a valid date or date and time.")
+        created = datetime.combine(date, time.min)
+    if timezone.is_naive(created):
+        try:
+            created = timezone.make_aware(created)
+        except pytz.InvalidTimeError:
+            # skipped or repeated by a daylight saving time switch
+            raise ValidationError(
+                "{} does not exist or is ambiguous in {}.".format(
+                    value, timezone.get_current_timezone_name()))
+    return created
+
+
+def clean_row(row, fields=TransactionForm.base_fields):
+    """
+    Returns cleaned ``title``, ``amount``, ``category`` and ``created``
+
+    Raises ``ValidationError`` with a dict of field errors.
+    """
+    data = {name: (row.get(name) or '').strip()
+            for name in ('title', 'amount', 'category', 'created')}
+    cleaned, errors = {}, {}
+
+    if not data['category'] and data['amount'].startswith('-'):
+        data['category'] = Transaction.EXPENSE
+        data['amount'] = data['amount'][1:]
+    elif not data['category']:
+        data['category'] = Transaction.INCOME
+
+    for name in TransactionForm._meta.fields:
+        try:
+            cleaned[name] = fields[name].clean(data[name])
+        except ValidationError as e:
+            errors[name] = e.messages
+
+    if data['created']:
+        try:
+            cleaned['created'] = _parse_created(data['created'])
+        except (ValidationError, ValueError) as e:
+            errors['created'] = getattr(e, 'messages', [str(e)])
+    else:
+        cleaned['created'] = timezone.now()
+
+    if errors:
+        raise ValidationError(errors)
+    return cleaned
+
+
+def import_transactions(user, lines, batch_size=None):
+    """
+    Imports CSV ``lines`` as ``user``'s transactions in a single transaction
+
+    Returns ``ImportResult`` with number of created transactions and errors
+    of skipped rows.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    result = ImportResult()
+    # ``bulk_create`` skips ``Transaction.save``, which keeps summaries, so
+    # they are summed up here and updated once at the end
+    summary_changes = {}
+
+    def insert(batch):
+        Transaction.objects.bulk_create(batch)
+        MonthlySummary.objects.collect_changes(
+            ({'user_id': user.id, 'created': t.created,
+              'category': t.category, 'amount': t.amount} for t in batch),
+            summary_changes,
+        )
+        result.created += len(batch)
+
+    batch = []
+    reader = csv.DictReader(lines)
+    with atomic():
+        for row in reader:
+            try:
+                cleaned = clean_row(row)
+            except ValidationError as e:
+                # the last line of the row, quoted values can span lines
+                result.errors.append((reader.line_num, e.message_dict))
+                continue
+            batch.append(Transaction(user=user, **cleaned))
+            if len(batch) >= batch_size:
+                insert(batch)
+                batch = []
+        if batch:
+            insert(batch)
+        MonthlySummary.objects.apply_changes(summary_changes)
+    return result
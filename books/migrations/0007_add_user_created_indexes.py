@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Listings only ever show active rows, so on postgres we also keep partial
+# indexes which skip deactivated rows entirely. Other backends (sqlite in
+# tests) do not need them and get only the plain composite indexes.
+PARTIAL_INDEXES = (
+    ('books_trans_active_created_idx', 'books_transaction'),
+    ('books_debtl_active_created_idx', 'books_debtloan'),
+)
+
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table in PARTIAL_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX {} ON {} (user_id, created DESC) '
+            'WHERE active'.format(name, table)
+        )
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0006_add_active_fields'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='debtloan',
+            index=models.Index(fields=['user', '-created'], name='books_debtl_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', '-created'], name='books_trans_user_created_idx'),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
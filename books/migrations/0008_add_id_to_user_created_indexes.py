@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# keyset pagination orders by (created, id), so partial indexes get the
+# ``id`` tie breaker as well
+PARTIAL_INDEXES = (
+    ('books_trans_active_created_idx', 'books_transaction'),
+    ('books_debtl_active_created_idx', 'books_debtloan'),
+)
+
+
+def recreate_partial_indexes(columns):
+    def recreate(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for name, table in PARTIAL_INDEXES:
+            schema_editor.execute('DROP INDEX IF EXISTS {}'.format(name))
+            schema_editor.execute(
+                'CREATE INDEX {} ON {} ({}) WHERE active'.format(
+                    name, table, columns)
+            )
+    return recreate
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0007_add_user_created_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='debtloan',
+            name='books_debtl_user_created_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='books_trans_user_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='debtloan',
+            index=models.Index(fields=['user', '-created', '-id'], name='books_debtl_user_cr_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', '-created', '-id'], name='books_trans_user_cr_id_idx'),
+        ),
+        migrations.RunPython(
+            recreate_partial_indexes('user_id, created DESC, id DESC'),
+            recreate_partial_indexes('user_id, created DESC'),
+        ),
+    ]
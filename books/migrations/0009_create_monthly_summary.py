@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:56
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models import Sum
+from django.db.models.functions import ExtractMonth
+from django.db.models.functions import ExtractYear
+import django.db.models.deletion
+
+import pytz
+
+
+def build_summaries(apps, schema_editor):
+    Transaction = apps.get_model('books', 'Transaction')
+    MonthlySummary = apps.get_model('books', 'MonthlySummary')
+    rows = Transaction.objects \
+        .filter(active=True) \
+        .annotate(year=ExtractYear('created', tzinfo=pytz.utc),
+                  month=ExtractMonth('created', tzinfo=pytz.utc)) \
+        .values('user_id', 'year', 'month', 'category') \
+        .annotate(sum=Sum('amount'), count=Count('id')) \
+        .order_by()
+    MonthlySummary.objects.bulk_create(
+        [MonthlySummary(**row) for row in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('books', '0008_add_id_to_user_created_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('category', models.CharField(choices=[('exp', 'expense'), ('inc', 'income')], max_length=3)),
+                ('sum', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlysummary',
+            unique_together=set([('user', 'year', 'month', 'category')]),
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+from django.db.models import Sum
+from django.db.models.functions import ExtractMonth
+from django.db.models.functions import ExtractYear
+
+import pytz
+
+
+def rebuild_summaries(apps, tz):
+    Transaction = apps.get_model('books', 'Transaction')
+    MonthlySummary = apps.get_model('books', 'MonthlySummary')
+    rows = Transaction.objects \
+        .filter(active=True) \
+        .annotate(year=ExtractYear('created', tzinfo=tz),
+                  month=ExtractMonth('created', tzinfo=tz)) \
+        .values('user_id', 'year', 'month', 'category') \
+        .annotate(sum=Sum('amount'), count=Count('id')) \
+        .order_by()
+    MonthlySummary.objects.all().delete()
+    MonthlySummary.objects.bulk_create(
+        [MonthlySummary(**row) for row in rows],
+        batch_size=1000,
+    )
+
+
+def summarize_in_local_time(apps, schema_editor):
+    rebuild_summaries(apps, pytz.timezone(settings.TIME_ZONE))
+
+
+def summarize_in_utc(apps, schema_editor):
+    rebuild_summaries(apps, pytz.utc)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0009_create_monthly_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(summarize_in_local_time, summarize_in_utc),
+    ]
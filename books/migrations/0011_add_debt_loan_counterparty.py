@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db import models
+
+import books.models
+
+
+def fill_counterparty(apps, schema_editor):
+    DebtLoan = apps.get_model('books', 'DebtLoan')
+    # one UPDATE per distinct spelling, not per row
+    names = DebtLoan.objects.order_by().values_list('with_who', flat=True) \
+        .distinct()
+    for name in names:
+        DebtLoan.objects.filter(with_who=name).update(
+            counterparty=' '.join(name.split()).casefold())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0010_summarize_in_local_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='debtloan',
+            name='counterparty',
+            field=books.models.NormalizedCharField(default='', editable=False, max_length=255, source='with_who'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_counterparty, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='debtloan',
+            index=models.Index(fields=['user', 'counterparty'], name='books_debtl_user_cpty_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 02:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0011_add_debt_loan_counterparty'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='debtloan',
+            index=models.Index(fields=['user', 'modified', 'id'], name='books_debtl_user_mod_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'modified', 'id'], name='books_trans_user_mod_id_idx'),
+        ),
+    ]
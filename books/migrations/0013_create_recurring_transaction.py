@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 02:32
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('books', '0012_add_user_modified_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('category', models.CharField(choices=[('exp', 'expense'), ('inc', 'income')], max_length=3)),
+                ('frequency', models.CharField(choices=[('w', 'weekly'), ('m', 'monthly'), ('y', 'yearly')], default='m', max_length=1)),
+                ('interval', models.PositiveSmallIntegerField(default=1)),
+                ('start', models.DateField()),
+                ('end', models.DateField(blank=True, null=True)),
+                ('next_date', models.DateField(editable=False)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('active', models.BooleanField(default=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='occurrence',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='recurring',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='books.RecurringTransaction'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='transaction',
+            unique_together=set([('recurring', 'occurrence')]),
+        ),
+        migrations.AddIndex(
+            model_name='recurringtransaction',
+            index=models.Index(fields=['active', 'next_date'], name='books_recur_act_next_idx'),
+        ),
+    ]
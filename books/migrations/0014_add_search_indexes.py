@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# expressions have to be the same as the ones ``books.search`` queries with,
+# otherwise postgres does not use the indexes
+INDEXES = (
+    ('books_trans_search_idx', 'books_transaction',
+     "to_tsvector('simple'::regconfig, COALESCE(title, ''))"),
+    ('books_trans_title_trgm_idx', 'books_transaction',
+     'UPPER(title::text) gin_trgm_ops'),
+    ('books_debtl_search_idx', 'books_debtloan',
+     "to_tsvector('simple'::regconfig, "
+     "COALESCE(with_who, '') || ' ' || COALESCE(title, ''))"),
+    ('books_debtl_with_trgm_idx', 'books_debtloan',
+     'UPPER(with_who::text) gin_trgm_ops'),
+    ('books_debtl_title_trgm_idx', 'books_debtloan',
+     'UPPER(title::text) gin_trgm_ops'),
+)
+
+
+def create_indexes(apps, schema_editor):
+    # other databases search without indexes
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, expression in INDEXES:
+        schema_editor.execute('CREATE INDEX {} ON {} USING gin ({})'.format(
+            name, table, expression))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, expression in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0013_create_recurring_transaction'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
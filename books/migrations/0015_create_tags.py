@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 02:36
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('books', '0014_add_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='TransactionTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField()),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='books.Tag')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='books.Transaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='tags',
+            field=models.ManyToManyField(blank=True, related_name='transactions', through='books.TransactionTag', to='books.Tag'),
+        ),
+        migrations.AddIndex(
+            model_name='transactiontag',
+            index=models.Index(fields=['user', 'tag', 'created'], name='books_trtag_user_tag_cr_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='transactiontag',
+            unique_together=set([('transaction', 'tag')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tag',
+            unique_together=set([('user', 'name')]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 02:46
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+CONSTRAINT = 'books_recur_interval_positive'
+
+
+def add_constraint(apps, schema_editor):
+    # an interval of 0 never moves a rule forward; Django 1.11 has no check
+    # constraints and sqlite can't add one to an existing table
+    RecurringTransaction = apps.get_model('books', 'RecurringTransaction')
+    RecurringTransaction.objects.filter(interval__lt=1).update(interval=1)
+    if schema_editor.connection.vendor == 'sqlite':
+        return
+    # ``interval`` is a keyword on postgres
+    schema_editor.execute(
+        'ALTER TABLE books_recurringtransaction ADD CONSTRAINT {} '
+        'CHECK ("interval" >= 1)'.format(CONSTRAINT))
+
+
+def drop_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        return
+    schema_editor.execute(
+        'ALTER TABLE books_recurringtransaction DROP CONSTRAINT {}'.format(
+            CONSTRAINT))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_create_tags'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recurringtransaction',
+            name='interval',
+            field=models.PositiveSmallIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.RunPython(add_constraint, drop_constraint),
+    ]
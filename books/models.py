@@ -1,8 +1,80 @@
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+
+import calendar
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.validators import MinValueValidator
+from django.db import IntegrityError
 from django.db import models
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
 from django.db.models import fields
+from django.db.models.functions import ExtractMonth
+from django.db.models.functions import ExtractYear
+from django.db.transaction import atomic
 from django.utils import timezone
 
+import pytz
+
+# timezone in which transactions are split into months for summaries, it
+# must match month boundaries used by ``books.services``; summaries are
+# rebuilt by a migration whenever it changes
+SUMMARY_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+
+
+class TransactionQuerySet(models.QuerySet):
+    """
+    Set based writes, which keep summaries up to date
+
+    Every method changes all rows of the queryset with a single UPDATE.
+    Changed rows are read (and locked) first, so summaries can be adjusted
+    once per affected month and category, not once per row.
+    """
+    def _summarized_rows(self):
+        return list(self.select_for_update().values(
+            'user_id', 'created', 'category', 'amount'))
+
+    def deactivate(self):
+        "Deactivates active transactions, returns their number"
+        with atomic():
+            active = self.filter(active=True)
+            rows = active._summarized_rows()
+            if not rows:
+                return 0
+            active.update(active=False, modified=timezone.now())
+            MonthlySummary.objects.add_rows(rows, sign=-1)
+        return len(rows)
+
+    def restore(self):
+        "Activates deactivated transactions, returns their number"
+        with atomic():
+            inactive = self.filter(active=False)
+            rows = inactive._summarized_rows()
+            if not rows:
+                return 0
+            inactive.update(active=True, modified=timezone.now())
+            MonthlySummary.objects.add_rows(rows)
+        return len(rows)
+
+    def set_category(self, category):
+        "Moves transactions to ``category``, returns number of changed ones"
+        with atomic():
+            changed = self.exclude(category=category)
+            rows = changed.filter(active=True)._summarized_rows()
+            count = changed.update(category=category,
+                                   modified=timezone.now())
+            MonthlySummary.objects.add_rows(rows, sign=-1)
+            MonthlySummary.objects.add_rows(
+                [dict(row, category=category) for row in rows])
+        return count
+
 
 class Transaction(models.Model):
     EXPENSE = 'exp'
@@ -11,6 +83,9 @@ class Transaction(models.Model):
         (EXPENSE, 'expense'),
         (INCOME, 'income'),
     )
+    # fields which decide where transaction is counted in summaries
+    SUMMARIZED_FIELDS = ('user_id', 'created', 'category', 'amount',
+                         'active')
 
     title = fields.CharField(max_length=255)
     amount = fields.DecimalField(max_digits=10, decimal_places=2)
@@ -19,14 +94,199 @@ class Transaction(models.Model):
     modified = fields.DateTimeField(default=timezone.now)
     active = fields.BooleanField(default=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # rule which created the transaction and its date in the schedule
+    recurring = models.ForeignKey('RecurringTransaction', null=True,
+                                  on_delete=models.SET_NULL, editable=False)
+    occurrence = fields.DateField(null=True, editable=False)
+    tags = models.ManyToManyField('Tag', through='TransactionTag',
+                                  related_name='transactions', blank=True)
+
+    objects = TransactionQuerySet.as_manager()
+
+    class Meta:
+        # a rule creates every occurrence once, however often it is run
+        unique_together = ('recurring', 'occurrence')
+        indexes = [
+            # serves per user listings ordered by newest first
+            models.Index(fields=['user', '-created', '-id'],
+                         name='books_trans_user_cr_id_idx'),
+            # serves delta sync
+            models.Index(fields=['user', 'modified', 'id'],
+                         name='books_trans_user_mod_id_idx'),
+        ]
 
     def __str__(self):
         return "{}".format(self.title)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember loaded state, so ``save`` knows what to move in summaries
+        # without reading the row again
+        instance._summarized_state = instance._get_summarized_state()
+        return instance
+
+    def _get_summarized_state(self):
+        if self.get_deferred_fields().intersection(self.SUMMARIZED_FIELDS):
+            return None
+        return {field: getattr(self, field)
+                for field in self.SUMMARIZED_FIELDS}
+
+    def save(self, *args, **kwargs):
+        # clients sync rows changed since their last sync by ``modified``
+        self.modified = timezone.now()
+        with atomic():
+            previous = None
+            if self.pk is not None:
+                previous = getattr(self, '_summarized_state', None)
+                if previous is None:
+                    previous = Transaction.objects \
+                        .filter(pk=self.pk) \
+                        .values(*self.SUMMARIZED_FIELDS) \
+                        .first()
+            super().save(*args, **kwargs)
+            self._update_summaries(previous)
+            self._summarized_state = self._get_summarized_state()
+
+    def _update_summaries(self, previous):
+        "Moves this transaction's amount from ``previous`` state's summary"
+        if previous == self._get_summarized_state():
+            return
+        if previous and previous['active']:
+            MonthlySummary.objects.add(previous['user_id'],
+                                       previous['created'],
+                                       previous['category'],
+                                       -previous['amount'], -1)
+        if self.active:
+            MonthlySummary.objects.add(self.user_id, self.created,
+                                       self.category, self.amount, 1)
+
     def deactivate(self):
         if self.active:
+            Transaction.objects.filter(pk=self.pk).deactivate()
             self.active = False
-            self.save()
+            self._summarized_state = self._get_summarized_state()
+
+    def set_tags(self, names):
+        "Replaces tags of the saved transaction with tags named ``names``"
+        with atomic():
+            tags = Tag.objects.get_or_create_many(self.user_id, names)
+            links = TransactionTag.objects.filter(transaction=self)
+            linked = set(links.values_list('tag_id', flat=True))
+            removed = linked.difference(tag.pk for tag in tags)
+            if removed:
+                links.filter(tag__in=removed).delete()
+            TransactionTag.objects.bulk_create(
+                TransactionTag(transaction=self, tag=tag, user_id=self.user_id,
+                               created=self.created)
+                for tag in tags if tag.pk not in linked)
+
+
+def normalize_name(name):
+    "Returns ``name`` with collapsed whitespace and folded case"
+    return ' '.join(name.split()).casefold()
+
+
+class NormalizedCharField(fields.CharField):
+    """
+    Normalized copy of the ``source`` field, which is set on every save
+
+    ``bulk_create`` calls ``pre_save`` as well, but ``QuerySet.update`` of
+    the source field leaves the copy as it was.
+    """
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = normalize_name(getattr(model_instance, self.source))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+class TagManager(models.Manager):
+    def get_or_create_many(self, user_id, names):
+        "Returns user's tags named ``names``, creates missing ones"
+        names = [normalize_name(name) for name in names]
+        # without repeated names, in the given order
+        names = [name for i, name in enumerate(names)
+                 if name and name not in names[:i]]
+        if not names:
+            return []
+        tags = {tag.name: tag
+                for tag in self.filter(user_id=user_id, name__in=names)}
+        missing = [name for name in names if name not in tags]
+        if missing:
+            try:
+                with atomic():
+                    self.bulk_create(self.model(user_id=user_id, name=name)
+                                     for name in missing)
+            except IntegrityError:
+                # concurrent request has created some of them in the meantime
+                pass
+            # ids of created rows are not returned by every database
+            tags.update((tag.name, tag) for tag in self.filter(
+                user_id=user_id, name__in=missing))
+        return [tags[name] for name in names]
+
+
+class Tag(models.Model):
+    "User defined label of transactions, e.g. groceries or travel"
+    name = fields.CharField(max_length=50)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    objects = TagManager()
+
+    class Meta:
+        ordering = ('name',)
+        unique_together = ('user', 'name')
+
+    def __str__(self):
+        return "{}".format(self.name)
+
+
+class TransactionTag(models.Model):
+    """
+    Link of a transaction and a tag
+
+    ``user`` and ``created`` are copies of transaction's ones, so sums per
+    tag of a period are read by a range scan of a single index. Transaction
+    ``created`` never changes once it is saved.
+    """
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    created = fields.DateTimeField()
+
+    class Meta:
+        unique_together = ('transaction', 'tag')
+        indexes = [
+            models.Index(fields=['user', 'tag', 'created'],
+                         name='books_trtag_user_tag_cr_idx'),
+        ]
+
+
+class DebtLoanQuerySet(models.QuerySet):
+    "Set based writes, each of them is a single UPDATE"
+    def deactivate(self):
+        "Deactivates active rows, returns their number"
+        return self.filter(active=True).update(active=False,
+                                               modified=timezone.now())
+
+    def restore(self):
+        "Activates deactivated rows, returns their number"
+        return self.filter(active=False).update(active=True,
+                                                modified=timezone.now())
+
+    def set_category(self, category):
+        "Moves rows to ``category``, returns number of changed ones"
+        return self.exclude(category=category).update(
+            category=category, modified=timezone.now())
 
 
 class DebtLoan(models.Model):
@@ -38,6 +298,10 @@ class DebtLoan(models.Model):
     )
 
     with_who = fields.CharField(max_length=255)
+    # debts and loans are netted per counterparty, so "John " and "john"
+    # are the same person
+    counterparty = NormalizedCharField(max_length=255, source='with_who',
+                                       editable=False)
     title = fields.CharField(max_length=255, null=True, blank=True)
     amount = fields.DecimalField(max_digits=10, decimal_places=2)
     category = fields.PositiveSmallIntegerField(choices=CATEGORY_CHOICES)
@@ -46,13 +310,264 @@ class DebtLoan(models.Model):
     active = fields.BooleanField(default=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    objects = DebtLoanQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-created', '-id'],
+                         name='books_debtl_user_cr_id_idx'),
+            models.Index(fields=['user', 'counterparty'],
+                         name='books_debtl_user_cpty_idx'),
+            models.Index(fields=['user', 'modified', 'id'],
+                         name='books_debtl_user_mod_id_idx'),
+        ]
+
     def __str__(self):
         if self.title:
             return "{}: {}".format(self.with_who, self.title)
         else:
             return "{}".format(self.with_who)
 
+    def save(self, *args, **kwargs):
+        # see ``Transaction.save``
+        self.modified = timezone.now()
+        super().save(*args, **kwargs)
+
     def deactivate(self):
         if self.active:
+            DebtLoan.objects.filter(pk=self.pk).deactivate()
             self.active = False
-            self.save()
+
+
+def add_months(day, months, day_of_month):
+    "Returns ``day_of_month`` of the month ``months`` after ``day``'s one"
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    month += 1
+    last_day = calendar.monthrange(year, month)[1]
+    return day.replace(year=year, month=month,
+                       day=min(day_of_month, last_day))
+
+
+class RecurringTransaction(models.Model):
+    """
+    Rule, which creates the same transaction every ``interval`` periods
+
+    Transactions are created by ``materialize_recurring`` management command.
+    ``next_date`` is the first occurrence, which has not been created yet.
+    Monthly and yearly rules keep the day of ``start``, in shorter months
+    they fall on the last day.
+    """
+    WEEKLY = 'w'
+    MONTHLY = 'm'
+    YEARLY = 'y'
+    FREQUENCY_CHOICES = (
+        (WEEKLY, 'weekly'),
+        (MONTHLY, 'monthly'),
+        (YEARLY, 'yearly'),
+    )
+
+    title = fields.CharField(max_length=255)
+    amount = fields.DecimalField(max_digits=10, decimal_places=2)
+    category = fields.CharField(max_length=3,
+                                choices=Transaction.CATEGORY_CHOICES)
+    frequency = fields.CharField(max_length=1, choices=FREQUENCY_CHOICES,
+                                 default=MONTHLY)
+    interval = fields.PositiveSmallIntegerField(
+        default=1, validators=[MinValueValidator(1)])
+    start = fields.DateField()
+    end = fields.DateField(null=True, blank=True)
+    next_date = fields.DateField(editable=False)
+    created = fields.DateTimeField(default=timezone.now, editable=False)
+    active = fields.BooleanField(default=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            # serves the scheduler's lookup of due rules
+            models.Index(fields=['active', 'next_date'],
+                         name='books_recur_act_next_idx'),
+        ]
+
+    def __str__(self):
+        return "{}".format(self.title)
+
+    def save(self, *args, **kwargs):
+        if self.next_date is None:
+            self.next_date = self.start
+        super().save(*args, **kwargs)
+
+    def get_next_date(self, day):
+        "Returns the occurrence following the occurrence on ``day``"
+        if self.frequency == self.WEEKLY:
+            return day + timedelta(weeks=self.interval)
+        months = self.interval * (12 if self.frequency == self.YEARLY else 1)
+        return add_months(day, months, self.start.day)
+
+    def get_due_dates(self, until):
+        "Returns occurrences from ``next_date`` to ``until`` and ``end``"
+        last = until if self.end is None else min(until, self.end)
+        dates = []
+        day = self.next_date
+        while day <= last:
+            dates.append(day)
+            next_day = self.get_next_date(day)
+            if next_day <= day:
+                # a rule, which does not move forward, would never end
+                break
+            day = next_day
+        return dates
+
+    def make_transaction(self, day):
+        "Returns unsaved transaction of the occurrence on ``day``"
+        return Transaction(
+            title=self.title, amount=self.amount, category=self.category,
+            created=SUMMARY_TIMEZONE.localize(datetime.combine(day, time.min)),
+            user_id=self.user_id, recurring=self, occurrence=day)
+
+
+class MonthlySummaryManager(models.Manager):
+    def compute(self, users=None):
+        "Returns unsaved summaries computed from transactions of ``users``"
+        qs = Transaction.objects.filter(active=True)
+        if users is not None:
+            qs = qs.filter(user__in=users)
+        rows = qs \
+            .annotate(year=ExtractYear('created', tzinfo=SUMMARY_TIMEZONE),
+                      month=ExtractMonth('created', tzinfo=SUMMARY_TIMEZONE)) \
+            .values('user_id', 'year', 'month', 'category') \
+            .annotate(sum=Sum('amount'), count=Count('id')) \
+            .order_by()
+        return [self.model(**row) for row in rows]
+
+    def rebuild(self, users=None, batch_size=1000):
+        "Replaces summaries of ``users`` (everybody by default)"
+        with atomic():
+            summaries = self.compute(users)
+            qs = self.all()
+            if users is not None:
+                qs = qs.filter(user__in=users)
+            qs.delete()
+            self.bulk_create(summaries, batch_size=batch_size)
+        return summaries
+
+    def add(self, user_id, created, category, amount, count):
+        "Adds ``amount`` and ``count`` to the month ``created`` belongs to"
+        year, month = MonthlySummary.period_of(created)
+        self._add(user_id, year, month, category, amount, count)
+
+    def add_rows(self, rows, sign=1):
+        """
+        Adds (or with ``sign=-1`` subtracts) many transactions at once
+
+        ``rows`` are dicts with ``user_id``, ``created``, ``category`` and
+        ``amount`` keys. Each affected summary is updated only once.
+        """
+        self.apply_changes(self.collect_changes(rows), sign)
+
+    def collect_changes(self, rows, changes=None):
+        "Sums ``rows`` per summary into ``changes`` dict, which is returned"
+        changes = {} if changes is None else changes
+        for row in rows:
+            year, month = MonthlySummary.period_of(row['created'])
+            key = (row['user_id'], year, month, row['category'])
+            amount, count = changes.get(key, (0, 0))
+            changes[key] = (amount + row['amount'], count + 1)
+        return changes
+
+    def apply_changes(self, changes, sign=1):
+        for (user_id, year, month, category), (amount, count) in \
+                changes.items():
+            self._add(user_id, year, month, category,
+                      sign * amount, sign * count)
+
+    def apply_changes_in_bulk(self, changes):
+        """
+        Applies ``changes`` with a fixed number of queries
+
+        Meant for changes of many users at once, where ``apply_changes``
+        would make a query or two per summary. Existing summaries are
+        updated by a single UPDATE, missing ones are inserted at once.
+        """
+        if not changes:
+            return
+        rows = self.select_for_update() \
+            .filter(user_id__in={key[0] for key in changes},
+                    year__in={key[1] for key in changes}) \
+            .values_list('pk', 'user_id', 'year', 'month', 'category')
+        existing = {tuple(key): pk for pk, *key in rows if
+                    tuple(key) in changes}
+
+        if existing:
+            sums, counts = [], []
+            for key, pk in existing.items():
+                amount, count = changes[key]
+                sums.append(When(pk=pk, then=Value(amount)))
+                counts.append(When(pk=pk, then=Value(count)))
+            self.filter(pk__in=existing.values()).update(
+                sum=F('sum') + Case(*sums, output_field=self.model._meta
+                                    .get_field('sum')),
+                count=F('count') + Case(*counts, output_field=self.model
+                                        ._meta.get_field('count')))
+
+        missing = {key: value for key, value in changes.items()
+                   if key not in existing}
+        try:
+            with atomic():
+                self.bulk_create(
+                    self.model(user_id=user_id, year=year, month=month,
+                               category=category, sum=amount, count=count)
+                    for (user_id, year, month, category), (amount, count)
+                    in missing.items())
+        except IntegrityError:
+            # concurrent request has created some of them in the meantime
+            self.apply_changes(missing)
+
+    def _add(self, user_id, year, month, category, amount, count):
+        summary = self.filter(user_id=user_id, year=year, month=month,
+                              category=category)
+        changes = {'sum': F('sum') + amount, 'count': F('count') + count}
+        if summary.update(**changes):
+            return
+        try:
+            with atomic():
+                self.create(user_id=user_id, year=year, month=month,
+                            category=category, sum=amount, count=count)
+        except IntegrityError:
+            # concurrent request has created the row in the meantime
+            summary.update(**changes)
+
+
+class MonthlySummary(models.Model):
+    """
+    Sum and count of user's active transactions per month and category
+
+    Rows are maintained incrementally by ``Transaction.save``, and can be
+    rebuilt from scratch with ``rebuild_summaries`` management command.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    year = fields.PositiveSmallIntegerField()
+    month = fields.PositiveSmallIntegerField()
+    category = fields.CharField(max_length=3,
+                                choices=Transaction.CATEGORY_CHOICES)
+    sum = fields.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = fields.IntegerField(default=0)
+
+    objects = MonthlySummaryManager()
+
+    class Meta:
+        unique_together = ('user', 'year', 'month', 'category')
+
+    def __str__(self):
+        return "{} {}-{:02d} {}".format(self.user_id, self.year, self.month,
+                                        self.category)
+
+    @staticmethod
+    def period_of(created):
+        "Returns ``(year, month)`` which summarizes time ``created``"
+        created = created.astimezone(SUMMARY_TIMEZONE)
+        return created.year, created.month
+
+    @staticmethod
+    def start_of(year, month):
+        "Returns the first moment of a summarized month"
+        return SUMMARY_TIMEZONE.localize(datetime(year, month, 1))
@@ -0,0 +1,101 @@
+"""
+Materialization of recurring transactions
+
+Due rules are processed in batches ordered by primary key. Every batch
+creates transactions of all its due occurrences, periods missed since the
+last run included, and moves rules' ``next_date`` past them in a single
+database transaction. A batch takes the same few queries whatever number
+of rules and users it holds, so a run makes a number of queries
+proportional to the number of batches, not rules.
+
+Rules are locked while their batch is processed and occurrences, which
+already exist, are skipped, so concurrent or repeated runs create every
+occurrence once; the unique ``(recurring, occurrence)`` constraint of
+transactions guarantees it.
+"""
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from books.models import MonthlySummary
+from books.models import RecurringTransaction
+from books.models import Transaction
+from books import cache
+
+BATCH_SIZE = 1000
+
+
+class MaterializeResult:
+    def __init__(self):
+        self.rules = 0
+        self.created = 0
+        self.users = set()
+
+
+def get_due_rules(today):
+    "Returns active rules with an occurrence on or before ``today``"
+    return RecurringTransaction.objects \
+        .filter(active=True, next_date__lte=today) \
+        .filter(Q(end=None) | Q(end__gte=F('next_date')))
+
+
+def materialize_batch(rules, today, result):
+    "Creates due transactions of locked ``rules``, updates ``result``"
+    existing = set(Transaction.objects
+                   .filter(recurring__in=rules,
+                           occurrence__gte=min(r.next_date for r in rules))
+                   .values_list('recurring_id', 'occurrence'))
+    transactions = []
+    next_dates = []
+    for rule in rules:
+        dates = rule.get_due_dates(today)
+        transactions.extend(rule.make_transaction(day) for day in dates
+                            if (rule.pk, day) not in existing)
+        next_dates.append(When(pk=rule.pk, then=Value(
+            rule.get_next_date(dates[-1]) if dates else rule.next_date)))
+
+    # ``bulk_create`` skips ``Transaction.save``, which keeps summaries
+    Transaction.objects.bulk_create(transactions, batch_size=BATCH_SIZE)
+    MonthlySummary.objects.apply_changes_in_bulk(
+        MonthlySummary.objects.collect_changes(
+            {'user_id': t.user_id, 'created': t.created,
+             'category': t.category, 'amount': t.amount}
+            for t in transactions))
+    RecurringTransaction.objects \
+        .filter(pk__in=[rule.pk for rule in rules]) \
+        .update(next_date=Case(*next_dates, output_field=RecurringTransaction
+                               ._meta.get_field('next_date')))
+
+    result.rules += len(rules)
+    result.created += len(transactions)
+    result.users.update(t.user_id for t in transactions)
+
+
+def materialize(today=None, batch_size=None):
+    """
+    Creates transactions of all due rules up to ``today``
+
+    Returns ``MaterializeResult`` with numbers of processed rules, created
+    transactions and users, whose caches have been invalidated.
+    """
+    today = today or timezone.localdate()
+    batch_size = batch_size or BATCH_SIZE
+    result = MaterializeResult()
+    last_pk = 0
+    while True:
+        with atomic():
+            rules = list(get_due_rules(today)
+                         .select_for_update()
+                         .filter(pk__gt=last_pk)
+                         .order_by('pk')[:batch_size])
+            if not rules:
+                break
+            materialize_batch(rules, today, result)
+        last_pk = rules[-1].pk
+    for user_id in result.users:
+        cache.bump_version(user_id)
+    return result
@@ -0,0 +1,98 @@
+"""
+Search in titles of transactions and debts/loans and in counterparties
+
+On postgres every word of a query matches beginnings of words (``rent``
+finds "Rental payment") through ``to_tsvector`` GIN indexes, and the whole
+query matches anywhere in the text ("market" finds "Supermarket") through
+trigram GIN indexes. Matches are ranked by ``ts_rank``, substring only
+matches come last. Indexes are used only by queries, which repeat indexed
+expressions exactly, so ``FIELDS`` and ``CONFIG`` have to match migration
+0014.
+
+Other databases (sqlite in tests) match every word anywhere in the fields
+and order matches by recency.
+
+Ranked results can't be paged by ``created`` cursors, pages are sliced by
+offset instead.
+"""
+import re
+
+from django.contrib.postgres.search import SearchQueryField
+from django.contrib.postgres.search import SearchRank
+from django.contrib.postgres.search import SearchVector
+from django.db import connections
+from django.db.models import F
+from django.db.models import Func
+from django.db.models import Q
+from django.db.models import Value
+
+from books.models import DebtLoan
+from books.models import Transaction
+
+# titles are in any language, so words are not stemmed
+CONFIG = 'simple'
+
+FIELDS = {
+    Transaction: ('title',),
+    DebtLoan: ('with_who', 'title'),
+}
+
+PAGE_SIZE = 50
+MAX_WORDS = 10
+# trigram indexes can't find shorter substrings
+MIN_SUBSTRING_LENGTH = 3
+
+
+class PrefixQuery(Func):
+    "``tsquery`` matching words, which start with all of ``words``"
+    function = 'to_tsquery'
+    template = "%(function)s('{}'::regconfig, %(expressions)s)".format(CONFIG)
+
+    def __init__(self, words):
+        super().__init__(
+            Value(' & '.join('{}:*'.format(word) for word in words)),
+            output_field=SearchQueryField())
+
+
+def get_words(query):
+    "Returns words of ``query`` without characters special to ``tsquery``"
+    return re.findall(r'[^\W_]+', query.lower())[:MAX_WORDS]
+
+
+def _contains(fields, text):
+    condition = Q()
+    for field in fields:
+        condition |= Q(**{field + '__icontains': text})
+    return condition
+
+
+def search(qs, query):
+    "Returns rows of ``qs`` matching ``query``, the best matches first"
+    words = get_words(query)
+    if not words:
+        return qs.none()
+    fields = FIELDS[qs.model]
+
+    if connections[qs.db].vendor != 'postgresql':
+        for word in words:
+            qs = qs.filter(_contains(fields, word))
+        return qs.order_by('-created', '-id')
+
+    prefix_query = PrefixQuery(words)
+    condition = Q(search=prefix_query)
+    text = ' '.join(query.split())
+    if len(text) >= MIN_SUBSTRING_LENGTH:
+        condition |= _contains(fields, text)
+    return qs \
+        .annotate(search=SearchVector(*fields, config=CONFIG)) \
+        .annotate(rank=SearchRank(F('search'), prefix_query)) \
+        .filter(condition) \
+        .order_by('-rank', '-created', '-id')
+
+
+def get_page(qs, page=1, page_size=None):
+    "Returns rows of the 1-based ``page`` and whether there is a next one"
+    page_size = page_size or PAGE_SIZE
+    offset = (page - 1) * page_size
+    rows = list(qs[offset:offset + page_size + 1])
+    return rows[:page_size], len(rows) > page_size
@@ -1,36 +1,367 @@
+from collections import namedtuple
+from datetime import date
 from datetime import datetime
+from datetime import time
 from datetime import timedelta
+from functools import lru_cache
 
+import pytz
+
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import DecimalField
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Q
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
 from django.utils import timezone
 
+from books.models import DebtLoan
+from books.models import MonthlySummary
 from books.models import Transaction
+from books.models import TransactionTag
 
+PAGE_SIZE = 50
 
-def get_months_transactions(user):
-    today = timezone.now()
-    first_day_of_a_month = datetime(today.year, today.month, 1,
-                                    tzinfo=today.tzinfo)
-    qs = Transaction.objects.filter(created__gte=first_day_of_a_month,
-                                    user=user,
-                                    active=True)
+SYNC_PAGE_SIZE = 500
+# longest time a write may take to commit, see ``get_changes``
+SYNC_OVERLAP = timedelta(minutes=5)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+# the largest value of ``AutoField``
+MAX_PK = 2 ** 31 - 1
+
+# half-open ``[start, end)`` range of aware datetimes, ``None`` is unbounded
+PeriodRange = namedtuple('PeriodRange', 'start end')
+
+
+def _local_midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _add_months(day, months):
+    "Returns the first day of the month ``months`` after ``day``'s one"
+    months += day.year * 12 + day.month - 1
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def get_date_range(start=None, end=None):
+    "Returns range of local dates from ``start`` to ``end``, both inclusive"
+    return PeriodRange(
+        _local_midnight(start) if start else None,
+        _local_midnight(end + timedelta(days=1)) if end else None,
+    )
+
+
+@lru_cache(maxsize=64)
+def _get_named_range(period, today, tzname):
+    "Named period around ``today`` in ``tzname``, cached as it never changes"
+    if period == 'this_month':
+        return get_date_range(_add_months(today, 0),
+                              _add_months(today, 1) - timedelta(days=1))
+    if period == 'last_month':
+        return get_date_range(_add_months(today, -1),
+                              _add_months(today, 0) - timedelta(days=1))
+    if period == 'this_year':
+        return get_date_range(date(today.year, 1, 1),
+                              date(today.year, 12, 31))
+    return PeriodRange(None, None)
+
+
+PERIODS = ('this_month', 'last_month', 'this_year', 'all_time')
+
+
+def get_period_range(period):
+    "Returns ``PeriodRange`` of a named period in the current timezone"
+    today = timezone.localtime(timezone.now()).date()
+    return _get_named_range(period, today,
+                            timezone.get_current_timezone_name())
+
+
+def get_period_start(period):
+    "Returns the first moment of a named period, ``None`` for all time"
+    return get_period_range(period).start
+
+
+def filter_period(qs, period_range):
+    "Filters ``qs`` by ``created`` in a way an index on it can serve"
+    if period_range.start is not None:
+        qs = qs.filter(created__gte=period_range.start)
+    if period_range.end is not None:
+        qs = qs.filter(created__lt=period_range.end)
     return qs
 
 
+def get_period_transactions(user, period):
+    qs = Transaction.objects.filter(user=user, active=True)
+    return filter_period(qs, get_period_range(period))
+
+
+def get_months_transactions(user):
+    return get_period_transactions(user, 'this_month')
+
+
 def get_last_months_transactions(user):
-    first_day_of_a_month = timezone.now().replace(day=1)
-    last_month = first_day_of_a_month - timedelta(days=1)
-    first_day_of_last_month = datetime(last_month.year, last_month.month, 1,
-                                       tzinfo=last_month.tzinfo)
-    qs = Transaction.objects.filter(created__gte=first_day_of_last_month,
-                                    user=user,
-                                    active=True)
-    return qs
+    return get_period_transactions(user, 'last_month')
 
 
 def get_this_years_transactions(user):
-    today = timezone.now()
-    first_day_of_this_year = datetime(today.year, 1, 1, tzinfo=today.tzinfo)
-    qs = Transaction.objects.filter(created__gte=first_day_of_this_year,
-                                    user=user,
-                                    active=True)
-    return qs
+    return get_period_transactions(user, 'this_year')
+
+
+def _get_category_totals(qs, sum_field='amount', count_field=None,
+                         **categories):
+    """
+    Sums and counts ``amount`` of every category in a single query
+
+    Keyword arguments map name prefix to category value, e.g.
+    ``income=Transaction.INCOME`` results in ``income_sum`` and
+    ``income_count`` keys. Sums of categories without rows are ``None``.
+    Pre-aggregated rows pass ``sum_field`` and ``count_field`` to be summed.
+    """
+    aggregates = {}
+    for name, category in categories.items():
+        aggregates['{}_sum'.format(name)] = Sum(Case(
+            When(category=category, then=sum_field),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ))
+        if count_field is None:
+            count = Count(Case(When(category=category, then='id')))
+        else:
+            count = Sum(Case(When(category=category, then=count_field)))
+        aggregates['{}_count'.format(name)] = count
+    totals = qs.aggregate(**aggregates)
+    for name in categories:
+        totals['{}_count'.format(name)] = totals['{}_count'.format(name)] or 0
+    return totals
+
+
+def get_transaction_totals(qs):
+    return _get_category_totals(qs,
+                                income=Transaction.INCOME,
+                                expense=Transaction.EXPENSE)
+
+
+def get_summary_totals(user, since=None, until=None):
+    """
+    Transaction totals of months from ``since`` up to ``until`` (excluded)
+
+    Both are starts of months, like ``PeriodRange`` of named periods has.
+    Returns the same keys as ``get_transaction_totals`` does, but reads at
+    most a couple of rows per month instead of every transaction.
+    """
+    qs = MonthlySummary.objects.filter(user=user)
+    if since is not None:
+        year, month = MonthlySummary.period_of(since)
+        qs = qs.filter(Q(year__gt=year) | Q(year=year, month__gte=month))
+    if until is not None:
+        year, month = MonthlySummary.period_of(until)
+        qs = qs.filter(Q(year__lt=year) | Q(year=year, month__lt=month))
+    return _get_category_totals(qs,
+                                sum_field='sum',
+                                count_field='count',
+                                income=Transaction.INCOME,
+                                expense=Transaction.EXPENSE)
+
+
+def get_debt_loan_totals(qs):
+    return _get_category_totals(qs,
+                                debt=DebtLoan.DEBT,
+                                loan=DebtLoan.LOAN)
+
+
+def get_counterparty_totals(qs):
+    """
+    Debts and loans of ``qs`` netted per counterparty in a single query
+
+    Returns list of dicts with ``counterparty``, ``name`` (one of its
+    spellings), ``debt``, ``loan``, ``count`` and ``balance`` keys ordered by
+    counterparty. Positive ``balance`` is owed to the user.
+    """
+    amount = DecimalField(max_digits=14, decimal_places=2)
+
+    def sum_of(category):
+        return Sum(Case(When(category=category, then='amount'),
+                        default=Value(0), output_field=amount))
+
+    return list(qs
+                .values('counterparty')
+                .annotate(name=Max('with_who'),
+                          debt=sum_of(DebtLoan.DEBT),
+                          loan=sum_of(DebtLoan.LOAN),
+                          count=Count('id'))
+                .annotate(balance=F('loan') - F('debt'))
+                .order_by('counterparty'))
+
+
+def get_tag_breakdown(user, period_range):
+    """
+    Sums of user's active transactions per tag in a single grouped query
+
+    Returns list of dicts with ``tag`` (id), ``name``, ``expense_sum``,
+    ``income_sum`` and ``count`` keys ordered by name. A transaction with
+    several tags is counted in each of them.
+    """
+    amount = DecimalField(max_digits=14, decimal_places=2)
+
+    def sum_of(category):
+        return Sum(Case(When(transaction__category=category,
+                             then='transaction__amount'),
+                        default=Value(0), output_field=amount))
+
+    qs = TransactionTag.objects.filter(user=user, transaction__active=True)
+    return list(filter_period(qs, period_range)
+                .values('tag')
+                .annotate(name=Max('tag__name'),
+                          expense_sum=sum_of(Transaction.EXPENSE),
+                          income_sum=sum_of(Transaction.INCOME),
+                          count=Count('id'))
+                .order_by('name'))
+
+
+def encode_position(moment, pk):
+    "Returns opaque cursor of ``(moment, pk)`` keyset position"
+    micros = (moment - EPOCH) // timedelta(microseconds=1)
+    return '{}_{}'.format(micros, pk)
+
+
+def _get_position(obj, field):
+    "Returns ``(field value, pk)`` of a model instance or a ``values()`` row"
+    if isinstance(obj, dict):
+        return obj[field], obj['id']
+    return getattr(obj, field), obj.pk
+
+
+def encode_cursor(obj):
+    """
+    Returns opaque cursor pointing right after ``obj`` in a list
+
+    ``obj`` is a model instance or a ``values()`` row with ``created`` and
+    ``id`` keys.
+    """
+    return encode_position(*_get_position(obj, 'created'))
+
+
+def decode_cursor(cursor):
+    "Returns ``(created, pk)`` tuple of a cursor or ``None`` if it's invalid"
+    try:
+        micros, pk = cursor.split('_')
+        moment, pk = EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        # ``OverflowError`` is raised by times out of datetime's range
+        return None
+    # the database can't bind larger ids
+    if not 0 <= pk <= MAX_PK:
+        return None
+    return moment, pk
+
+
+def get_page(qs, cursor=None, page_size=None):
+    """
+    Keyset pagination of ``qs`` from the newest to the oldest row
+
+    Rows are ordered by ``(created, id)``, so every page is a range scan of
+    ``(user, created, id)`` index, no matter how deep it is. Returns a list
+    of page rows and a cursor of the next page, or ``None`` on the last one.
+    ``values()`` querysets have to include ``created`` and ``id``.
+    """
+    page_size = page_size or PAGE_SIZE
+    qs = qs.order_by('-created', '-id')
+    position = decode_cursor(cursor)
+    if position is not None:
+        created, pk = position
+        # ``created__lte`` bounds the index scan, the rest breaks ties
+        qs = qs.filter(Q(created__lt=created) | Q(id__lt=pk),
+                       created__lte=created)
+
+    rows = list(qs[:page_size + 1])
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def get_changes(qs, since=None, page_size=None):
+    """
+    Rows of ``qs`` created, changed or deactivated after the ``since`` token
+
+    Rows are ordered by ``(modified, id)``, a range scan of ``(user,
+    modified, id)`` index. Returns a list of rows, the token to continue
+    from and whether there are more rows right away. Without a token every
+    row is returned. ``values()`` querysets have to include ``modified``
+    and ``id``.
+
+    ``modified`` is set before a write commits, so a slow write may become
+    visible after a later one was synced. The last page's token therefore
+    points ``SYNC_OVERLAP`` into the past and the next sync may return a
+    few rows again, clients apply rows by id.
+    """
+    page_size = page_size or SYNC_PAGE_SIZE
+    qs = qs.order_by('modified', 'id')
+    position = decode_cursor(since)
+    if position is not None:
+        modified, pk = position
+        qs = qs.filter(Q(modified__gt=modified) | Q(id__gt=pk),
+                       modified__gte=modified)
+
+    rows = list(qs[:page_size + 1])
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = _get_position(rows[-1], 'modified')
+        return rows, encode_position(*last), True
+
+    horizon = (timezone.now() - SYNC_OVERLAP, 0)
+    if rows:
+        position = _get_position(rows[-1], 'modified')
+    return rows, encode_position(*min(position or horizon, horizon)), False
+
+
+def _signed_sum(field):
+    "Sum of ``field`` with income counted as positive and expense negative"
+    return Sum(Case(
+        When(category=Transaction.INCOME, then=F(field)),
+        When(category=Transaction.EXPENSE, then=F(field) * -1),
+        output_field=DecimalField(max_digits=14, decimal_places=2),
+    ))
+
+
+def get_balance(user, created, pk):
+    """
+    Balance of user's transactions up to and including ``(created, pk)``
+
+    Months before the one of ``created`` are read from summaries, so only
+    the rows of a single month are summed up, however long the history is.
+    """
+    year, month = MonthlySummary.period_of(created)
+    earlier = MonthlySummary.objects \
+        .filter(user=user) \
+        .filter(Q(year__lt=year) | Q(year=year, month__lt=month)) \
+        .aggregate(balance=_signed_sum('sum'))['balance']
+    this_month = Transaction.objects \
+        .filter(user=user, active=True,
+                created__gte=MonthlySummary.start_of(year, month),
+                created__lte=created) \
+        .filter(Q(created__lt=created) | Q(id__lte=pk)) \
+        .aggregate(balance=_signed_sum('amount'))['balance']
+    return (earlier or 0) + (this_month or 0)
+
+
+def set_running_balances(user, transactions):
+    """
+    Sets ``balance`` after each of ``transactions``
+
+    Transactions must be ordered from the newest, like ``get_page`` returns
+    them. Earlier pages do not need to be loaded.
+    """
+    if not transactions:
+        return
+    first = transactions[0]
+    balance = get_balance(user, first.created, first.pk)
+    for transaction in transactions:
+        transaction.balance = balance
+        if transaction.category == Transaction.INCOME:
+            balance -= transaction.amount
+        else:
+            balance += transaction.amount
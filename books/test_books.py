@@ -1,17 +1,43 @@
+from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
 from unittest import mock
 
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import Client
 from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.http import http_date
 
 import pytz
 
 from books.factories import DebtLoanFactory
+from books.factories import RecurringTransactionFactory
 from books.factories import TransactionFactory
 from books.factories import UserFactory
 from books.models import DebtLoan
+from books.models import MonthlySummary
+from books.models import RecurringTransaction
+from books.models import Tag
 from books.models import Transaction
+from books.models import TransactionTag
+from books import analytics
+from books import cache
+from books import forms
+from books import importer
+from books import recurring
+from books import search
 from books import services
 
 
@@ -89,7 +115,8 @@ class TransactionTests(TestCase):
 
         t = TransactionFactory(title='first',
                                amount=1,
-                               category=Transaction.EXPENSE)
+                               category=Transaction.EXPENSE,
+                               user=self.user)
         self.assertEqual(1, Transaction.objects.count())
         self.assertTrue(Transaction.objects.all()[0].active)
 
@@ -130,8 +157,8 @@ class TransactionFilterTests(TestCase):
 
 
     def test_this_months_transactions(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             transactions = services.get_months_transactions(self.user)
             # make test deterministic
@@ -141,8 +168,8 @@ class TransactionFilterTests(TestCase):
             self.assertEqual(transactions[0].title, 'this_month')
 
     def test_this_months_transactions_list(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             c = Client()
             logged_in = c.login(username=self.user.username, password='secret')
@@ -155,36 +182,32 @@ class TransactionFilterTests(TestCase):
             self.assertSequenceEqual(qs, [self.this_month])
 
     def test_last_months_transactions(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             transactions = services.get_last_months_transactions(self.user)
-            # make test deterministic
-            transactions = transactions.order_by("-created")
 
-            self.assertEqual(len(transactions), 2)
-            self.assertEqual(transactions[0].title, 'this_month')
-            self.assertEqual(transactions[1].title, 'last_month')
+            # this month is not a part of the last one
+            self.assertEqual(len(transactions), 1)
+            self.assertEqual(transactions[0].title, 'last_month')
 
     def test_last_months_transactions_list(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             c = Client()
             logged_in = c.login(username=self.user.username, password='secret')
             self.assertTrue(logged_in)
 
-            response = c.get(reverse('transaction_list_filter'),
-                             {'filter': 'last_month'},
-                             follow=True)
-            self.assertRedirects(response, reverse('transaction_list'))
+            response = c.get(reverse('transaction_list'),
+                             {'filter': 'last_month'})
 
             qs = response.context['transactions']
-            self.assertSequenceEqual(qs, [self.this_month, self.last_month])
+            self.assertSequenceEqual(qs, [self.last_month])
 
     def test_this_years_transactions(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             transactions = services.get_this_years_transactions(self.user)
             # make test deterministic
@@ -196,17 +219,15 @@ class TransactionFilterTests(TestCase):
             self.assertEqual(transactions[2].title, 'this_year')
 
     def test_this_years_transactions_list(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             c = Client()
             logged_in = c.login(username=self.user.username, password='secret')
             self.assertTrue(logged_in)
 
-            response = c.get(reverse('transaction_list_filter'),
-                             {'filter': 'this_year'},
-                             follow=True)
-            self.assertRedirects(response, reverse('transaction_list'))
+            response = c.get(reverse('transaction_list'),
+                             {'filter': 'this_year'})
 
             qs = response.context['transactions']
             self.assertSequenceEqual(
@@ -215,17 +236,15 @@ class TransactionFilterTests(TestCase):
             )
 
     def test_all_time_transactions_list(self):
-        with mock.patch('books.services.timezone') as mock_now:
-            mock_now.now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
 
             c = Client()
             logged_in = c.login(username=self.user.username, password='secret')
             self.assertTrue(logged_in)
 
-            response = c.get(reverse('transaction_list_filter'),
-                             {'filter': 'all_time'},
-                             follow=True)
-            self.assertRedirects(response, reverse('transaction_list'))
+            response = c.get(reverse('transaction_list'),
+                             {'filter': 'all_time'})
 
             qs = response.context['transactions']
             self.assertSequenceEqual(
@@ -233,6 +252,1394 @@ class TransactionFilterTests(TestCase):
                 [self.this_month, self.last_month, self.this_year, self.last_year]
             )
 
+    def test_filter_does_not_touch_session(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('transaction_list'),
+                                   {'filter': 'this_year'})
+        self.assertEqual(response.context['fltr'], 'this_year')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_old_filter_link_redirects(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('transaction_list_filter'),
+                                   {'filter': 'this_year'})
+        self.assertRedirects(
+            response, reverse('transaction_list') + '?filter=this_year')
+
+
+class PeriodRangeTests(TestCase):
+    def get_range(self, period, now):
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = now
+            return services.get_period_range(period)
+
+    def test_named_periods_in_local_time(self):
+        # already April in Vilnius, which is UTC+3 in summer
+        now = datetime(2015, 3, 31, 22, 30, tzinfo=pytz.utc)
+        vilnius = pytz.timezone('Europe/Vilnius')
+
+        self.assertEqual(self.get_range('this_month', now), (
+            vilnius.localize(datetime(2015, 4, 1)),
+            vilnius.localize(datetime(2015, 5, 1)),
+        ))
+        # starts in winter time, ends in summer time
+        period = self.get_range('last_month', now)
+        self.assertEqual(period.start,
+                         datetime(2015, 2, 28, 22, tzinfo=pytz.utc))
+        self.assertEqual(period.end,
+                         datetime(2015, 3, 31, 21, tzinfo=pytz.utc))
+        self.assertEqual(self.get_range('this_year', now), (
+            vilnius.localize(datetime(2015, 1, 1)),
+            vilnius.localize(datetime(2016, 1, 1)),
+        ))
+        self.assertEqual(self.get_range('all_time', now), (None, None))
+
+    def test_last_month_in_january(self):
+        period = self.get_range('last_month',
+                                datetime(2016, 1, 15, tzinfo=pytz.utc))
+        self.assertEqual(timezone.localtime(period.start).date(),
+                         date(2015, 12, 1))
+        self.assertEqual(timezone.localtime(period.end).date(),
+                         date(2016, 1, 1))
+
+    def test_ranges_are_memoized(self):
+        now = datetime(2015, 4, 23, tzinfo=pytz.utc)
+        self.assertIs(self.get_range('this_month', now),
+                      self.get_range('this_month', now))
+
+    def test_date_range(self):
+        period = services.get_date_range(date(2015, 4, 1), date(2015, 4, 30))
+        self.assertEqual(period.end - period.start, timedelta(days=30))
+        self.assertEqual(services.get_date_range(), (None, None))
+
+    def test_filter_period(self):
+        user = UserFactory()
+        dates = [datetime(2015, 3, 31, 20, 59), datetime(2015, 3, 31, 21),
+                 datetime(2015, 4, 30, 20, 59), datetime(2015, 4, 30, 21)]
+        for created in dates:
+            TransactionFactory(user=user, created=pytz.utc.localize(created))
+
+        period = services.get_date_range(date(2015, 4, 1), date(2015, 4, 30))
+        qs = services.filter_period(Transaction.objects.all(), period)
+        self.assertEqual(
+            sorted(t.created for t in qs),
+            [pytz.utc.localize(created) for created in dates[1:3]])
+
+
+class TotalsTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+
+    def test_transaction_totals(self):
+        TransactionFactory(amount=10, category=Transaction.EXPENSE,
+                           user=self.user)
+        TransactionFactory(amount=5, category=Transaction.EXPENSE,
+                           user=self.user)
+        TransactionFactory(amount=7, category=Transaction.INCOME,
+                           user=self.user)
+
+        qs = Transaction.objects.filter(user=self.user)
+        with self.assertNumQueries(1):
+            totals = services.get_transaction_totals(qs)
+
+        self.assertEqual(totals['expense_sum'], 15)
+        self.assertEqual(totals['expense_count'], 2)
+        self.assertEqual(totals['income_sum'], 7)
+        self.assertEqual(totals['income_count'], 1)
+
+    def test_transaction_totals_empty(self):
+        totals = services.get_transaction_totals(Transaction.objects.all())
+        self.assertIsNone(totals['expense_sum'])
+        self.assertEqual(totals['expense_count'], 0)
+
+    def test_debt_loan_totals(self):
+        DebtLoanFactory(amount=3, category=DebtLoan.DEBT, user=self.user)
+        DebtLoanFactory(amount=4, category=DebtLoan.LOAN, user=self.user)
+        DebtLoanFactory(amount=5, category=DebtLoan.LOAN, user=self.user)
+
+        qs = DebtLoan.objects.filter(user=self.user)
+        with self.assertNumQueries(1):
+            totals = services.get_debt_loan_totals(qs)
+
+        self.assertEqual(totals['debt_sum'], 3)
+        self.assertEqual(totals['debt_count'], 1)
+        self.assertEqual(totals['loan_sum'], 9)
+        self.assertEqual(totals['loan_count'], 2)
+
+    def test_counterparty_totals(self):
+        DebtLoanFactory(amount=3, category=DebtLoan.DEBT, user=self.user,
+                        with_who='John')
+        DebtLoanFactory(amount=5, category=DebtLoan.LOAN, user=self.user,
+                        with_who='  john ')
+        DebtLoanFactory(amount=4, category=DebtLoan.DEBT, user=self.user,
+                        with_who='Bank')
+        DebtLoanFactory(amount=7, category=DebtLoan.LOAN, with_who='Bank')
+
+        qs = DebtLoan.objects.filter(user=self.user)
+        with self.assertNumQueries(1):
+            totals = services.get_counterparty_totals(qs)
+
+        self.assertEqual([t['counterparty'] for t in totals],
+                         ['bank', 'john'])
+        bank, john = totals
+        self.assertEqual(bank['debt'], 4)
+        self.assertEqual(bank['loan'], 0)
+        self.assertEqual(bank['balance'], -4)
+        self.assertEqual(john['count'], 2)
+        self.assertEqual(john['balance'], 2)
+        self.assertIn(john['name'], ('John', '  john '))
+
+    def test_debt_loan_list_sums(self):
+        DebtLoanFactory(amount=3, category=DebtLoan.DEBT, user=self.user)
+        DebtLoanFactory(amount=4, category=DebtLoan.LOAN, user=self.user)
+
+        c = Client()
+        logged_in = c.login(username=self.user.username, password='secret')
+        self.assertTrue(logged_in)
+
+        response = c.get(reverse('debt_loan_list'))
+        self.assertEqual(response.context['debt_sum'], 3)
+        self.assertEqual(response.context['loan_sum'], 4)
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+
+        # two rows share ``created``, so ``id`` has to break the tie
+        self.april = TransactionFactory(
+            created=datetime(2015, 4, 23, tzinfo=pytz.utc), user=self.user)
+        self.march_late = TransactionFactory(
+            created=datetime(2015, 3, 23, tzinfo=pytz.utc), user=self.user)
+        self.march_early = TransactionFactory(
+            created=datetime(2015, 3, 23, tzinfo=pytz.utc), user=self.user)
+        self.february = TransactionFactory(
+            created=datetime(2015, 2, 23, tzinfo=pytz.utc), user=self.user)
+
+    def test_get_page(self):
+        qs = Transaction.objects.filter(user=self.user)
+
+        rows, cursor = services.get_page(qs, page_size=2)
+        self.assertSequenceEqual(rows, [self.april, self.march_early])
+        self.assertIsNotNone(cursor)
+
+        rows, cursor = services.get_page(qs, cursor, page_size=2)
+        self.assertSequenceEqual(rows, [self.march_late, self.february])
+        self.assertIsNone(cursor)
+
+    def test_get_page_invalid_cursor(self):
+        qs = Transaction.objects.filter(user=self.user)
+        rows, cursor = services.get_page(qs, 'garbage', page_size=10)
+        self.assertEqual(len(rows), 4)
+        self.assertIsNone(cursor)
+
+    def test_overflowing_cursors(self):
+        self.assertIsNone(services.decode_cursor('300000000000000000_1'))
+        self.assertIsNone(
+            services.decode_cursor('1_99999999999999999999999'))
+
+        c = Client()
+        c.login(username=self.user.username, password='secret')
+        for cursor in ('300000000000000000_1', '1_99999999999999999999999'):
+            response = c.get(reverse('transaction_list'),
+                             {'filter': 'all_time', 'cursor': cursor})
+            self.assertEqual(len(response.context['transactions']), 4)
+            response = c.get(reverse('debt_loan_list'), {'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            response = c.get(reverse('api_transactions'), {'cursor': cursor})
+            self.assertEqual(len(response.json()['results']), 4)
+            response = c.get(reverse('api_transaction_changes'),
+                             {'since': cursor})
+            self.assertEqual(response.status_code, 400)
+
+    def test_transaction_list_load_more(self):
+        c = Client()
+        logged_in = c.login(username=self.user.username, password='secret')
+        self.assertTrue(logged_in)
+        with mock.patch('books.services.PAGE_SIZE', 2):
+            response = c.get(reverse('transaction_list'),
+                             {'filter': 'all_time'})
+            self.assertSequenceEqual(response.context['transactions'],
+                                     [self.april, self.march_early])
+            self.assertEqual(
+                [t.starts_month for t in response.context['transactions']],
+                [True, True]
+            )
+            cursor = response.context['next_cursor']
+            self.assertContains(
+                response, '?cursor={}&amp;filter=all_time'.format(cursor))
+
+            response = c.get(reverse('transaction_list'),
+                             {'cursor': cursor, 'filter': 'all_time'},
+                             HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        self.assertTemplateUsed(response, 'list_page.html')
+        self.assertSequenceEqual(response.context['transactions'],
+                                 [self.march_late, self.february])
+        # march header was already rendered on the previous page
+        self.assertEqual(
+            [t.starts_month for t in response.context['transactions']],
+            [False, True]
+        )
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertNotContains(response, 'load-more"')
+
+    def test_debt_loan_list_load_more(self):
+        debt_loans = [DebtLoanFactory(user=self.user) for _ in range(3)]
+
+        c = Client()
+        logged_in = c.login(username=self.user.username, password='secret')
+        self.assertTrue(logged_in)
+
+        with mock.patch('books.services.PAGE_SIZE', 2):
+            response = c.get(reverse('debt_loan_list'))
+            self.assertEqual(len(response.context['debt_loans']), 2)
+
+            response = c.get(reverse('debt_loan_list'),
+                             {'cursor': response.context['next_cursor']},
+                             HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        self.assertSequenceEqual(response.context['debt_loans'],
+                                 [debt_loans[0]])
+
+
+class MonthlySummaryTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.april = datetime(2015, 4, 23, tzinfo=pytz.utc)
+
+    def get_summary(self, month=4, category=Transaction.EXPENSE):
+        return MonthlySummary.objects.get(user=self.user, year=2015,
+                                          month=month, category=category)
+
+    def test_create_updates_summary(self):
+        TransactionFactory(amount=10, created=self.april, user=self.user)
+        TransactionFactory(amount=5, created=self.april, user=self.user)
+
+        summary = self.get_summary()
+        self.assertEqual(summary.sum, 15)
+        self.assertEqual(summary.count, 2)
+
+    def test_update_moves_amount(self):
+        t = TransactionFactory(amount=10, created=self.april, user=self.user)
+
+        t.amount = 7
+        t.category = Transaction.INCOME
+        t.save()
+
+        self.assertEqual(self.get_summary().sum, 0)
+        self.assertEqual(self.get_summary().count, 0)
+        income = self.get_summary(category=Transaction.INCOME)
+        self.assertEqual(income.sum, 7)
+        self.assertEqual(income.count, 1)
+
+    def test_deactivate_updates_summary(self):
+        t = TransactionFactory(amount=10, created=self.april, user=self.user)
+        TransactionFactory(amount=5, created=self.april, user=self.user)
+
+        t.deactivate()
+        summary = self.get_summary()
+        self.assertEqual(summary.sum, 5)
+        self.assertEqual(summary.count, 1)
+
+        # second deactivation changes nothing
+        t.deactivate()
+        self.assertEqual(self.get_summary().sum, 5)
+
+    def test_summary_totals(self):
+        TransactionFactory(amount=10, created=self.april, user=self.user)
+        TransactionFactory(amount=3, created=datetime(2015, 3, 1,
+                                                      tzinfo=pytz.utc),
+                           user=self.user, category=Transaction.INCOME)
+        TransactionFactory(amount=1, created=datetime(2014, 12, 31,
+                                                      tzinfo=pytz.utc),
+                           user=self.user)
+
+        totals = services.get_summary_totals(self.user, self.april)
+        self.assertEqual(totals['expense_sum'], 10)
+        self.assertIsNone(totals['income_sum'])
+        self.assertEqual(totals['income_count'], 0)
+
+        totals = services.get_summary_totals(
+            self.user, datetime(2015, 1, 1, tzinfo=pytz.utc))
+        self.assertEqual(totals['expense_sum'], 10)
+        self.assertEqual(totals['income_sum'], 3)
+
+        totals = services.get_summary_totals(self.user)
+        self.assertEqual(totals['expense_sum'], 11)
+        self.assertEqual(totals['expense_count'], 2)
+
+        # until April, which is excluded
+        totals = services.get_summary_totals(
+            self.user, *services.get_date_range(date(2015, 1, 1),
+                                                date(2015, 3, 31)))
+        self.assertIsNone(totals['expense_sum'])
+        self.assertEqual(totals['income_sum'], 3)
+
+    def test_transaction_list_sums(self):
+        TransactionFactory(amount=10, created=self.april, user=self.user)
+        TransactionFactory(amount=4, created=self.april, user=self.user,
+                           category=Transaction.INCOME)
+        TransactionFactory(amount=1, created=datetime(2015, 3, 1,
+                                                      tzinfo=pytz.utc),
+                           user=self.user)
+
+        c = Client()
+        logged_in = c.login(username=self.user.username, password='secret')
+        self.assertTrue(logged_in)
+
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = self.april
+            response = c.get(reverse('transaction_list'))
+
+        self.assertEqual(response.context['negative_transaction_sum'], 10)
+        self.assertEqual(response.context['positive_transaction_sum'], 4)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'books-tests',
+}})
+class CacheTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        cache.cache.clear()
+
+    def test_get_or_set(self):
+        compute = mock.Mock(return_value=42)
+        stats = cache.get_stats()
+
+        self.assertEqual(cache.get_or_set(self.user.id, 'x', compute, 1), 42)
+        self.assertEqual(cache.get_or_set(self.user.id, 'x', compute, 1), 42)
+        self.assertEqual(compute.call_count, 1)
+
+        # other parts are cached separately
+        cache.get_or_set(self.user.id, 'x', compute, 2)
+        self.assertEqual(compute.call_count, 2)
+
+        cache.bump_version(self.user.id)
+        cache.get_or_set(self.user.id, 'x', compute, 1)
+        self.assertEqual(compute.call_count, 3)
+
+        new_stats = cache.get_stats()
+        self.assertEqual(new_stats['hits'] - stats['hits'], 1)
+        self.assertEqual(new_stats['misses'] - stats['misses'], 3)
+
+    def test_file_based_backend(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        backend = 'django.core.cache.backends.filebased.FileBasedCache'
+
+        with self.settings(CACHES={'default': {'BACKEND': backend,
+                                               'LOCATION': location}}):
+            compute = mock.Mock(return_value={'sum': 1})
+            cache.get_or_set(self.user.id, 'x', compute)
+            cache.get_or_set(self.user.id, 'x', compute)
+            self.assertEqual(compute.call_count, 1)
+
+            cache.bump_version(self.user.id)
+            cache.get_or_set(self.user.id, 'x', compute)
+            self.assertEqual(compute.call_count, 2)
+
+    def test_transaction_list_cached_until_write(self):
+        c = Client()
+        logged_in = c.login(username=self.user.username, password='secret')
+        self.assertTrue(logged_in)
+
+        c.post(reverse('transaction_create'),
+               {'title': 'first', 'amount': 1,
+                'category': Transaction.EXPENSE})
+        response = c.get(reverse('transaction_list'))
+        self.assertContains(response, 'first')
+
+        with mock.patch('books.services.get_page') as get_page:
+            response = c.get(reverse('transaction_list'))
+            self.assertFalse(get_page.called)
+        self.assertContains(response, 'first')
+
+        c.post(reverse('transaction_create'),
+               {'title': 'second', 'amount': 2,
+                'category': Transaction.EXPENSE})
+        response = c.get(reverse('transaction_list'))
+        self.assertContains(response, 'second')
+        self.assertEqual(response.context['negative_transaction_sum'], 3)
+
+    def test_debt_loan_list_cached_until_delete(self):
+        debt_loan = DebtLoanFactory(user=self.user, with_who='Foo')
+
+        c = Client()
+        logged_in = c.login(username=self.user.username, password='secret')
+        self.assertTrue(logged_in)
+
+        self.assertContains(c.get(reverse('debt_loan_list')), 'Foo')
+        c.get(reverse('debt_loan_delete', args=[debt_loan.id]))
+        self.assertNotContains(c.get(reverse('debt_loan_list')), 'Foo')
+
+    def test_counterparties_cached_until_create(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('debt_loan_counterparties'))
+        self.assertEqual(response.context['counterparties'], [])
+
+        self.client.post(reverse('debt_loan_create'),
+                         {'with_who': 'Foo', 'amount': 1,
+                          'category': DebtLoan.DEBT})
+        response = self.client.get(reverse('debt_loan_counterparties'))
+        self.assertContains(response, 'Foo')
+
+
+class DeactivateTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+
+    def test_transaction_delete_other_users(self):
+        t = TransactionFactory()
+        self.client.get(reverse('transaction_delete', args=[t.id]))
+        t.refresh_from_db()
+        self.assertTrue(t.active)
+
+    def test_debt_loan_delete_other_users(self):
+        d = DebtLoanFactory()
+        self.client.get(reverse('debt_loan_delete', args=[d.id]))
+        d.refresh_from_db()
+        self.assertTrue(d.active)
+
+    def test_save_sets_modified(self):
+        t = TransactionFactory(modified=datetime(2017, 1, 1, tzinfo=pytz.utc))
+        d = DebtLoanFactory(modified=datetime(2017, 1, 1, tzinfo=pytz.utc))
+        self.assertGreater(t.modified, datetime(2017, 1, 1, tzinfo=pytz.utc))
+        self.assertGreater(d.modified, datetime(2017, 1, 1, tzinfo=pytz.utc))
+
+    def test_deactivate_sets_modified(self):
+        t = TransactionFactory(user=self.user)
+        d = DebtLoanFactory(user=self.user)
+
+        self.assertEqual(Transaction.objects.filter(pk=t.pk).deactivate(), 1)
+        self.assertEqual(DebtLoan.objects.filter(pk=d.pk).deactivate(), 1)
+        # already inactive rows are not touched
+        self.assertEqual(Transaction.objects.filter(pk=t.pk).deactivate(), 0)
+
+        self.assertGreater(Transaction.objects.get(pk=t.pk).modified,
+                           t.modified)
+        self.assertGreater(DebtLoan.objects.get(pk=d.pk).modified,
+                           d.modified)
+
+    def test_save_after_deactivate(self):
+        t = TransactionFactory(amount=10, user=self.user)
+        t.deactivate()
+        t.title = 'renamed'
+        t.save()
+
+        summary = MonthlySummary.objects.get(user=self.user)
+        self.assertEqual(summary.sum, 0)
+        self.assertEqual(summary.count, 0)
+
+
+class BulkTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+        self.april = datetime(2015, 4, 23, tzinfo=pytz.utc)
+
+    def get_summary(self, category=Transaction.EXPENSE):
+        return MonthlySummary.objects.get(user=self.user, year=2015, month=4,
+                                          category=category)
+
+    def test_transaction_bulk_deactivate_and_restore(self):
+        transactions = TransactionFactory.create_batch(
+            3, amount=10, created=self.april, user=self.user)
+        ids = [t.id for t in transactions[:2]]
+
+        # lock, update and summary update in a savepoint
+        with self.assertNumQueries(5):
+            count = Transaction.objects.filter(pk__in=ids).deactivate()
+        self.assertEqual(count, 2)
+        self.assertEqual(self.get_summary().sum, 10)
+        self.assertEqual(self.get_summary().count, 1)
+
+        self.assertEqual(Transaction.objects.filter(pk__in=ids).restore(), 2)
+        self.assertEqual(self.get_summary().sum, 30)
+        self.assertEqual(self.get_summary().count, 3)
+        self.assertEqual(Transaction.objects.filter(active=True).count(), 3)
+
+    def test_transaction_bulk_set_category(self):
+        TransactionFactory.create_batch(2, amount=10, created=self.april,
+                                        user=self.user)
+        inactive = TransactionFactory(amount=5, created=self.april,
+                                      user=self.user)
+        inactive.deactivate()
+
+        count = Transaction.objects.all().set_category(Transaction.INCOME)
+        self.assertEqual(count, 3)
+        self.assertEqual(self.get_summary().sum, 0)
+        income = self.get_summary(Transaction.INCOME)
+        self.assertEqual(income.sum, 20)
+        self.assertEqual(income.count, 2)
+
+    def test_transaction_bulk_view(self):
+        mine = TransactionFactory.create_batch(5, user=self.user)
+        other = TransactionFactory()
+
+        response = self.client.post(
+            reverse('transaction_bulk'),
+            {'action': 'deactivate',
+             'ids': [t.id for t in mine] + [other.id]})
+        self.assertRedirects(response, reverse('transaction_list'))
+
+        self.assertFalse(Transaction.objects.filter(user=self.user,
+                                                    active=True).exists())
+        other.refresh_from_db()
+        self.assertTrue(other.active)
+
+    def test_transaction_bulk_view_queries_do_not_grow(self):
+        ids = [t.id for t in TransactionFactory.create_batch(
+            50, created=self.april, user=self.user)]
+
+        # session, user, lock, update and both summaries, one of them new,
+        # in savepoints
+        with self.assertNumQueries(11):
+            self.client.post(reverse('transaction_bulk'),
+                             {'action': 'set_category', 'ids': ids,
+                              'category': Transaction.INCOME})
+        self.assertEqual(self.get_summary(Transaction.INCOME).count, 50)
+
+    def test_transaction_bulk_view_invalid(self):
+        response = self.client.post(reverse('transaction_bulk'),
+                                    {'action': 'set_category', 'ids': [1]})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(reverse('transaction_bulk'),
+                                    {'action': 'deactivate', 'ids': ['x']})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(reverse('transaction_bulk'))
+        self.assertEqual(response.status_code, 405)
+
+    def test_debt_loan_bulk_view(self):
+        debt_loans = DebtLoanFactory.create_batch(3, user=self.user,
+                                                  category=DebtLoan.DEBT)
+        ids = [d.id for d in debt_loans]
+
+        response = self.client.post(reverse('debt_loan_bulk'),
+                                    {'action': 'set_category', 'ids': ids,
+                                     'category': DebtLoan.LOAN})
+        self.assertRedirects(response, reverse('debt_loan_list'))
+        self.assertEqual(
+            DebtLoan.objects.filter(category=DebtLoan.LOAN).count(), 3)
+
+        self.client.post(reverse('debt_loan_bulk'),
+                         {'action': 'deactivate', 'ids': ids})
+        self.assertFalse(DebtLoan.objects.filter(active=True).exists())
+
+        self.client.post(reverse('debt_loan_bulk'),
+                         {'action': 'restore', 'ids': ids[:1]})
+        self.assertEqual(DebtLoan.objects.filter(active=True).count(), 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+
+        self.april = TransactionFactory(
+            title='april', amount=10,
+            created=datetime(2015, 4, 23, 12, tzinfo=pytz.utc),
+            user=self.user)
+        self.march = TransactionFactory(
+            title='march, "quoted"', amount='2.50',
+            category=Transaction.INCOME,
+            created=datetime(2015, 3, 23, 12, tzinfo=pytz.utc),
+            user=self.user)
+        TransactionFactory(title='not mine')
+        TransactionFactory(user=self.user).deactivate()
+
+    def get_content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_export_csv(self):
+        response = self.client.get(reverse('export'))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('transactions.csv', response['Content-Disposition'])
+
+        lines = self.get_content(response).splitlines()
+        self.assertEqual(lines, [
+            'id,created,title,category,amount',
+            '{},2015-03-23T12:00:00+00:00,"march, ""quoted""",inc,2.50'
+            .format(self.march.id),
+            '{},2015-04-23T12:00:00+00:00,april,exp,10.00'
+            .format(self.april.id),
+        ])
+
+    def test_export_ndjson_date_range(self):
+        response = self.client.get(reverse('export'),
+                                   {'format': 'ndjson',
+                                    'start': '2015-04-01',
+                                    'end': '2015-04-23'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        rows = [json.loads(line)
+                for line in self.get_content(response).splitlines()]
+        self.assertEqual(rows, [{
+            'id': self.april.id,
+            'created': '2015-04-23T12:00:00+00:00',
+            'title': 'april',
+            'category': 'exp',
+            'amount': '10.00',
+        }])
+
+    def test_export_period(self):
+        with mock.patch('books.services.timezone.now') as mock_now:
+            mock_now.return_value = datetime(2015, 4, 23, tzinfo=pytz.utc)
+            response = self.client.get(reverse('export'),
+                                       {'period': 'this_month'})
+        self.assertEqual(len(self.get_content(response).splitlines()), 2)
+
+    def test_export_debt_loans(self):
+        DebtLoanFactory(user=self.user, with_who='Foo', amount=3)
+
+        response = self.client.get(reverse('export'),
+                                   {'kind': 'debt_loans'})
+        lines = self.get_content(response).splitlines()
+        self.assertEqual(lines[0], 'id,created,with_who,title,category,amount')
+        self.assertEqual(len(lines), 2)
+
+    def test_export_invalid(self):
+        response = self.client.get(reverse('export'),
+                                   {'start': '2015-04-02',
+                                    'end': '2015-04-01'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ImportTests(TestCase):
+    CSV = (
+        'title,amount,category,created\n'
+        'rent,500,exp,2015-04-01\n'
+        'salary,1000.50,,2015-04-02T10:00:00+00:00\n'
+        'lunch,-7.20,,2015-04-03 12:30\n'
+        ',1,exp,\n'
+        'broken,lots,exp,someday\n'
+    )
+
+    def setUp(self):
+        self.user = UserFactory()
+
+    def test_import_transactions(self):
+        result = importer.import_transactions(
+            self.user, self.CSV.splitlines(True), batch_size=2)
+
+        self.assertEqual(result.created, 3)
+        self.assertEqual([line for line, _ in result.errors], [5, 6])
+        self.assertIn('title', result.errors[0][1])
+        self.assertEqual(sorted(result.errors[1][1]), ['amount', 'created'])
+
+        self.assertEqual(
+            list(Transaction.objects.order_by('created')
+                 .values_list('title', 'amount', 'category')),
+            [('rent', 500, Transaction.EXPENSE),
+             ('salary', Decimal('1000.50'), Transaction.INCOME),
+             ('lunch', Decimal('7.20'), Transaction.EXPENSE)]
+        )
+        totals = services.get_summary_totals(self.user)
+        self.assertEqual(totals['expense_sum'], Decimal('507.20'))
+        self.assertEqual(totals['income_count'], 1)
+
+    def test_import_view(self):
+        self.client.force_login(self.user)
+        self.assertEqual(
+            self.client.get(reverse('transaction_import')).status_code, 200)
+
+        upload = SimpleUploadedFile('statement.csv',
+                                    self.CSV.encode('utf-8-sig'))
+        response = self.client.post(reverse('transaction_import'),
+                                    {'file': upload})
+
+        self.assertEqual(response.context['result'].created, 3)
+        self.assertContains(response, 'line 6')
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(),
+                         3)
+
+    @override_settings(TIME_ZONE='Europe/Vilnius')
+    def test_import_daylight_saving_switch(self):
+        lines = ('title,amount,category,created\n'
+                 'repeated,1,exp,2017-10-29 03:30\n'
+                 'skipped,1,exp,2017-03-26 03:30\n'
+                 'valid,1,exp,2017-03-26 04:30\n').splitlines(True)
+        result = importer.import_transactions(self.user, lines)
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual([(line, list(errors)) for line, errors
+                          in result.errors],
+                         [(2, ['created']), (3, ['created'])])
+
+    def test_import_multiline_title(self):
+        lines = ('title,amount,category,created\n'
+                 '"rent\nfor april",500,exp,2015-04-01\n'
+                 'broken,lots,exp,2015-04-02\n').splitlines(True)
+        result = importer.import_transactions(self.user, lines)
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual(Transaction.objects.get().title, 'rent\nfor april')
+        self.assertEqual([(line, list(errors)) for line, errors
+                          in result.errors],
+                         [(4, ['amount'])])
+
+    def test_import_view_not_csv(self):
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile('statement.csv', b'\xff\xfe\x00')
+        response = self.client.post(reverse('transaction_import'),
+                                    {'file': upload})
+        self.assertTrue(response.context['form'].errors)
+        self.assertFalse(Transaction.objects.exists())
+
+
+class RecurringTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+
+    def test_next_date_keeps_day_of_month(self):
+        rule = RecurringTransactionFactory(start=date(2015, 1, 31))
+        self.assertEqual(rule.next_date, date(2015, 1, 31))
+        self.assertEqual(rule.get_next_date(date(2015, 1, 31)),
+                         date(2015, 2, 28))
+        self.assertEqual(rule.get_next_date(date(2015, 2, 28)),
+                         date(2015, 3, 31))
+
+        rule.frequency = RecurringTransaction.YEARLY
+        rule.start = date(2016, 2, 29)
+        self.assertEqual(rule.get_next_date(date(2016, 2, 29)),
+                         date(2017, 2, 28))
+        rule.frequency = RecurringTransaction.WEEKLY
+        rule.interval = 2
+        self.assertEqual(rule.get_next_date(date(2015, 12, 25)),
+                         date(2016, 1, 8))
+
+    def test_interval_must_be_positive(self):
+        rule = RecurringTransactionFactory(start=date(2015, 1, 1), interval=0)
+        with self.assertRaises(ValidationError):
+            rule.full_clean()
+        # a rule, which does not move forward, gets a single occurrence
+        self.assertEqual(rule.get_due_dates(date(2015, 3, 1)),
+                         [date(2015, 1, 1)])
+        self.assertEqual(recurring.materialize(date(2015, 3, 1)).created, 1)
+
+    def test_materialize_catches_up(self):
+        rule = RecurringTransactionFactory(user=self.user, title='rent',
+                                           start=date(2015, 1, 15))
+        # adds to an existing summary
+        TransactionFactory(user=self.user, created=datetime(
+            2015, 1, 2, tzinfo=pytz.utc))
+        result = recurring.materialize(date(2015, 4, 20))
+
+        self.assertEqual((result.rules, result.created), (1, 4))
+        self.assertEqual(
+            list(Transaction.objects.filter(recurring=rule)
+                 .order_by('created').values_list('occurrence', flat=True)),
+            [date(2015, 1, 15), date(2015, 2, 15), date(2015, 3, 15),
+             date(2015, 4, 15)])
+        self.assertEqual(Transaction.objects.latest('created').title, 'rent')
+        rule.refresh_from_db()
+        self.assertEqual(rule.next_date, date(2015, 5, 15))
+        totals = services.get_summary_totals(self.user)
+        self.assertEqual(totals['expense_sum'], 410)
+        self.assertEqual(totals['expense_count'], 5)
+
+    def test_materialize_is_idempotent(self):
+        rule = RecurringTransactionFactory(user=self.user,
+                                           start=date(2015, 1, 1))
+        recurring.materialize(date(2015, 3, 1))
+        self.assertEqual(recurring.materialize(date(2015, 3, 1)).created, 0)
+
+        # even when the rule's progress is lost
+        RecurringTransaction.objects.update(next_date=rule.start)
+        result = recurring.materialize(date(2015, 4, 1))
+        self.assertEqual(result.created, 1)
+        self.assertEqual(Transaction.objects.count(), 4)
+        self.assertEqual(
+            MonthlySummary.objects.filter(user=self.user).count(), 4)
+
+    def test_materialize_skips_ended_and_inactive_rules(self):
+        RecurringTransactionFactory(user=self.user, start=date(2015, 1, 1),
+                                    end=date(2015, 2, 10))
+        RecurringTransactionFactory(user=self.user, start=date(2015, 1, 1),
+                                    active=False)
+        self.assertEqual(recurring.materialize(date(2015, 6, 1)).created, 2)
+        self.assertEqual(recurring.materialize(date(2015, 9, 1)).rules, 0)
+
+    def test_materialize_queries_do_not_grow_with_rules(self):
+        for user in UserFactory.create_batch(4):
+            RecurringTransactionFactory.create_batch(
+                5, user=user, start=date(2015, 1, 1))
+        # two batches, and an empty lookup ending the run, savepoints
+        # included
+        with self.assertNumQueries(23):
+            result = recurring.materialize(date(2015, 3, 1), batch_size=10)
+        self.assertEqual(result.created, 60)
+
+        for user in UserFactory.create_batch(4):
+            RecurringTransactionFactory.create_batch(
+                5, user=user, start=date(2015, 1, 1))
+        with self.assertNumQueries(23):
+            recurring.materialize(date(2015, 4, 1), batch_size=20)
+
+        output = StringIO()
+        call_command('rebuild_summaries', '--verify', stdout=output)
+        self.assertIn('up to date', output.getvalue())
+
+    def test_materialize_command(self):
+        RecurringTransactionFactory(user=self.user, start=date(2015, 1, 1))
+        output = StringIO()
+        call_command('materialize_recurring', '--date', '2015-02-01',
+                     stdout=output)
+        self.assertIn('2 transactions of 1 rules created',
+                      output.getvalue())
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+
+    def test_get_words(self):
+        self.assertEqual(search.get_words("Rent:* & 'Maxima'_2"),
+                         ['rent', 'maxima', '2'])
+        query = search.PrefixQuery(search.get_words('rent ma'))
+        self.assertEqual(query.source_expressions[0].value, 'rent:* & ma:*')
+
+    def test_search_matches_every_word(self):
+        TransactionFactory(user=self.user, title='Rent for March')
+        TransactionFactory(user=self.user, title='Supermarket')
+        TransactionFactory(user=self.user, title='rent deposit')
+        TransactionFactory(title='Rent for March')
+        qs = Transaction.objects.filter(user=self.user)
+
+        self.assertEqual([t.title for t in search.search(qs, 'rent MAR')],
+                         ['Rent for March'])
+        self.assertEqual([t.title for t in search.search(qs, 'market')],
+                         ['Supermarket'])
+        self.assertEqual(len(search.search(qs, 'rent')), 2)
+        self.assertFalse(search.search(qs, ' %* '))
+
+    def test_search_debt_loans(self):
+        DebtLoanFactory(user=self.user, with_who='John', title='bike')
+        DebtLoanFactory(user=self.user, with_who='Bank', title='john')
+        DebtLoanFactory(user=self.user, with_who='Bank', title='car')
+        qs = DebtLoan.objects.filter(user=self.user)
+        self.assertEqual(len(search.search(qs, 'john')), 2)
+        self.assertEqual([d.title for d in search.search(qs, 'bank car')],
+                         ['car'])
+
+    def test_search_view(self):
+        last_month = timezone.now() - timedelta(days=40)
+        for i in range(3):
+            TransactionFactory(user=self.user, title='taxi {}'.format(i))
+        TransactionFactory(user=self.user, title='taxi old',
+                           created=last_month)
+        url = reverse('search')
+
+        with mock.patch.object(search, 'PAGE_SIZE', 2):
+            response = self.client.get(url, {'q': 'taxi'})
+            self.assertEqual([t.title for t in response.context['rows']],
+                             ['taxi 2', 'taxi 1'])
+            self.assertTrue(response.context['has_next'])
+            response = self.client.get(url, {'q': 'taxi', 'page': 2})
+            self.assertEqual([t.title for t in response.context['rows']],
+                             ['taxi 0', 'taxi old'])
+            self.assertFalse(response.context['has_next'])
+
+        response = self.client.get(url, {'q': 'taxi',
+                                         'period': 'this_month'})
+        self.assertNotContains(response, 'taxi old')
+
+        response = self.client.get(url, {'q': 'taxi', 'kind': 'debt_loans'})
+        self.assertContains(response, 'Nothing found')
+
+    def test_search_view_invalid(self):
+        response = self.client.get(reverse('search'), {'page': 0})
+        self.assertEqual(response.status_code, 400)
+
+
+class TagTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+
+    def test_create_with_tags(self):
+        self.client.post(reverse('transaction_create'), {
+            'title': 'dinner', 'amount': 20, 'category': Transaction.EXPENSE,
+            'tags': 'Food, food ,, Travel  abroad',
+        })
+        transaction = Transaction.objects.get(user=self.user)
+        self.assertEqual([t.name for t in transaction.tags.all()],
+                         ['food', 'travel abroad'])
+        link = TransactionTag.objects.first()
+        self.assertEqual((link.user, link.created),
+                         (self.user, transaction.created))
+
+    def test_update_tags(self):
+        transaction = TransactionFactory(user=self.user)
+        transaction.set_tags(['food', 'travel'])
+        url = reverse('transaction_update', args=[transaction.id])
+        self.assertContains(self.client.get(url), 'food, travel')
+
+        self.client.post(url, {'title': 'x', 'amount': 1,
+                               'category': Transaction.EXPENSE,
+                               'tags': 'travel, work'})
+        self.assertEqual([t.name for t in transaction.tags.all()],
+                         ['travel', 'work'])
+        self.assertEqual(Tag.objects.filter(user=self.user).count(), 3)
+
+        # tags left out of an API update stay
+        self.client.post(reverse('api_transaction', args=[transaction.id]),
+                         json.dumps({'amount': 2}),
+                         content_type='application/json')
+        self.assertEqual(transaction.tags.count(), 2)
+
+    def test_tag_too_long(self):
+        form = forms.TransactionForm({'title': 'x', 'amount': 1,
+                                      'category': Transaction.EXPENSE,
+                                      'tags': 'a' * 51})
+        self.assertIn('tags', form.errors)
+
+    def test_list_shows_tags(self):
+        for name in ('food', 'rent', 'fuel'):
+            TransactionFactory(user=self.user).set_tags([name, 'monthly'])
+        # the view's query budget fails the test on a query per row
+        response = self.client.get(reverse('transaction_list'))
+        for name in ('food', 'rent', 'fuel', 'monthly'):
+            self.assertContains(response, name)
+
+    def test_breakdown(self):
+        last_year = timezone.now() - timedelta(days=400)
+        TransactionFactory(user=self.user, amount=10).set_tags(['food'])
+        TransactionFactory(user=self.user, amount=5).set_tags(
+            ['food', 'work'])
+        TransactionFactory(user=self.user, amount=100,
+                           category=Transaction.INCOME).set_tags(['work'])
+        TransactionFactory(user=self.user, amount=7,
+                           created=last_year).set_tags(['food'])
+        deleted = TransactionFactory(user=self.user, amount=1)
+        deleted.set_tags(['food'])
+        deleted.deactivate()
+        TransactionFactory(amount=3).set_tags(['food'])
+
+        breakdown = services.get_tag_breakdown(
+            self.user, services.get_period_range('this_month'))
+        self.assertEqual(
+            [(row['name'], row['expense_sum'], row['income_sum'],
+              row['count']) for row in breakdown],
+            [('food', 15, 0, 2), ('work', 5, 100, 2)])
+
+        response = self.client.get(reverse('transaction_tag_breakdown'))
+        tags = json.loads(response.content.decode())['tags']
+        self.assertEqual([(t['name'], t['count']) for t in tags],
+                         [('food', 3), ('work', 2)])
+
+        response = self.client.get(reverse('transaction_tag_breakdown'),
+                                   {'period': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+class RunningBalanceTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        amounts = [(Transaction.INCOME, 100, datetime(2016, 1, 5)),
+                   (Transaction.EXPENSE, 30, datetime(2016, 1, 20)),
+                   (Transaction.EXPENSE, 20, datetime(2016, 2, 1)),
+                   (Transaction.INCOME, 5, datetime(2016, 2, 1)),
+                   (Transaction.EXPENSE, 1, datetime(2016, 3, 3))]
+        self.transactions = [
+            TransactionFactory(user=self.user, category=category,
+                               amount=amount,
+                               created=pytz.utc.localize(created))
+            for category, amount, created in amounts
+        ]
+        # deactivated ones are not counted
+        TransactionFactory(user=self.user, amount=1000, active=False,
+                           created=pytz.utc.localize(datetime(2016, 1, 6)))
+        TransactionFactory(amount=1000)
+
+    def test_get_balance(self):
+        balances = [services.get_balance(self.user, t.created, t.pk)
+                    for t in self.transactions]
+        self.assertEqual(balances, [100, 70, 50, 55, 54])
+
+    def test_running_balances_of_a_page(self):
+        qs = Transaction.objects.filter(user=self.user, active=True)
+        first_page, cursor = services.get_page(qs, page_size=2)
+        second_page, _ = services.get_page(qs, cursor, page_size=2)
+
+        # a page does not need earlier pages, balance is read in 2 queries
+        with self.assertNumQueries(2):
+            services.set_running_balances(self.user, second_page)
+        self.assertEqual([t.balance for t in second_page], [50, 70])
+
+        services.set_running_balances(self.user, first_page)
+        self.assertEqual([t.balance for t in first_page], [54, 55])
+
+    def test_list_shows_balance(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('transaction_list'),
+                                   {'filter': 'all_time'})
+        self.assertEqual(response.context['transactions'][0].balance, 54)
+        self.assertContains(response, '€ 54.00')
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        # 2016-02-01 00:30 in Vilnius
+        TransactionFactory(user=self.user, amount=10,
+                           category=Transaction.EXPENSE,
+                           created=datetime(2016, 1, 31, 22, 30,
+                                            tzinfo=pytz.utc))
+        TransactionFactory(user=self.user, amount=100,
+                           category=Transaction.INCOME,
+                           created=datetime(2016, 1, 10, tzinfo=pytz.utc))
+        TransactionFactory(user=self.user, amount=5,
+                           category=Transaction.EXPENSE,
+                           created=datetime(2016, 1, 11, tzinfo=pytz.utc))
+
+    def get_buckets(self, granularity, start, end):
+        return [(b['start'], b['income'], b['expense'])
+                for b in analytics.get_buckets(self.user, granularity,
+                                               start, end)]
+
+    def test_months_in_local_timezone(self):
+        self.assertEqual(
+            self.get_buckets('month', date(2015, 12, 15), date(2016, 3, 1)),
+            [(date(2015, 12, 1), 0, 0),
+             (date(2016, 1, 1), 100, 5),
+             (date(2016, 2, 1), 0, 10),
+             (date(2016, 3, 1), 0, 0)])
+
+    def test_weeks_and_days(self):
+        self.assertEqual(
+            self.get_buckets('week', date(2016, 1, 6), date(2016, 1, 20)),
+            [(date(2016, 1, 4), 100, 0),
+             (date(2016, 1, 11), 0, 5),
+             (date(2016, 1, 18), 0, 0)])
+        self.assertEqual(
+            self.get_buckets('day', date(2016, 1, 31), date(2016, 2, 1)),
+            [(date(2016, 1, 31), 0, 0),
+             (date(2016, 2, 1), 0, 10)])
+
+    def test_years(self):
+        self.assertEqual(
+            self.get_buckets('year', date(2015, 1, 1), date(2016, 1, 1)),
+            [(date(2015, 1, 1), 0, 0),
+             (date(2016, 1, 1), 100, 15)])
+
+    def test_months_from_summaries(self):
+        self.assertTrue(analytics.summaries_match_timezone())
+        with self.assertNumQueries(1):
+            self.get_buckets('month', date(2016, 1, 1), date(2016, 2, 1))
+
+    def test_months_in_other_timezone(self):
+        with timezone.override(pytz.utc):
+            self.assertFalse(analytics.summaries_match_timezone())
+            buckets = self.get_buckets('month', date(2016, 1, 1),
+                                       date(2016, 2, 1))
+        # in UTC the first transaction is still in January
+        self.assertEqual(buckets, [(date(2016, 1, 1), 100, 15),
+                                   (date(2016, 2, 1), 0, 0)])
+
+    def test_count_buckets(self):
+        start, end = date(2015, 12, 31), date(2016, 1, 4)
+        for granularity in analytics.GRANULARITIES:
+            self.assertEqual(
+                analytics.count_buckets(start, end, granularity),
+                len(list(analytics.iter_bucket_starts(start, end,
+                                                      granularity))))
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'books-analytics-tests',
+    }})
+    def test_view(self):
+        self.client.force_login(self.user)
+        url = reverse('transaction_analytics', args=['month'])
+
+        response = self.client.get(url, {'end': '2016-02-29'})
+        data = response.json()
+        self.assertEqual(data['timezone'], 'Europe/Vilnius')
+        # starts with the month of the first transaction
+        self.assertEqual(data['buckets'], [
+            {'start': '2016-01-01', 'income': '100.00', 'expense': '5.00'},
+            {'start': '2016-02-01', 'income': '0.00', 'expense': '10.00'},
+        ])
+
+        etag = response['ETag']
+        response = self.client.get(url, {'end': '2016-02-29'},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # any write makes a new version
+        cache.bump_version(self.user.id)
+        response = self.client.get(url, {'end': '2016-02-29'},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_view_too_many_buckets(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('transaction_analytics', args=['day']),
+            {'start': '2000-01-01', 'end': '2016-01-01'})
+        self.assertEqual(response.status_code, 400)
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Exact number of queries every view makes
+
+    A change in these numbers means either an optimization or a
+    regression, so update them only deliberately.
+    """
+    def setUp(self):
+        self.user = UserFactory()
+        self.transaction = TransactionFactory(user=self.user)
+        self.debt_loan = DebtLoanFactory(user=self.user)
+        self.client.force_login(self.user)
+
+    def assertQueryBudget(self, num, method, url, data=None, **extra):
+        with self.assertNumQueries(num):
+            response = getattr(self.client, method)(url, data, **extra)
+        self.assertLess(response.status_code, 400)
+        return response
+
+    def test_transaction_list(self):
+        # session, user, rows, their tags, balance of earlier months and of
+        # the first row's month, totals
+        self.assertQueryBudget(7, 'get', reverse('transaction_list'))
+
+    def test_transaction_list_load_more(self):
+        # session, user and rows, the page is empty, so balance is not read
+        self.assertQueryBudget(3, 'get', reverse('transaction_list'),
+                               {'cursor': services.encode_cursor(
+                                   self.transaction)},
+                               HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_transaction_create(self):
+        # session, user, insert and summary update in a savepoint
+        self.assertQueryBudget(6, 'post', reverse('transaction_create'),
+                               {'title': 'new', 'amount': 1,
+                                'category': Transaction.EXPENSE})
+
+    def test_transaction_update(self):
+        # session, user, fetch, update, summaries moved to a new row, all
+        # in savepoints
+        self.assertQueryBudget(11, 'post',
+                               reverse('transaction_update',
+                                       args=[self.transaction.id]),
+                               {'title': 'new', 'amount': 1,
+                                'category': Transaction.INCOME})
+
+    def test_transaction_delete(self):
+        # session, user, lock, update and summary update in a savepoint
+        self.assertQueryBudget(7, 'get',
+                               reverse('transaction_delete',
+                                       args=[self.transaction.id]))
+
+    def test_transaction_tag_breakdown(self):
+        # session, user and sums
+        self.assertQueryBudget(3, 'get', reverse('transaction_tag_breakdown'),
+                               {'period': 'this_year'})
+
+    def test_debt_loan_list(self):
+        # session, user, rows and totals
+        self.assertQueryBudget(4, 'get', reverse('debt_loan_list'))
+
+    def test_debt_loan_counterparties(self):
+        # session, user and totals
+        self.assertQueryBudget(3, 'get', reverse('debt_loan_counterparties'))
+
+    def test_debt_loan_create(self):
+        # session, user and insert
+        self.assertQueryBudget(3, 'post', reverse('debt_loan_create'),
+                               {'with_who': 'Foo', 'amount': 1,
+                                'category': DebtLoan.DEBT})
+
+    def test_debt_loan_delete(self):
+        # session, user and update
+        self.assertQueryBudget(3, 'get',
+                               reverse('debt_loan_delete',
+                                       args=[self.debt_loan.id]))
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+        self.first = self.create_transaction('first', 1, date(2017, 1, 1))
+        self.second = self.create_transaction('second', 2, date(2017, 1, 2))
+
+    def create_transaction(self, title, amount, day):
+        moment = datetime.combine(day, datetime.min.time()) \
+            .replace(tzinfo=pytz.utc)
+        transaction = TransactionFactory(user=self.user, title=title,
+                                         amount=amount, created=moment)
+        # ``save`` sets ``modified`` to now
+        Transaction.objects.filter(pk=transaction.pk).update(modified=moment)
+        transaction.modified = moment
+        return transaction
+
+    def post_json(self, url, data):
+        return self.client.post(url, json.dumps(data),
+                                content_type='application/json')
+
+    def test_anonymous(self):
+        self.client.logout()
+        response = self.client.get(reverse('api_transactions'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_list_pages_and_fields(self):
+        with mock.patch('books.services.PAGE_SIZE', 1):
+            response = self.client.get(reverse('api_transactions'),
+                                       {'fields': 'id,amount'})
+            data = response.json()
+            self.assertEqual(data['results'],
+                             [{'id': self.second.id, 'amount': '2.00'}])
+
+            response = self.client.get(reverse('api_transactions'),
+                                       {'fields': 'title',
+                                        'cursor': data['next']})
+        data = response.json()
+        self.assertEqual(data['results'], [{'title': 'first'}])
+        self.assertIsNone(data['next'])
+
+    def test_unknown_field(self):
+        response = self.client.get(reverse('api_transactions'),
+                                   {'fields': 'id,user'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_writes_in_the_same_second_are_not_missed(self):
+        now = timezone.now().replace(microsecond=0)
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            self.client.post(reverse('api_transaction', args=[self.first.id]),
+                             json.dumps({'amount': 2}),
+                             content_type='application/json')
+        seen = http_date(now.timestamp())
+        with mock.patch('django.utils.timezone.now',
+                        return_value=now + timedelta(milliseconds=500)):
+            self.client.post(reverse('api_transaction', args=[self.first.id]),
+                             json.dumps({'amount': 3}),
+                             content_type='application/json')
+
+        response = self.client.get(reverse('api_transactions'),
+                                   HTTP_IF_MODIFIED_SINCE=seen)
+        self.assertEqual(response.status_code, 200)
+        amounts = {row['id']: row['amount']
+                   for row in response.json()['results']}
+        self.assertEqual(amounts[self.first.id], '3.00')
+
+    def test_not_modified(self):
+        response = self.client.get(reverse('api_transactions'))
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)
+
+        # session, user and the aggregate, rows are not read
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('api_transactions'),
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.client.delete(reverse('api_transaction', args=[self.first.id]))
+        response = self.client.get(reverse('api_transactions'),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def test_create(self):
+        response = self.post_json(reverse('api_transactions'),
+                                  {'title': 'new', 'amount': '3.50',
+                                   'category': Transaction.INCOME})
+        self.assertEqual(response.status_code, 201)
+        transaction = Transaction.objects.get(pk=response.json()['id'])
+        self.assertEqual(transaction.user, self.user)
+        self.assertEqual(transaction.amount, Decimal('3.50'))
+        self.assertEqual(services.get_summary_totals(self.user)['income_sum'],
+                         Decimal('3.50'))
+
+    def test_create_invalid(self):
+        response = self.post_json(reverse('api_transactions'),
+                                  {'title': 'new', 'amount': 'a lot'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']),
+                         {'amount', 'category'})
+
+        response = self.client.post(reverse('api_transactions'), '[1]',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_partial_update(self):
+        response = self.post_json(
+            reverse('api_transaction', args=[self.first.id]), {'amount': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'first')
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.amount, 5)
+        self.assertGreater(self.first.modified,
+                           datetime(2017, 1, 1, tzinfo=pytz.utc))
+
+    def test_deactivate(self):
+        url = reverse('api_transaction', args=[self.first.id])
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.first.refresh_from_db()
+        self.assertFalse(self.first.active)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+
+    def test_other_users_rows(self):
+        other = TransactionFactory()
+        url = reverse('api_transaction', args=[other.id])
+        self.assertEqual(self.client.delete(url).status_code, 404)
+        self.assertEqual(self.post_json(url, {'amount': 1}).status_code, 404)
+
+    def test_debt_loans(self):
+        response = self.client.post(reverse('api_debt_loans'),
+                                    {'with_who': ' Bank ', 'amount': 1,
+                                     'category': DebtLoan.LOAN})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(reverse('api_debt_loans'),
+                                   {'fields': 'with_who,category'})
+        self.assertEqual(response.json()['results'],
+                         [{'with_who': 'Bank', 'category': DebtLoan.LOAN}])
+
+    def test_changes(self):
+        url = reverse('api_transaction_changes')
+        with mock.patch('books.services.SYNC_PAGE_SIZE', 1):
+            data = self.client.get(url).json()
+            self.assertEqual([row['id'] for row in data['changes']],
+                             [self.first.id])
+            self.assertTrue(data['more'])
+            data = self.client.get(url, {'since': data['next']}).json()
+        self.assertEqual([row['id'] for row in data['changes']],
+                         [self.second.id])
+        self.assertFalse(data['more'])
+
+        # rows are old enough, so the token points right after them
+        with self.assertNumQueries(3):
+            token = data['next']
+            data = self.client.get(url, {'since': token}).json()
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['next'], token)
+
+        self.client.delete(reverse('api_transaction', args=[self.first.id]))
+        self.post_json(reverse('api_transaction', args=[self.second.id]),
+                       {'title': 'renamed'})
+        data = self.client.get(url, {'since': token}).json()
+        changes = {row['id']: row for row in data['changes']}
+        self.assertFalse(changes[self.first.id]['active'])
+        self.assertEqual(changes[self.second.id]['title'], 'renamed')
+
+        # recent changes are returned again, a slower write may commit later
+        data = self.client.get(url, {'since': data['next']}).json()
+        self.assertEqual(len(data['changes']), 2)
+
+    def test_changes_invalid_token(self):
+        response = self.client.get(reverse('api_debt_loan_changes'),
+                                   {'since': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
 
 class DebtLoanTests(TestCase):
     def setUp(self):
@@ -248,6 +1655,19 @@ class DebtLoanTests(TestCase):
         self.assertEqual(2, DebtLoan.objects.count())
         self.assertEqual(str(DebtLoan.objects.latest('id')), 'ACME co.')
 
+    def test_counterparty_normalized(self):
+        d = DebtLoanFactory(with_who=' ACME\tCo. ')
+        self.assertEqual(d.counterparty, 'acme co.')
+
+        d.with_who = 'Bank'
+        d.save()
+        self.assertEqual(DebtLoan.objects.get(pk=d.pk).counterparty, 'bank')
+
+        DebtLoan.objects.bulk_create([DebtLoan(
+            with_who='JOHN', amount=1, category=DebtLoan.DEBT,
+            user=self.user)])
+        self.assertTrue(DebtLoan.objects.filter(counterparty='john').exists())
+
     def test_debt_loan_create_get(self):
         c = Client()
         logged_in = c.login(username=self.user.username, password='secret')
@@ -314,7 +1734,8 @@ class DebtLoanTests(TestCase):
 
         t = DebtLoanFactory(title='first',
                             amount=1,
-                            category=DebtLoan.LOAN)
+                            category=DebtLoan.LOAN,
+                            user=self.user)
         self.assertEqual(1, DebtLoan.objects.count())
         self.assertTrue(DebtLoan.objects.all()[0].active)
 
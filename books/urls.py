@@ -1,5 +1,6 @@
 from django.conf.urls import url
 
+from books import api
 from books import views
 
 
@@ -12,6 +13,12 @@ urlpatterns = [
         name='transaction_update'),
     url(r'^filter/$', views.transaction_list_filter,
         name='transaction_list_filter'),
+    url(r'^bulk/$', views.transaction_bulk, name='transaction_bulk'),
+    url(r'^import/$', views.transaction_import, name='transaction_import'),
+    url(r'^tags/$', views.transaction_tag_breakdown,
+        name='transaction_tag_breakdown'),
+    url(r'^analytics/(?P<granularity>day|week|month|year)/$',
+        views.transaction_analytics, name='transaction_analytics'),
 
     url(r'^debts-loans/$', views.debt_loan_list, name='debt_loan_list'),
     url(r'^debts-loans/create/$', views.debt_loan_create,
@@ -20,4 +27,21 @@ urlpatterns = [
         name='debt_loan_delete'),
     url(r'^debts-loans/update/(?P<pk>\d+)/$', views.debt_loan_update,
         name='debt_loan_update'),
+    url(r'^debts-loans/bulk/$', views.debt_loan_bulk, name='debt_loan_bulk'),
+    url(r'^debts-loans/counterparties/$', views.debt_loan_counterparties,
+        name='debt_loan_counterparties'),
+
+    url(r'^search/$', views.search_rows, name='search'),
+    url(r'^export/$', views.export_rows, name='export'),
+
+    url(r'^api/transactions/$', api.transactions, name='api_transactions'),
+    url(r'^api/transactions/(?P<pk>\d+)/$', api.transaction,
+        name='api_transaction'),
+    url(r'^api/transactions/changes/$', api.transaction_changes,
+        name='api_transaction_changes'),
+    url(r'^api/debts-loans/$', api.debt_loans, name='api_debt_loans'),
+    url(r'^api/debts-loans/(?P<pk>\d+)/$', api.debt_loan,
+        name='api_debt_loan'),
+    url(r'^api/debts-loans/changes/$', api.debt_loan_changes,
+        name='api_debt_loan_changes'),
 ]
@@ -1,60 +1,166 @@
+from urllib.parse import urlencode
+
+import csv
+import hashlib
+
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
+from django.http import HttpResponseBadRequest
+from django.http import JsonResponse
 from django.urls import reverse
-from django.db.models import Sum
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_POST
 
 from books.models import DebtLoan
 from books.models import Transaction
+from books import analytics
+from books import cache
+from books import export
 from books import forms
+from books import importer
+from books import search
 from books import services
+from finance import db
+
+
+def _mark_month_starts(transactions, previous_created=None):
+    """
+    Sets ``starts_month`` on transactions which need a month header
 
+    ``previous_created`` is the creation time of the row preceding the
+    first one, when the page continues a list rendered earlier.
+    """
+    previous = None
+    if previous_created is not None:
+        previous_created = timezone.localtime(previous_created)
+        previous = (previous_created.year, previous_created.month)
+    for transaction in transactions:
+        created = timezone.localtime(transaction.created)
+        current = (created.year, created.month)
+        transaction.starts_month = current != previous
+        previous = current
 
+
+@db.replica_reads
 @login_required
 def transaction_list(request):
     ctx = {}
 
-    user_id = request.user.id
-    user = User.objects.get(id=user_id)
-
-    fltr = request.session.get('filter:transaction_list', None)
-    if fltr == "last_month":
-        user_transactions = services.get_last_months_transactions(user)
-        ctx['fltr'] = fltr
-    elif fltr == "this_year":
-        user_transactions = services.get_this_years_transactions(user)
-        ctx['fltr'] = fltr
-    elif fltr == "all_time":
-        user_transactions = Transaction.objects.filter(user=user, active=True)
-        ctx['fltr'] = fltr
-    else:
+    # authentication middleware has already loaded the user
+    user = request.user
+
+    # the filter is in the query string, so choosing one writes nothing
+    fltr = request.GET.get('filter')
+    if fltr not in services.PERIODS:
         # make 'this_month' filter default
-        user_transactions = services.get_months_transactions(user)
-        ctx['fltr'] = 'this_month'
+        fltr = 'this_month'
+    ctx['fltr'] = fltr
+    period = services.get_period_range(fltr)
+    user_transactions = services.filter_period(
+        Transaction.objects.filter(user=user, active=True), period)
 
-    user_transactions = user_transactions.order_by('-created')
+    cursor = request.GET.get('cursor')
+    ajax = request.is_ajax()
 
-    ctx['user'] = user
-    ctx['transactions'] = user_transactions
-    ctx['negative_transaction_sum'] = user_transactions \
-        .filter(category=Transaction.EXPENSE) \
-        .aggregate(Sum('amount')).get('amount__sum')
-    ctx['positive_transaction_sum'] = user_transactions \
-        .filter(category=Transaction.INCOME) \
-        .aggregate(Sum('amount')).get('amount__sum')
+    def render_rows():
+        # tags of the whole page are read by a single query
+        transactions, next_cursor = services.get_page(
+            user_transactions.prefetch_related('tags'), cursor)
+        services.set_running_balances(user, transactions)
+        # rows loaded into an already rendered list continue its last month
+        position = services.decode_cursor(cursor) if ajax else None
+        _mark_month_starts(transactions, position[0] if position else None)
+        ctx['transactions'] = transactions
+        rows = render_to_string('transaction_list_rows.html',
+                                {'transactions': transactions})
+        return rows, next_cursor
 
+    ctx['rows'], ctx['next_cursor'] = cache.get_or_set(
+        user.id, 'transaction_rows', render_rows, period.start, period.end,
+        cursor, ajax)
+
+    if ajax:
+        return render(request, 'list_page.html', context=ctx)
+
+    totals = cache.get_or_set(
+        user.id, 'transaction_totals',
+        lambda: services.get_summary_totals(user, *period),
+        period.start, period.end)
+    ctx['negative_transaction_sum'] = totals['expense_sum']
+    ctx['positive_transaction_sum'] = totals['income_sum']
+
+    ctx['categories'] = Transaction.CATEGORY_CHOICES
     ctx['list'] = 'transactions'
 
     return render(request, 'transaction_list.html', context=ctx)
 
 
+@db.replica_reads
+@login_required
+def transaction_analytics(request, granularity):
+    form = forms.DateRangeForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    user = request.user
+    end = form.cleaned_data['end'] or timezone.localdate()
+    start = form.cleaned_data['start'] or \
+        min(analytics.get_first_day(user), end)
+    if analytics.count_buckets(start, end, granularity) > \
+            analytics.MAX_BUCKETS:
+        return HttpResponseBadRequest(
+            "More than {} buckets requested.".format(analytics.MAX_BUCKETS))
+    tz = timezone.get_current_timezone_name()
+
+    # data version changes on every write, so it identifies the response
+    version = cache.get_version(user.id)
+    etag = None
+    if version is not None:
+        etag = '"{}"'.format(hashlib.md5('{}:{}:{}:{}:{}'.format(
+            version, granularity, start, end, tz).encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return response
+
+    buckets = cache.get_or_set(
+        user.id, 'analytics',
+        lambda: analytics.get_buckets(user, granularity, start, end),
+        granularity, start, end, tz)
+    response = JsonResponse({
+        'granularity': granularity,
+        'timezone': tz,
+        'buckets': buckets,
+    })
+    if etag is not None:
+        response['ETag'] = etag
+    # browsers have to revalidate, which is cheap with the ETag
+    patch_cache_control(response, private=True, max_age=0)
+    return response
+
+
+@db.replica_reads
+@login_required
+def transaction_tag_breakdown(request):
+    form = forms.PeriodForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    user = request.user
+    period = form.get_range()
+    tags = cache.get_or_set(
+        user.id, 'tag_breakdown',
+        lambda: services.get_tag_breakdown(user, period), *period)
+    return JsonResponse({'tags': tags})
+
+
 @login_required
 def transaction_list_filter(request):
-    fltr = request.GET.get('filter', None)
-    request.session['filter:transaction_list'] = fltr
-    return redirect(reverse('transaction_list'))
+    "Kept for old links, the list takes the filter as a query parameter"
+    query = urlencode({'filter': request.GET.get('filter', '')})
+    return redirect('{}?{}'.format(reverse('transaction_list'), query))
 
 
 @login_required
@@ -63,13 +169,41 @@ def transaction_create(request):
     if form.is_valid():
         form.instance.user = request.user
         form.save()
+        cache.bump_version(request.user.id)
         return redirect(reverse('transaction_list'))
     return render(request, 'transaction_create.html', {'form': form})
 
 
+@login_required
+def transaction_import(request):
+    form = forms.ImportForm(request.POST or None, request.FILES or None)
+    ctx = {'form': form}
+    if form.is_valid():
+        lines = importer.decode_lines(form.cleaned_data['file'])
+        try:
+            ctx['result'] = importer.import_transactions(request.user, lines)
+        except (UnicodeDecodeError, csv.Error) as e:
+            form.add_error('file', "File is not a valid CSV: {}".format(e))
+        else:
+            cache.bump_version(request.user.id)
+    return render(request, 'transaction_import.html', ctx)
+
+
 @login_required
 def transaction_delete(request, pk):
-    Transaction.objects.get(pk=pk).deactivate()
+    Transaction.objects.filter(pk=pk, user=request.user).deactivate()
+    cache.bump_version(request.user.id)
+    return redirect(reverse('transaction_list'))
+
+
+@login_required
+@require_POST
+def transaction_bulk(request):
+    form = forms.TransactionBulkForm(request.POST)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    form.apply(Transaction.objects.filter(user=request.user))
+    cache.bump_version(request.user.id)
     return redirect(reverse('transaction_list'))
 
 
@@ -79,48 +213,89 @@ def transaction_update(request, pk):
     form = forms.TransactionForm(request.POST or None, instance=instance)
     if form.is_valid():
         form.save()
+        cache.bump_version(instance.user_id)
         return redirect(reverse('transaction_list'))
     return render(request, 'transaction_create.html', {'form': form})
 
 
+@db.replica_reads
 @login_required
 def debt_loan_list(request):
     ctx = {}
 
-    user_id = request.user.id
-    user = User.objects.get(id=user_id)
+    # authentication middleware has already loaded the user
+    user = request.user
 
     user_debt_loans = DebtLoan.objects.filter(user=user, active=True)
 
-    user_debt_loans = user_debt_loans.order_by('-created')
+    cursor = request.GET.get('cursor')
+
+    def render_rows():
+        debt_loans, next_cursor = services.get_page(user_debt_loans, cursor)
+        ctx['debt_loans'] = debt_loans
+        rows = render_to_string('debt_loan_list_rows.html',
+                                {'debt_loans': debt_loans})
+        return rows, next_cursor
+
+    ctx['rows'], ctx['next_cursor'] = cache.get_or_set(
+        user.id, 'debt_loan_rows', render_rows, cursor)
 
-    ctx['user'] = user
-    ctx['debt_loans'] = user_debt_loans
-    ctx['debt_sum'] = user_debt_loans \
-        .filter(category=DebtLoan.DEBT) \
-        .aggregate(Sum('amount')).get('amount__sum')
-    ctx['loan_sum'] = user_debt_loans \
-        .filter(category=DebtLoan.LOAN) \
-        .aggregate(Sum('amount')).get('amount__sum')
+    if request.is_ajax():
+        return render(request, 'list_page.html', context=ctx)
 
+    totals = cache.get_or_set(
+        user.id, 'debt_loan_totals',
+        lambda: services.get_debt_loan_totals(user_debt_loans))
+    ctx['debt_sum'] = totals['debt_sum']
+    ctx['loan_sum'] = totals['loan_sum']
+
+    ctx['categories'] = DebtLoan.CATEGORY_CHOICES
     ctx['list'] = 'debts_loans'
 
     return render(request, 'debt_loan_list.html', context=ctx)
 
 
+@db.replica_reads
+@login_required
+def debt_loan_counterparties(request):
+    user = request.user
+    user_debt_loans = DebtLoan.objects.filter(user=user, active=True)
+
+    ctx = {}
+    ctx['counterparties'] = cache.get_or_set(
+        user.id, 'counterparty_totals',
+        lambda: services.get_counterparty_totals(user_debt_loans))
+    ctx['list'] = 'debts_loans'
+
+    return render(request, 'debt_loan_counterparties.html', context=ctx)
+
+
 @login_required
 def debt_loan_create(request):
     form = forms.DebtLoanForm(request.POST or None)
     if form.is_valid():
         form.instance.user = request.user
         form.save()
+        cache.bump_version(request.user.id)
         return redirect(reverse('debt_loan_list'))
     return render(request, 'debt_loan_create.html', {'form': form})
 
 
 @login_required
 def debt_loan_delete(request, pk):
-    DebtLoan.objects.get(pk=pk).deactivate()
+    DebtLoan.objects.filter(pk=pk, user=request.user).deactivate()
+    cache.bump_version(request.user.id)
+    return redirect(reverse('debt_loan_list'))
+
+
+@login_required
+@require_POST
+def debt_loan_bulk(request):
+    form = forms.DebtLoanBulkForm(request.POST)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    form.apply(DebtLoan.objects.filter(user=request.user))
+    cache.bump_version(request.user.id)
     return redirect(reverse('debt_loan_list'))
 
 
@@ -130,5 +305,50 @@ def debt_loan_update(request, pk):
     form = forms.DebtLoanForm(request.POST or None, instance=instance)
     if form.is_valid():
         form.save()
+        cache.bump_version(instance.user_id)
         return redirect(reverse('debt_loan_list'))
     return render(request, 'debt_loan_create.html', {'form': form})
+
+
+@db.replica_reads
+@login_required
+def search_rows(request):
+    form = forms.SearchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    data = form.cleaned_data
+    qs = export.get_export_queryset(request.user, data['kind'],
+                                    period=data['period'])
+    rows, has_next = search.get_page(search.search(qs, data['q']),
+                                     data['page'])
+
+    ctx = {
+        'form': form,
+        'query': data['q'],
+        'kind': data['kind'],
+        'fltr': data['period'],
+        'rows': rows,
+        'page': data['page'],
+        'has_next': has_next,
+    }
+    if data['kind'] == forms.ExportForm.TRANSACTIONS:
+        ctx['list'] = 'transactions'
+    else:
+        ctx['list'] = 'debts_loans'
+    return render(request, 'search.html', context=ctx)
+
+
+@db.replica_reads
+@login_required
+def export_rows(request):
+    form = forms.ExportForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    data = form.cleaned_data
+    qs = export.get_export_queryset(request.user, data['kind'],
+                                    period=data['period'],
+                                    start=data['start'],
+                                    end=data['end'])
+    # rows are streamed after the view returns, so the database is chosen now
+    qs = qs.using(db.read_database())
+    return export.export_response(qs, data['kind'], data['format'])
@@ -0,0 +1,142 @@
+"""
+Read replica routing and health of persistent connections
+
+Reads go to one of ``DATABASE_REPLICAS`` only in views decorated with
+``replica_reads``. Everything else, writes and management commands
+included, uses the ``default`` (primary) database.
+
+Replicas lag behind the primary, so ``ReplicaPinningMiddleware`` keeps a
+client on the primary for ``REPLICA_PIN_SECONDS`` after every request
+which wrote anything. Unsafe requests (POST etc.) never read from replicas,
+so forms are validated against current rows.
+
+uwsgi workers keep connections open for ``CONN_MAX_AGE`` seconds.
+``ConnectionHealthMiddleware`` pings connections idle for more than
+``CONN_HEALTH_CHECK_SECONDS`` and drops broken ones (e.g. after a database
+restart), so a request opens a new connection instead of failing. Django
+1.11 has no ``CONN_HEALTH_CHECKS`` database option.
+"""
+from functools import wraps
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+PRIMARY = 'default'
+PIN_COOKIE = 'pin_primary'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def pin():
+    "Sends the rest of this thread's reads to the primary"
+    _state.pinned = True
+
+
+def read_database():
+    "Returns alias the current thread reads from"
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas or getattr(_state, 'pinned', False) \
+            or not getattr(_state, 'replica', False):
+        return PRIMARY
+    return random.choice(replicas)
+
+
+def replica_reads(view):
+    "Lets ``view`` read from replicas, unless the client is pinned"
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_state, 'replica', False)
+        _state.replica = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _state.replica = previous
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return read_database()
+
+    def db_for_write(self, model, **hints):
+        # rows read after a write have to see it
+        _state.wrote = True
+        pin()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        aliases = (PRIMARY,) + tuple(settings.DATABASE_REPLICAS)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """
+    Pins clients, which have just written something, to the primary
+
+    It should come before session middleware, which writes sessions.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.pinned = request.method not in SAFE_METHODS \
+            or PIN_COOKIE in request.COOKIES
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = _state.wrote
+            _state.pinned = _state.wrote = False
+
+        if wrote:
+            response.set_cookie(PIN_COOKIE, '1',
+                                max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True)
+        return response
+
+
+def check_connections():
+    "Closes open connections, which are idle for long and do not respond"
+    interval = settings.CONN_HEALTH_CHECK_SECONDS
+    if interval is None:
+        return
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        used = getattr(connection, 'last_used_at', None)
+        if used is not None and now - used < interval:
+            continue
+        # ``is_usable`` runs ``SELECT 1`` on the raw connection, so it is
+        # not counted as a query of the request
+        if not connection.is_usable():
+            connection.close()
+
+
+def mark_connections_used():
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.last_used_at = now
+
+
+class ConnectionHealthMiddleware:
+    "Checks persistent connections before a request uses them"
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        check_connections()
+        try:
+            return self.get_response(request)
+        finally:
+            mark_connections_used()
@@ -0,0 +1,250 @@
+from datetime import datetime
+
+import json
+import platform
+import random
+import subprocess
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.transaction import atomic
+from django.db.transaction import set_rollback
+from django.test import Client
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from books.models import DebtLoan
+from books.models import Transaction
+from books import analytics
+from books import cache
+from books import services
+from finance.management.commands import benchmark_queries
+
+PASSWORD = 'benchmark'
+
+# a real cache for cached cases, whatever settings the command runs with
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+    }
+}
+# middleware adding overhead production requests don't have
+EXCLUDED_MIDDLEWARE = (
+    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'finance.querylog.QueryInspectionMiddleware',
+    'opbeat.contrib.django.middleware.OpbeatAPMMiddleware',
+)
+
+
+class Command(benchmark_queries.Command):
+    help = ("Measures latency and query counts of views and services on "
+            "seeded datasets and writes them out as JSON. Whatever the "
+            "settings, runs with a local memory cache and without debug "
+            "toolbar, APM and query inspection middleware.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1000, 100000, 1000000],
+                            help="rows of each kind per benchmark user")
+        parser.add_argument('--repeat', type=int, default=10,
+                            help="how many times each case is timed")
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='benchmark.json',
+                            help="file JSON results are written to")
+        parser.add_argument('--compare',
+                            help="JSON results of an earlier run to compare "
+                                 "with")
+
+    def handle(self, *args, **options):
+        middleware = [m for m in settings.MIDDLEWARE
+                      if m not in EXCLUDED_MIDDLEWARE]
+        with override_settings(CACHES=CACHES, MIDDLEWARE=middleware):
+            try:
+                self.benchmark(options)
+            finally:
+                caches['default'].clear()
+
+    def benchmark(self, options):
+        self.batch_size = options['batch_size']
+        random.seed(options['seed'])
+
+        results = []
+        for size in options['sizes']:
+            user, _ = User.objects.get_or_create(
+                username='benchmark_{}'.format(size))
+            user.set_password(PASSWORD)
+            user.save()
+            self.seed(user, size)
+            for name, setup, run, write in self.get_cases(user):
+                result = self.run_case(setup, run, write, options['repeat'])
+                result.update(size=size, name=name)
+                results.append(result)
+                self.stdout.write(
+                    "{name} @ {size}: median {median_ms:.2f} ms, "
+                    "{queries} queries".format(**result))
+
+        with open(options['output'], 'w') as f:
+            json.dump({'meta': self.get_meta(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+            self.compare(baseline, results)
+
+    def get_meta(self):
+        try:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                stderr=subprocess.DEVNULL,
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'database': connection.vendor,
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'time': datetime.utcnow().isoformat(),
+        }
+
+    def get_cases(self, user):
+        """
+        Yields ``(name, setup, run, write)`` of every benchmark case
+
+        ``setup`` is called before every timed ``run``, changes done by
+        ``write`` cases are rolled back.
+        """
+        # ALLOWED_HOSTS of every settings module allow localhost
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(user)
+
+        def get(name, *args, **data):
+            return lambda: client.get(reverse(name, args=args), data)
+
+        def post(name, data, *args):
+            return lambda: client.post(reverse(name, args=args), data)
+
+        def uncached():
+            "Drops cached lists"
+            def setup():
+                cache.bump_version(user.id)
+            return setup
+
+        def noop():
+            pass
+
+        for period in services.PERIODS:
+            yield ('transaction_list[{}]'.format(period), uncached(),
+                   get('transaction_list', filter=period), False)
+        # the first run fills the cache
+        yield ('transaction_list[cached]',
+               get('transaction_list', filter='all_time'),
+               get('transaction_list', filter='all_time'), False)
+        yield ('debt_loan_list', uncached(), get('debt_loan_list'), False)
+        yield ('debt_loan_counterparties', uncached(),
+               get('debt_loan_counterparties'), False)
+        for granularity in analytics.GRANULARITIES:
+            # a year of days, the whole history otherwise
+            data = {'start': '{}-01-01'.format(timezone.localdate().year)} \
+                if granularity == analytics.DAY else {}
+            yield ('transaction_analytics[{}]'.format(granularity),
+                   uncached(),
+                   get('transaction_analytics', granularity, **data), False)
+
+        for period in services.PERIODS:
+            yield ('services.get_transaction_totals[{}]'.format(period), noop,
+                   lambda period=period: services.get_transaction_totals(
+                       services.get_period_transactions(user, period)),
+                   False)
+            yield ('services.get_summary_totals[{}]'.format(period), noop,
+                   lambda period=period: services.get_summary_totals(
+                       user, *services.get_period_range(period)),
+                   False)
+        debt_loans = DebtLoan.objects.filter(user=user, active=True)
+        yield ('services.get_debt_loan_totals', noop,
+               lambda: services.get_debt_loan_totals(debt_loans), False)
+        yield ('services.get_counterparty_totals', noop,
+               lambda: services.get_counterparty_totals(debt_loans), False)
+        transactions = Transaction.objects.filter(user=user, active=True)
+        yield ('services.get_page', noop,
+               lambda: services.get_page(transactions), False)
+
+        transaction = transactions.order_by('-created').first()
+        debt_loan = debt_loans.order_by('-created').first()
+        yield ('transaction_create', noop,
+               post('transaction_create',
+                    {'title': 'benchmark', 'amount': '10.00',
+                     'category': Transaction.EXPENSE}),
+               True)
+        yield ('transaction_update', noop,
+               post('transaction_update',
+                    {'title': 'benchmark', 'amount': '20.00',
+                     'category': Transaction.INCOME},
+                    transaction.pk),
+               True)
+        yield ('transaction_delete', noop,
+               get('transaction_delete', transaction.pk), True)
+        yield ('debt_loan_create', noop,
+               post('debt_loan_create',
+                    {'with_who': 'benchmark', 'amount': '10.00',
+                     'category': DebtLoan.DEBT}),
+               True)
+        yield ('debt_loan_delete', noop,
+               get('debt_loan_delete', debt_loan.pk), True)
+
+        anonymous = Client(HTTP_HOST='localhost')
+        yield ('login', anonymous.logout,
+               lambda: anonymous.post(reverse('login'),
+                                      {'username': user.username,
+                                       'password': PASSWORD}),
+               False)
+
+    def run_case(self, setup, run, write, repeat):
+        timings = []
+        for _ in range(max(repeat, 1)):
+            setup()
+            with atomic(), CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = run()
+                timings.append((time.perf_counter() - start) * 1000)
+                if write:
+                    set_rollback(True)
+            status = getattr(response, 'status_code', 200)
+            if status >= 400:
+                raise CommandError("Benchmark request failed with {}".format(
+                    status))
+        timings.sort()
+        return {
+            'min_ms': round(timings[0], 3),
+            'median_ms': round(timings[len(timings) // 2], 3),
+            'p95_ms': round(timings[int(0.95 * (len(timings) - 1))], 3),
+            'max_ms': round(timings[-1], 3),
+            'queries': len(queries),
+        }
+
+    def compare(self, baseline, results):
+        "Prints change of median latency and query count of each case"
+        previous = {(r['size'], r['name']): r for r in baseline}
+        for result in results:
+            before = previous.get((result['size'], result['name']))
+            if before is None:
+                continue
+            change = (result['median_ms'] - before['median_ms']) \
+                / (before['median_ms'] or 1) * 100
+            self.stdout.write(
+                "{name} @ {size}: median {before:.2f} -> {after:.2f} ms "
+                "({change:+.0f}%), queries {q_before} -> {q_after}".format(
+                    name=result['name'], size=result['size'],
+                    before=before['median_ms'], after=result['median_ms'],
+                    change=change, q_before=before['queries'],
+                    q_after=result['queries']))
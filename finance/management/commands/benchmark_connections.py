@@ -0,0 +1,103 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import reverse
+
+# (name, CONN_MAX_AGE, CONN_HEALTH_CHECK_SECONDS)
+MODES = (
+    ('new connection per request', 0, None),
+    ('persistent', 300, None),
+    ('persistent, checked every request', 300, 0),
+)
+
+
+class Command(BaseCommand):
+    help = ("Measures requests per second of a view with a new database "
+            "connection per request and with persistent connections. "
+            "Requests go through the whole WSGI handler, like uwsgi sends "
+            "them, one at a time as a single worker serves them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500,
+                            help="requests made in every mode")
+        parser.add_argument('--view', default='transaction_list',
+                            help="URL name of a view without arguments")
+        parser.add_argument('--username', default='admin',
+                            help="user requests are made by, e.g. one "
+                                 "created by populate")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError("User {} does not exist".format(
+                options['username']))
+        environ = self.get_environ(user, reverse(options['view']))
+        handler = WSGIHandler()
+
+        opened = []
+
+        def count_connection(sender, connection, **kwargs):
+            opened.append(connection.alias)
+
+        connection_created.connect(count_connection)
+        max_ages = {c.alias: c.settings_dict['CONN_MAX_AGE']
+                    for c in connections.all()}
+        baseline = None
+        try:
+            for name, max_age, interval in MODES:
+                self.set_max_age(max_age)
+                del opened[:]
+                with override_settings(CONN_HEALTH_CHECK_SECONDS=interval):
+                    elapsed = self.run_requests(handler, environ,
+                                                options['requests'])
+                rate = options['requests'] / elapsed
+                baseline = baseline or rate
+                self.stdout.write(
+                    "{}: {:.0f} requests/s, {:.2f} ms per request, {} "
+                    "connections opened, {:.2f}x".format(
+                        name, rate, elapsed / options['requests'] * 1000,
+                        len(opened), rate / baseline))
+        finally:
+            connection_created.disconnect(count_connection)
+            for connection in connections.all():
+                connection.settings_dict['CONN_MAX_AGE'] = \
+                    max_ages[connection.alias]
+
+    def get_environ(self, user, path):
+        "Returns WSGI environ of a GET request made by logged in ``user``"
+        client = Client()
+        client.force_login(user)
+        session = client.cookies[settings.SESSION_COOKIE_NAME].value
+        request = RequestFactory().get(
+            path, HTTP_HOST='localhost',
+            HTTP_COOKIE='{}={}'.format(settings.SESSION_COOKIE_NAME, session))
+        return request.environ
+
+    def set_max_age(self, max_age):
+        "Closes connections, so new ones are opened with ``max_age``"
+        for connection in connections.all():
+            connection.close()
+            connection.settings_dict['CONN_MAX_AGE'] = max_age
+
+    def run_requests(self, handler, environ, count):
+        def start_response(status, headers):
+            if not status.startswith('200'):
+                raise CommandError("Request failed with {}".format(status))
+
+        start = time.perf_counter()
+        for _ in range(count):
+            response = handler(dict(environ), start_response)
+            b''.join(response)
+            # closing the response finishes the request, which closes
+            # connections older than CONN_MAX_AGE
+            response.close()
+        return time.perf_counter() - start
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from books import importer
+
+
+class Command(BaseCommand):
+    help = "Measures CSV import speed, imported rows are rolled back"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int,
+                            default=importer.BATCH_SIZE)
+        parser.add_argument('--username', default='benchmark')
+        parser.add_argument('--keep', action='store_true',
+                            help="commit imported rows")
+
+    def generate_lines(self, rows):
+        "Yields CSV lines like bank statements have, one of 100 is invalid"
+        now = timezone.now()
+        yield 'title,amount,category,created\n'
+        for n in range(rows):
+            amount = '{:.2f}'.format(random.uniform(-500, 500))
+            if n % 100 == 99:
+                amount = 'n/a'
+            created = now - timedelta(minutes=random.randint(0, 10 ** 6))
+            yield 'payment {},{},,{}\n'.format(n, amount, created.isoformat())
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username=options['username'])
+        lines = self.generate_lines(options['rows'])
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            result = importer.import_transactions(
+                user, lines, batch_size=options['batch_size'])
+            if not options['keep']:
+                transaction.set_rollback(True)
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            "{} rows imported, {} skipped in {:.2f} s ({:.0f} rows/s)".format(
+                result.created, len(result.errors), elapsed,
+                options['rows'] / elapsed))
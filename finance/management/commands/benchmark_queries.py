@@ -0,0 +1,115 @@
+from datetime import timedelta
+
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from books.models import DebtLoan
+from books.models import MonthlySummary
+from books.models import Transaction
+from books import services
+
+
+class Command(BaseCommand):
+    help = "Prints query plans and latencies of list queries on big tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000,
+                            help="transactions benchmark user should have")
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="how many times each query is timed")
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--username', default='benchmark')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        user, _ = User.objects.get_or_create(username=options['username'])
+        self.seed(user, options['rows'])
+
+        for name, qs in self.get_querysets(user):
+            self.stdout.write("== {}".format(name))
+            for line in self.explain(qs):
+                self.stdout.write("  {}".format(line))
+            timings = self.measure(qs, options['repeat'])
+            self.stdout.write("  min {:.2f} ms, median {:.2f} ms".format(
+                timings[0], timings[len(timings) // 2]))
+
+    def seed(self, user, rows):
+        "Tops up benchmark user's transactions and debt/loans to ``rows``"
+        now = timezone.now()
+        # spread rows over ten years, so period filters are selective
+        span = int(timedelta(days=3650).total_seconds())
+
+        def make(model, categories, count, **fields):
+            return [
+                model(amount=random.randint(1, 1000),
+                      category=random.choice(categories),
+                      created=now - timedelta(seconds=random.randint(0, span)),
+                      user=user,
+                      **fields)
+                for _ in range(count)
+            ]
+
+        targets = (
+            (Transaction, [Transaction.EXPENSE, Transaction.INCOME],
+             {'title': 'benchmark'}),
+            (DebtLoan, [DebtLoan.DEBT, DebtLoan.LOAN],
+             {'with_who': 'benchmark'}),
+        )
+        for model, categories, fields in targets:
+            missing = rows - model.objects.filter(user=user).count()
+            while missing > 0:
+                count = min(missing, self.batch_size)
+                model.objects.bulk_create(
+                    make(model, categories, count, **fields))
+                missing -= count
+            self.stdout.write("{} rows of {}".format(
+                model.objects.filter(user=user).count(), model.__name__))
+
+        # bulk inserts skip ``Transaction.save``, which keeps summaries
+        MonthlySummary.objects.rebuild([user])
+
+    def get_querysets(self, user):
+        "Yields first page queries issued by the list views"
+        page = slice(0, 50)
+        yield ('this_month',
+               services.get_months_transactions(user)
+               .order_by('-created', '-id')[page])
+        yield ('last_month',
+               services.get_last_months_transactions(user)
+               .order_by('-created', '-id')[page])
+        yield ('this_year',
+               services.get_this_years_transactions(user)
+               .order_by('-created', '-id')[page])
+        yield ('all_time',
+               Transaction.objects.filter(user=user, active=True)
+               .order_by('-created', '-id')[page])
+        yield ('debt_loans',
+               DebtLoan.objects.filter(user=user, active=True)
+               .order_by('-created', '-id')[page])
+
+    def explain(self, qs):
+        if connection.vendor == 'postgresql':
+            prefix = 'EXPLAIN ANALYZE '
+        elif connection.vendor == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            return []
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [' '.join(str(col) for col in row)
+                    for row in cursor.fetchall()]
+
+    def measure(self, qs, repeat):
+        timings = []
+        for _ in range(max(repeat, 1)):
+            start = time.perf_counter()
+            # clone the queryset, otherwise the result cache is reused
+            list(qs.all())
+            timings.append((time.perf_counter() - start) * 1000)
+        return sorted(timings)
@@ -0,0 +1,33 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from books import cache
+from books import importer
+
+
+class Command(BaseCommand):
+    help = "Imports transactions of a user from a CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int,
+                            default=importer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError("User {} does not exist".format(
+                options['username']))
+
+        with open(options['path'], encoding='utf-8-sig', newline='') as f:
+            result = importer.import_transactions(
+                user, f, batch_size=options['batch_size'])
+        cache.bump_version(user.id)
+
+        for line_number, errors in result.errors:
+            self.stderr.write("line {}: {}".format(line_number, errors))
+        self.stdout.write("{} transactions imported, {} rows skipped".format(
+            result.created, len(result.errors)))
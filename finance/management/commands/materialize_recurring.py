@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_date
+
+from books import recurring
+
+
+class Command(BaseCommand):
+    help = ("Creates transactions of recurring rules, which are due, "
+            "including periods missed since the last run. Meant to be run "
+            "from cron daily, running it again creates nothing twice.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=parse_date,
+                            help="create occurrences up to this day "
+                                 "(YYYY-MM-DD), today by default")
+        parser.add_argument('--batch-size', type=int,
+                            default=recurring.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        result = recurring.materialize(options['date'],
+                                       batch_size=options['batch_size'])
+        self.stdout.write("{} transactions of {} rules created".format(
+            result.created, result.rules))
@@ -1,143 +1,190 @@
 from datetime import datetime
 from datetime import timedelta
+from decimal import Decimal
 
+import csv
+import io
 import random
+import time
 
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.transaction import atomic
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 
-import factory
 import pytz
 
 from accounts.factories import UserFactory
-from books.factories import DebtLoanFactory
-from books.factories import TransactionFactory
 from books.models import DebtLoan
+from books.models import MonthlySummary
 from books.models import Transaction
+from books import cache
+
+TITLES = ('groceries', 'rent', 'salary', 'fuel', 'coffee', 'books',
+          'electricity', 'phone', 'gift', 'restaurant', 'taxi', 'bonus')
+
+COUNTERPARTIES = ('ACME co.', 'John', 'Jane', 'Bank', 'Landlord', 'Mom')
 
 
 class Command(BaseCommand):
-    help = "Popoulates databse with dummy data"
+    help = "Populates database with reproducible dummy data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1,
+                            help="number of users, the first one is admin")
+        parser.add_argument('--rows', type=int, default=20,
+                            help="transactions and debt/loans per user")
+        parser.add_argument('--days', type=int, default=3650,
+                            help="rows are spread over this many days")
+        parser.add_argument('--end', type=parse_date,
+                            help="last day of the span (YYYY-MM-DD), "
+                                 "today by default")
+        parser.add_argument('--distribution', default='uniform',
+                            choices=('uniform', 'recent'),
+                            help="'recent' puts more rows near the end")
+        parser.add_argument('--seed', type=int,
+                            help="same seed generates the same rows")
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--copy', action='store_true',
+                            help="insert with COPY (postgres only)")
+        parser.add_argument('--clear', action='store_true',
+                            help="delete users' existing rows first")
 
     def handle(self, *args, **options):
-        if not User.objects.filter(username='admin'):
-            self.create_admin()
+        if options['days'] < 1:
+            raise CommandError("--days should be at least 1")
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError("--copy works on postgres only")
+
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.copy = options['copy']
+        self.distribution = options['distribution']
+        end = options['end'] or timezone.now().date()
+        # span ends at the next midnight, so the whole last day is covered
+        self.end = datetime(end.year, end.month, end.day, tzinfo=pytz.utc) \
+            + timedelta(days=1)
+        self.span = int(timedelta(days=options['days']).total_seconds())
+
+        users = self.get_users(options['users'])
+        if options['clear']:
+            Transaction.objects.filter(user__in=users).delete()
+            DebtLoan.objects.filter(user__in=users).delete()
+
+        start = time.perf_counter()
+        created = 0
+        for user in users:
+            created += self.insert(Transaction, self.make_transaction,
+                                   user, options['rows'])
+            created += self.insert(DebtLoan, self.make_debt_loan,
+                                   user, options['rows'])
+        # bulk inserts skip ``Transaction.save``, which keeps summaries
+        MonthlySummary.objects.rebuild(users)
+        for user in users:
+            cache.bump_version(user.id)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write("{} rows for {} users created in {:.2f} s".format(
+            created, len(users), elapsed))
+
+    def get_users(self, count):
+        "Returns admin and ``count - 1`` other users, creating missing ones"
+        admin = User.objects.filter(username='admin').first()
+        if admin is None:
+            admin = self.create_admin()
         else:
-            self.admin = User.objects.get(username='admin')
-            print("admin user already exists")
-
-        self.create_transactions()
-        self.create_debt_loans()
+            self.stdout.write("admin user already exists")
+
+        usernames = ['user{}'.format(n) for n in range(1, count)]
+        existing = set(User.objects.filter(username__in=usernames)
+                       .values_list('username', flat=True))
+        # hashing is slow on purpose, so all users share one password hash
+        password = make_password('asdasd')
+        User.objects.bulk_create(
+            [User(username=username,
+                  email='{}@example.com'.format(username),
+                  password=password)
+             for username in usernames if username not in existing],
+            batch_size=self.batch_size,
+        )
+        others = User.objects.filter(username__in=usernames).order_by('id')
+        return [admin] + list(others)
 
     def create_admin(self):
         # Factory creates simple user, so ``is_staff`` is set later
-        self.admin = UserFactory(username='admin', password='asdasd')
-        self.admin.is_staff = True
-        self.admin.is_superuser = True
-        self.admin.save()
-        print("admin user have been created successfully")
-
-    def _get_last_month(self):
-        "Returns random date in last month"
-        today = timezone.now()
-        first_month_day = today.replace(day=1)
-        last_month = first_month_day - timedelta(days=1)
-        return datetime(last_month.year,
-                        last_month.month,
-                        random.randint(1, 28),
-                        tzinfo=pytz.utc)
-
-    def _get_this_year(self):
-        "Returns random date in this year"
-        today = timezone.now()
-        return datetime(today.year,
-                        random.randint(1, today.month),
-                        random.randint(1, today.day),
-                        tzinfo=pytz.utc)
-
-    def _get_all_time(self):
-        "Returns random date"
-        today = timezone.now()
-        return datetime(random.randint(2000, today.year-1),
-                        random.randint(1, 12),
-                        random.randint(1, 28),
-                        tzinfo=pytz.utc)
-
-    def create_transactions(self):
-        categories = [Transaction.EXPENSE, Transaction.INCOME]
-
-        # create now
-        TransactionFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-        )
-
-        # create for last month
-        TransactionFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-            created=factory.Sequence(lambda n: self._get_last_month()),
-        )
-
-        # create for this year
-        TransactionFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-            created=factory.Sequence(lambda n: self._get_this_year()),
-        )
-
-        # create for all time
-        TransactionFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-            created=factory.Sequence(lambda n: self._get_all_time()),
-        )
-        print("Transactions for admin created")
-
-    def create_debt_loans(self):
-        categories = [DebtLoan.DEBT, DebtLoan.LOAN]
-
-        # create now
-        DebtLoanFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-        )
-
-        # create for last month
-        DebtLoanFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-            created=factory.Sequence(lambda n: self._get_last_month()),
-        )
-
-        # create for this year
-        DebtLoanFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-            created=factory.Sequence(lambda n: self._get_this_year()),
-        )
-
-        # create for all time
-        DebtLoanFactory.create_batch(
-            5,
-            amount=factory.Sequence(lambda n: random.randint(1, 10)),
-            category=factory.Sequence(lambda n: random.choice(categories)),
-            user=self.admin,
-            created=factory.Sequence(lambda n: self._get_all_time()),
+        admin = UserFactory(username='admin', password='asdasd')
+        admin.is_staff = True
+        admin.is_superuser = True
+        admin.save()
+        self.stdout.write("admin user have been created successfully")
+        return admin
+
+    def get_created(self):
+        "Returns random moment of the span"
+        fraction = self.random.random()
+        if self.distribution == 'recent':
+            # density grows linearly towards the end of the span
+            fraction = fraction ** 2
+        return self.end - timedelta(seconds=int(fraction * self.span) + 1)
+
+    def get_amount(self):
+        return Decimal(self.random.randint(100, 100000)) / 100
+
+    def make_transaction(self, user):
+        category = self.random.choice((Transaction.EXPENSE,
+                                       Transaction.INCOME))
+        created = self.get_created()
+        return Transaction(title=self.random.choice(TITLES),
+                           amount=self.get_amount(),
+                           category=category,
+                           created=created,
+                           modified=created,
+                           user=user)
+
+    def make_debt_loan(self, user):
+        category = self.random.choice((DebtLoan.DEBT, DebtLoan.LOAN))
+        created = self.get_created()
+        return DebtLoan(with_who=self.random.choice(COUNTERPARTIES),
+                        title=self.random.choice(TITLES),
+                        amount=self.get_amount(),
+                        category=category,
+                        created=created,
+                        modified=created,
+                        user=user)
+
+    def insert(self, model, make, user, count):
+        "Inserts ``count`` rows made by ``make`` in batches"
+        inserted = 0
+        while inserted < count:
+            batch = [make(user)
+                     for _ in range(min(self.batch_size, count - inserted))]
+            with atomic():
+                if self.copy:
+                    self.copy_rows(model, batch)
+                else:
+                    model.objects.bulk_create(batch)
+            inserted += len(batch)
+        return inserted
+
+    def copy_rows(self, model, objs):
+        "Streams ``objs`` to postgres with ``COPY ... FROM STDIN``"
+        fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for obj in objs:
+            # ``pre_save`` fills derived fields, as ``bulk_create`` does
+            writer.writerow([
+                f.get_db_prep_save(f.pre_save(obj, True), connection)
+                for f in fields
+            ])
+        buf.seek(0)
+        sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(f.column) for f in fields),
         )
-        print("DebtLoans for admin created")
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, buf)
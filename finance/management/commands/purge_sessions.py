@@ -0,0 +1,41 @@
+from importlib import import_module
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = ("Deletes expired sessions in small batches, so the session "
+            "table is never locked for long. Meant to be run from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help="seconds to wait between batches")
+
+    def handle(self, *args, **options):
+        engine = import_module(settings.SESSION_ENGINE)
+        try:
+            model = engine.SessionStore.get_model_class()
+        except AttributeError:
+            raise CommandError("{} does not store sessions in the "
+                               "database".format(settings.SESSION_ENGINE))
+
+        now = timezone.now()
+        deleted = 0
+        while True:
+            # ``expire_date`` is indexed, so every batch is a range scan
+            keys = list(model.objects
+                        .filter(expire_date__lt=now)
+                        .values_list('session_key', flat=True)
+                        [:options['batch_size']])
+            if not keys:
+                break
+            deleted += model.objects.filter(session_key__in=keys).delete()[0]
+            time.sleep(options['pause'])
+
+        self.stdout.write("{} expired sessions deleted".format(deleted))
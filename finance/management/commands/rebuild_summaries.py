@@ -0,0 +1,51 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from books.models import MonthlySummary
+
+
+class Command(BaseCommand):
+    help = "Rebuilds or verifies monthly transaction summaries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help="only compare summaries with transactions")
+        parser.add_argument('--user', dest='usernames', action='append',
+                            help="limit to a user, can be repeated")
+
+    def handle(self, *args, **options):
+        users = None
+        if options['usernames']:
+            users = User.objects.filter(username__in=options['usernames'])
+
+        if options['verify']:
+            self.verify(users)
+        else:
+            summaries = MonthlySummary.objects.rebuild(users)
+            self.stdout.write("{} summaries rebuilt".format(len(summaries)))
+
+    def verify(self, users):
+        def key(summary):
+            return (summary.user_id, summary.year, summary.month,
+                    summary.category)
+
+        expected = {key(s): (s.sum, s.count)
+                    for s in MonthlySummary.objects.compute(users)}
+        stored = MonthlySummary.objects.all()
+        if users is not None:
+            stored = stored.filter(user__in=users)
+        # rows of fully deactivated months stay behind with zeros
+        actual = {key(s): (s.sum, s.count)
+                  for s in stored if s.count or s.sum}
+
+        mismatches = sorted(set(expected) ^ set(actual) | {
+            k for k in set(expected) & set(actual) if expected[k] != actual[k]
+        })
+        for k in mismatches:
+            self.stderr.write("{}: expected {}, stored {}".format(
+                k, expected.get(k), actual.get(k)))
+        if mismatches:
+            raise CommandError(
+                "{} summaries are out of date".format(len(mismatches)))
+        self.stdout.write("{} summaries are up to date".format(len(actual)))
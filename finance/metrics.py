@@ -0,0 +1,253 @@
+"""
+In-process request metrics served in Prometheus text format
+
+``MetricsMiddleware`` records wall time, SQL query count and time, template
+render time and response size of every request into histograms labelled by
+URL name. Hits and misses of ``books.cache`` are served as counters next to
+them. Every process (e.g. uwsgi worker) keeps its own histograms and
+counters, so they are summed over processes by Prometheus queries.
+
+SQL is timed by wrapping connections' cursors, the same way debug toolbar
+does, because Django 1.11 has no ``connection.execute_wrapper``. Fetching
+rows from server side cursors (``QuerySet.iterator()`` on postgres) is not
+included in SQL time. Template render time is measured by ``DjangoTemplates``
+backend, top level templates only, so includes are not counted twice.
+"""
+from collections import OrderedDict
+
+import threading
+import time
+
+from django.db import connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
+from django.template.backends import django as django_backend
+
+from books import cache
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000)
+
+_request = threading.local()
+_observers = threading.local()
+
+
+class Histogram:
+    "Cumulative histogram with a single ``view`` label"
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # view -> [bucket counts, sum, count]
+        self._values = OrderedDict()
+
+    def observe(self, view, value):
+        with self._lock:
+            values = self._values.get(view)
+            if values is None:
+                values = self._values[view] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[0][i] += 1
+            values[1] += value
+            values[2] += 1
+
+    def get(self, view):
+        "Returns ``(bucket counts, sum, count)`` of ``view``"
+        with self._lock:
+            counts, total, count = self._values.get(
+                view, [[0] * len(self.buckets), 0, 0])
+            return list(counts), total, count
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        "Yields lines of Prometheus text exposition format"
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self._lock:
+            values = [(view, list(counts), total, count)
+                      for view, (counts, total, count) in self._values.items()]
+        for view, counts, total, count in values:
+            label = 'view="{}"'.format(_escape(view))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, label, bound, bucket_count)
+            yield '{}_bucket{{{},le="+Inf"}} {}'.format(
+                self.name, label, count)
+            yield '{}_sum{{{}}} {}'.format(self.name, label, total)
+            yield '{}_count{{{}}} {}'.format(self.name, label, count)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    "Wall time of requests, including middleware.",
+    DURATION_BUCKETS)
+SQL_QUERIES = Histogram(
+    'http_request_sql_queries',
+    "Number of SQL queries per request.",
+    QUERY_BUCKETS)
+SQL_DURATION = Histogram(
+    'http_request_sql_duration_seconds',
+    "Time spent executing SQL per request.",
+    DURATION_BUCKETS)
+RENDER_DURATION = Histogram(
+    'http_request_render_duration_seconds',
+    "Time spent rendering templates per request.",
+    DURATION_BUCKETS)
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes',
+    "Size of response bodies, streaming responses are not counted.",
+    SIZE_BUCKETS)
+
+HISTOGRAMS = (REQUEST_DURATION, SQL_QUERIES, SQL_DURATION, RENDER_DURATION,
+              RESPONSE_SIZE)
+
+
+def _add(name, value):
+    "Adds ``value`` to the current request's counter, if there is a request"
+    if getattr(_request, 'active', False):
+        setattr(_request, name, getattr(_request, name) + value)
+
+
+def add_query_observer(observer):
+    """
+    Calls ``observer(alias, sql, params, duration)`` after every statement
+    this thread executes, until it's removed
+    """
+    if not hasattr(_observers, 'list'):
+        _observers.list = []
+    _observers.list.append(observer)
+
+
+def remove_query_observer(observer):
+    _observers.list.remove(observer)
+
+
+def _record_query(connection, sql, params, duration):
+    _add('sql_time', duration)
+    _add('sql_count', 1)
+    for observer in getattr(_observers, 'list', ()):
+        observer(connection.alias, sql, params, duration)
+
+
+class TimedCursorWrapper(CursorWrapper):
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _record_query(self.db, sql, params, time.perf_counter() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            _record_query(self.db, sql, param_list,
+                          time.perf_counter() - start)
+
+
+def _wrap(method, connection):
+    def cursor(*args, **kwargs):
+        return TimedCursorWrapper(method(*args, **kwargs), connection)
+    cursor.timed = True
+    return cursor
+
+
+def install_cursor_wrappers():
+    """
+    Makes cursors of this thread's connections timed
+
+    Debug toolbar removes its own wrappers by deleting instance attributes,
+    which removes these as well, so they are checked on every request.
+    """
+    for connection in connections.all():
+        if getattr(connection.cursor, 'timed', False):
+            continue
+        # the default ``chunked_cursor`` calls ``cursor``, which is wrapped
+        if type(connection).chunked_cursor is not \
+                BaseDatabaseWrapper.chunked_cursor:
+            connection.chunked_cursor = _wrap(connection.chunked_cursor,
+                                              connection)
+        connection.cursor = _wrap(connection.cursor, connection)
+
+
+class TimedTemplate(django_backend.Template):
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            _add('render_time', time.perf_counter() - start)
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    "Django template backend, which times rendering of templates"
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+class MetricsMiddleware:
+    """
+    Records metrics of every request, should be the first middleware
+
+    Requests which did not resolve to a URL are labelled ``unknown``.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        install_cursor_wrappers()
+        _request.sql_count = 0
+        _request.sql_time = 0
+        _request.render_time = 0
+        _request.active = True
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.active = False
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match and match.url_name) or 'unknown'
+        REQUEST_DURATION.observe(view, duration)
+        SQL_QUERIES.observe(view, _request.sql_count)
+        SQL_DURATION.observe(view, _request.sql_time)
+        RENDER_DURATION.observe(view, _request.render_time)
+        if not response.streaming:
+            RESPONSE_SIZE.observe(view, len(response.content))
+        return response
+
+
+def render_cache_stats():
+    "Yields lines of ``books.cache`` counters in Prometheus text format"
+    stats = cache.get_stats()
+    yield '# HELP books_cache_lookups_total Lookups of cached list data.'
+    yield '# TYPE books_cache_lookups_total counter'
+    for result, name in (('hit', 'hits'), ('miss', 'misses')):
+        yield 'books_cache_lookups_total{{result="{}"}} {}'.format(
+            result, stats[name])
+
+
+def render_metrics():
+    "Returns all histograms and counters in Prometheus text format"
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.extend(render_cache_stats())
+    return '\n'.join(lines) + '\n'
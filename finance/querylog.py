@@ -0,0 +1,141 @@
+"""
+Slow query log and N+1 detector for development and tests
+
+``QueryInspectionMiddleware`` collects every SQL statement of a request and
+after the response is ready
+
+* logs statements slower than ``SLOW_QUERY_MS`` with their ``EXPLAIN``,
+* logs statement shapes repeated ``REPEATED_QUERY_LIMIT`` or more times,
+  which usually are per row lazy loads,
+* checks the number of statements against ``QUERY_BUDGETS`` of the URL
+  name. With ``QUERY_BUDGET_STRICT`` an exceeded budget raises
+  ``QueryBudgetExceeded``, which fails the test that made the request.
+
+Savepoint statements are not counted, tests wrap everything in
+transactions, so they would make counts differ from production.
+"""
+from collections import Counter
+from collections import namedtuple
+
+import logging
+import re
+
+from django.conf import settings
+from django.db import connections
+
+from finance import metrics
+
+logger = logging.getLogger(__name__)
+
+Statement = namedtuple('Statement', 'alias sql params duration')
+
+_SAVEPOINT = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO '
+                        r'SAVEPOINT)\b', re.IGNORECASE)
+
+_NORMALIZE = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s|\?'), '?'),
+    # lists of any length have the same shape
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def normalize(sql):
+    "Returns shape of ``sql`` with literals and placeholders replaced by ?"
+    for pattern, replacement in _NORMALIZE:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def explain(alias, sql, params):
+    "Returns query plan lines of a SELECT statement"
+    connection = connections[alias]
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return []
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(col) for col in row)
+                for row in cursor.fetchall()]
+
+
+class QueryLog:
+    "Collects statements this thread executes while used as context manager"
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        metrics.install_cursor_wrappers()
+        metrics.add_query_observer(self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        metrics.remove_query_observer(self.record)
+
+    def record(self, alias, sql, params, duration):
+        self.statements.append(Statement(alias, sql, params, duration))
+
+    @property
+    def queries(self):
+        "Statements without savepoints"
+        return [s for s in self.statements if not _SAVEPOINT.match(s.sql)]
+
+    def shapes(self):
+        "Returns ``(shape, count)`` of queries, most frequent first"
+        return Counter(normalize(s.sql) for s in self.queries).most_common()
+
+    def repeated(self, limit):
+        return [(shape, count) for shape, count in self.shapes()
+                if count >= limit]
+
+    def slow(self, ms):
+        return [s for s in self.queries if s.duration * 1000 >= ms]
+
+    def report(self):
+        return '\n'.join('{:4} x {}'.format(count, shape)
+                         for shape, count in self.shapes())
+
+
+class QueryInspectionMiddleware:
+    "Inspects SQL of every request, for development and tests only"
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryLog() as log:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        self.inspect((match and match.url_name) or 'unknown', log)
+        return response
+
+    def inspect(self, view, log):
+        for statement in log.slow(settings.SLOW_QUERY_MS):
+            plan = explain(statement.alias, statement.sql, statement.params)
+            logger.warning("Slow query in %s (%.1f ms): %s\n%s", view,
+                           statement.duration * 1000, statement.sql,
+                           '\n'.join(plan))
+
+        for shape, count in log.repeated(settings.REPEATED_QUERY_LIMIT):
+            logger.warning("Query repeated %d times in %s, likely N+1: %s",
+                           count, view, shape)
+
+        budget = settings.QUERY_BUDGETS.get(view)
+        count = len(log.queries)
+        if budget is not None and count > budget:
+            message = "{} made {} queries, its budget is {}:\n{}".format(
+                view, count, budget, log.report())
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(message)
+            logger.error(message)
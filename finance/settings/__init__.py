@@ -33,6 +33,9 @@ DEBUG = False
 ALLOWED_HOSTS = ['localhost', '0.0.0.0', '188.166.117.76',
                  'finantious.com', 'www.finantious.com']
 
+# addresses allowed to scrape request metrics from /metrics
+METRICS_IPS = ('127.0.0.1',)
+
 
 # Application definition
 
@@ -52,7 +55,10 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'finance.metrics.MetricsMiddleware',
+    'finance.db.ConnectionHealthMiddleware',
     'opbeat.contrib.django.middleware.OpbeatAPMMiddleware',
+    'finance.db.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -63,11 +69,37 @@ MIDDLEWARE = (
     'django.middleware.security.SecurityMiddleware',
 )
 
+# most queries a view may make, checked where QueryInspectionMiddleware is
+# enabled; views missing here are not checked
+QUERY_BUDGETS = {
+    'home': 2,
+    'login': 5,
+    'transaction_list': 7,
+    'transaction_analytics': 4,
+    'transaction_tag_breakdown': 3,
+    'transaction_create': 10,
+    'transaction_update': 13,
+    'transaction_delete': 5,
+    'debt_loan_list': 4,
+    'debt_loan_counterparties': 3,
+    'debt_loan_create': 3,
+    'debt_loan_update': 4,
+    'debt_loan_delete': 3,
+    'search': 3,
+    'api_transactions': 5,
+    'api_transaction': 6,
+    'api_debt_loans': 4,
+    'api_debt_loan': 4,
+    'api_transaction_changes': 3,
+    'api_debt_loan_changes': 3,
+}
+
 ROOT_URLCONF = 'finance.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # times template rendering for request metrics
+        'BACKEND': 'finance.metrics.DjangoTemplates',
         'DIRS': ['finance/templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -103,10 +135,48 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',
         'PORT': '',
+        # every uwsgi worker keeps its connection open between requests
+        'CONN_MAX_AGE': 300,
+        # with pgbouncer in transaction pooling mode point HOST and PORT to
+        # it and uncomment this (needs Django 1.11.1), server side cursors
+        # do not survive transaction boundaries there, so exports would
+        # read all rows at once
+        # 'DISABLE_SERVER_SIDE_CURSORS': True,
+    }
+}
+
+# persistent connections idle for longer are pinged before being reused,
+# None disables the check
+CONN_HEALTH_CHECK_SECONDS = 30
+
+# read-only views read from these aliases of DATABASES, e.g.
+#     DATABASES['replica'] = dict(DATABASES['default'], HOST='replica-host')
+#     DATABASE_REPLICAS = ('replica',)
+# two local databases work too, as long as the second is a copy of the first
+DATABASE_REPLICAS = ()
+DATABASE_ROUTERS = ['finance.db.ReplicaRouter']
+# how long a client reads from the primary after a write, should be longer
+# than replication lag
+REPLICA_PIN_SECONDS = 10
+
+
+# Cache has to be shared by all uwsgi workers, otherwise a write in one of
+# them would not invalidate list pages cached by the others
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'var/cache'),
+        'TIMEOUT': 3600,
     }
 }
 
 
+# sessions are read from the shared cache and written through to the
+# database, so most requests do not query django_session; expired ones are
+# deleted by the purge_sessions command
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
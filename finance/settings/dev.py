@@ -8,6 +8,10 @@ ALLOWED_HOSTS = []
 
 # we want to have debug toolbar in dev but not in prod
 MIDDLEWARE = (
+    'finance.metrics.MetricsMiddleware',
+    'finance.db.ConnectionHealthMiddleware',
+    'finance.querylog.QueryInspectionMiddleware',
+    'finance.db.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -45,6 +49,18 @@ DEBUG_TOOLBAR_CONFIG = {
 
 DEBUG_TOOLBAR_PATCH_SETTINGS = False
 
+# runserver is a single process, so there is no need to share the cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # file base email backend on development
 EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'tmp/app-messages')
+
+# log slow and repeated queries and check QUERY_BUDGETS of views
+SLOW_QUERY_MS = 100
+REPEATED_QUERY_LIMIT = 3
+QUERY_BUDGET_STRICT = False
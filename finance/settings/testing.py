@@ -24,6 +24,10 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'finance.metrics.MetricsMiddleware',
+    'finance.db.ConnectionHealthMiddleware',
+    'finance.querylog.QueryInspectionMiddleware',
+    'finance.db.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -34,6 +38,20 @@ MIDDLEWARE = (
     'django.middleware.security.SecurityMiddleware',
 )
 
+# database ids repeat between test cases, so anything cached would leak
+# from one test to another, tests of caching override this
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
+
 # file base email backend on testing
 EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'tmp/app-messages')
+
+# log slow and repeated queries and check QUERY_BUDGETS of views
+SLOW_QUERY_MS = 100
+REPEATED_QUERY_LIMIT = 3
+# a view exceeding its budget fails the test
+QUERY_BUDGET_STRICT = True
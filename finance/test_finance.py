@@ -1,11 +1,43 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from unittest import skipIf
+from unittest import skipUnless
+
+import json
+import os
+import tempfile
+import time
+
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Sum
+from django.http import HttpResponse
 from django.test import Client
+from django.test import RequestFactory
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+
+import pytz
 
 from accounts.factories import UserFactory
+from books.factories import TransactionFactory
+from books.models import DebtLoan
+from books.models import MonthlySummary
 from books.models import Transaction
+from books import cache
+from finance import db
+from finance import metrics
+from finance import querylog
 
 
 class HomePageTests(TestCase):
@@ -36,3 +68,398 @@ class PopulateTests(TestCase):
         call_command('populate')
         self.assertTrue(User.objects.get(username='admin'))
         self.assertEqual(Transaction.objects.count(), 40)
+
+    def test_populate_scaled(self):
+        options = {'users': 3, 'rows': 25, 'days': 30,
+                   'end': date(2016, 5, 31), 'seed': 7, 'batch_size': 10,
+                   'stdout': StringIO()}
+        call_command('populate', **options)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(Transaction.objects.count(), 75)
+        self.assertEqual(DebtLoan.objects.filter(user__username='user2')
+                         .count(), 25)
+        created = Transaction.objects.aggregate(Min('created'),
+                                                Max('created'))
+        self.assertGreaterEqual(created['created__min'],
+                                datetime(2016, 5, 2, tzinfo=pytz.utc))
+        self.assertLess(created['created__max'],
+                        datetime(2016, 6, 1, tzinfo=pytz.utc))
+        self.assertEqual(
+            MonthlySummary.objects.aggregate(Sum('count'))['count__sum'], 75)
+
+        # the same seed generates the same rows
+        fields = ('user__username', 'title', 'amount', 'category', 'created')
+        rows = list(Transaction.objects.order_by('id').values_list(*fields))
+        call_command('populate', clear=True, **options)
+        self.assertEqual(
+            list(Transaction.objects.order_by('id').values_list(*fields)),
+            rows)
+
+    @skipIf(connection.vendor == 'postgresql', "COPY works on postgres")
+    def test_populate_copy_requires_postgres(self):
+        with self.assertRaises(CommandError):
+            call_command('populate', copy=True, stdout=StringIO())
+
+    @skipUnless(connection.vendor == 'postgresql', "COPY is postgres only")
+    def test_populate_copy(self):
+        call_command('populate', copy=True, users=2, rows=15, batch_size=10,
+                     seed=3, stdout=StringIO())
+        self.assertEqual(Transaction.objects.count(), 30)
+        self.assertEqual(DebtLoan.objects.count(), 30)
+        # derived fields are filled as ``bulk_create`` fills them
+        self.assertFalse(DebtLoan.objects.filter(counterparty='').exists())
+        self.assertEqual(
+            MonthlySummary.objects.aggregate(Sum('count'))['count__sum'], 30)
+
+
+class BenchmarkQueriesTests(TestCase):
+    def test_benchmark_queries_command(self):
+        out = StringIO()
+        call_command('benchmark_queries', rows=30, repeat=1, batch_size=7,
+                     stdout=out)
+        self.assertEqual(Transaction.objects.count(), 30)
+        self.assertIn('== all_time', out.getvalue())
+
+        # second run only tops up missing rows
+        call_command('benchmark_queries', rows=30, repeat=1, stdout=out)
+        self.assertEqual(Transaction.objects.count(), 30)
+
+
+class RebuildSummariesTests(TestCase):
+    def test_rebuild_summaries_command(self):
+        TransactionFactory(amount=10)
+        TransactionFactory(amount=5, category=Transaction.INCOME)
+        # simulate summaries drifting away from transactions
+        MonthlySummary.objects.update(sum=0)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_summaries', verify=True, stdout=StringIO(),
+                         stderr=StringIO())
+
+        call_command('rebuild_summaries', stdout=StringIO())
+        self.assertEqual(
+            sorted(MonthlySummary.objects.values_list('sum', flat=True)),
+            [5, 10]
+        )
+        call_command('rebuild_summaries', verify=True, stdout=StringIO())
+
+
+class ImportTransactionsTests(TestCase):
+    def test_import_transactions_command(self):
+        user = UserFactory()
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('title,amount,category\nrent,500,exp\nbad,x,exp\n')
+
+        out, err = StringIO(), StringIO()
+        call_command('import_transactions', user.username, path,
+                     stdout=out, stderr=err)
+        self.assertEqual(Transaction.objects.filter(user=user).count(), 1)
+        self.assertIn('1 transactions imported, 1 rows skipped',
+                      out.getvalue())
+        self.assertIn('line 3', err.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('import_transactions', 'nobody', path)
+
+
+class BenchmarkImportTests(TestCase):
+    def test_benchmark_import_command(self):
+        out = StringIO()
+        call_command('benchmark_import', rows=200, batch_size=50, stdout=out)
+        self.assertIn('198 rows imported, 2 skipped', out.getvalue())
+        # imported rows are rolled back
+        self.assertFalse(Transaction.objects.exists())
+
+
+class BenchmarkTests(TestCase):
+    def test_benchmark_command(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        out = StringIO()
+        call_command('benchmark', sizes=[20], repeat=2, output=path,
+                     stdout=out)
+        with open(path) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['meta']['database'], connection.vendor)
+        results = {r['name']: r for r in report['results']}
+        self.assertIn('transaction_list[last_month]', results)
+        self.assertIn('login', results)
+        self.assertEqual(results['services.get_page']['queries'], 1)
+        self.assertEqual(results['transaction_list[cached]']['size'], 20)
+        # rows and totals come from the cache
+        self.assertEqual(results['transaction_list[all_time]']['queries'], 6)
+        self.assertEqual(results['transaction_list[cached]']['queries'], 1)
+        # writes are rolled back
+        self.assertEqual(Transaction.objects.count(), 20)
+        self.assertEqual(Transaction.objects.filter(active=True).count(), 20)
+
+        call_command('benchmark', sizes=[20], repeat=1, output=path,
+                     compare=path, stdout=out)
+        self.assertIn('login @ 20: median', out.getvalue())
+        self.assertIn('queries', out.getvalue())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+        self.user = UserFactory()
+        TransactionFactory(user=self.user)
+
+    def test_request_is_measured(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('transaction_list'))
+
+        _, total, count = metrics.SQL_QUERIES.get('transaction_list')
+        self.assertEqual(count, 1)
+        self.assertGreaterEqual(total, 4)
+        _, render_time, _ = metrics.RENDER_DURATION.get('transaction_list')
+        self.assertGreater(render_time, 0)
+        buckets, size, _ = metrics.RESPONSE_SIZE.get('transaction_list')
+        self.assertEqual(size, len(response.content))
+        self.assertEqual(buckets[-1], 1)
+        _, sql_time, _ = metrics.SQL_DURATION.get('transaction_list')
+        _, wall_time, _ = metrics.REQUEST_DURATION.get('transaction_list')
+        self.assertLess(sql_time, wall_time)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('login'))
+        self.client.get('/no-such-page/')
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_request_sql_queries_bucket{view="login",le="+Inf"}'
+                      ' 1', text)
+        self.assertIn('http_request_duration_seconds_count{view="unknown"} 1',
+                      text)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }})
+    def test_metrics_endpoint_cache_stats(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('transaction_list'))
+        self.client.get(reverse('transaction_list'))
+
+        stats = cache.get_stats()
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['misses'], 0)
+        text = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('# TYPE books_cache_lookups_total counter', text)
+        self.assertIn('books_cache_lookups_total{{result="hit"}} {}'.format(
+            stats['hits']), text)
+        self.assertIn('books_cache_lookups_total{{result="miss"}} {}'.format(
+            stats['misses']), text)
+
+    def test_metrics_endpoint_forbidden(self):
+        response = self.client.get(reverse('metrics'),
+                                   REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class QueryLogTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        TransactionFactory.create_batch(2, user=self.user)
+        self.client.force_login(self.user)
+
+    def test_normalize(self):
+        self.assertEqual(
+            querylog.normalize(
+                "SELECT *  FROM t\nWHERE id IN (%s, %s, %s) "
+                "AND name = 'it''s' LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?")
+
+    def test_query_log(self):
+        with querylog.QueryLog() as log:
+            for transaction in Transaction.objects.all():
+                transaction.user.username
+        # savepoint of the test case is not a query
+        self.assertEqual(len(log.queries), 3)
+        shape, count = log.repeated(2)[0]
+        self.assertEqual(count, 2)
+        self.assertIn('FROM "auth_user"', shape)
+        self.assertIn('2 x SELECT', log.report())
+
+    @override_settings(QUERY_BUDGETS={'transaction_list': 1})
+    def test_budget_exceeded(self):
+        with self.assertRaises(querylog.QueryBudgetExceeded) as cm:
+            self.client.get(reverse('transaction_list'))
+        self.assertIn('transaction_list made 7 queries, its budget is 1',
+                      str(cm.exception))
+
+    @override_settings(QUERY_BUDGETS={'transaction_list': 1},
+                       QUERY_BUDGET_STRICT=False)
+    def test_budget_exceeded_logged(self):
+        with self.assertLogs('finance.querylog', 'ERROR'):
+            response = self.client.get(reverse('transaction_list'))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(SLOW_QUERY_MS=0, REPEATED_QUERY_LIMIT=1)
+    def test_slow_and_repeated_queries_logged(self):
+        with self.assertLogs('finance.querylog', 'WARNING') as cm:
+            self.client.get(reverse('transaction_list'))
+        output = '\n'.join(cm.output)
+        self.assertIn('Slow query in transaction_list', output)
+        # the rows query is logged with its plan, which index the plan uses
+        # depends on the database
+        plans = [record.args[3] for record in cm.records
+                 if record.msg.startswith('Slow query')
+                 and 'ORDER BY' in record.args[2]
+                 and '"books_transaction"' in record.args[2]]
+        self.assertTrue(plans)
+        self.assertIn('books_transaction', plans[0])
+        self.assertIn('Query repeated 1 times in transaction_list', output)
+
+
+@override_settings(DATABASE_REPLICAS=('replica',))
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.router = db.ReplicaRouter()
+
+    def read_in_view(self, method='get', **cookies):
+        "Returns alias a replica reading view reads from"
+        aliases = []
+
+        @db.replica_reads
+        def view(request):
+            aliases.append(self.router.db_for_read(Transaction))
+            return HttpResponse()
+
+        factory = RequestFactory()
+        for name, value in cookies.items():
+            factory.cookies[name] = value
+        request = getattr(factory, method)('/')
+        db.ReplicaPinningMiddleware(view)(request)
+        return aliases[0]
+
+    def test_reads_outside_views_use_primary(self):
+        self.assertEqual(self.router.db_for_read(Transaction), 'default')
+
+    def test_view_reads_replica(self):
+        self.assertEqual(self.read_in_view(), 'replica')
+
+    @override_settings(DATABASE_REPLICAS=())
+    def test_without_replicas(self):
+        self.assertEqual(self.read_in_view(), 'default')
+
+    def test_unsafe_request_reads_primary(self):
+        self.assertEqual(self.read_in_view('post'), 'default')
+
+    def test_pinned_client_reads_primary(self):
+        self.assertEqual(self.read_in_view(**{db.PIN_COOKIE: '1'}),
+                         'default')
+
+    def test_reads_after_write_use_primary(self):
+        @db.replica_reads
+        def view(request):
+            before = self.router.db_for_read(Transaction)
+            self.assertEqual(self.router.db_for_write(Transaction),
+                             'default')
+            after = self.router.db_for_read(Transaction)
+            return HttpResponse('{} {}'.format(before, after))
+
+        response = db.ReplicaPinningMiddleware(view)(
+            RequestFactory().get('/'))
+        self.assertEqual(response.content, b'replica default')
+        self.assertEqual(response.cookies[db.PIN_COOKIE]['max-age'], 10)
+
+    def test_write_sets_pin_cookie(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('debt_loan_create'),
+                                    {'with_who': 'Foo', 'amount': 1,
+                                     'category': DebtLoan.DEBT})
+        self.assertIn(db.PIN_COOKIE, response.cookies)
+
+        response = self.client.get(reverse('home'))
+        self.assertNotIn(db.PIN_COOKIE, response.cookies)
+
+    def test_relations_across_aliases(self):
+        transaction = TransactionFactory(user=self.user)
+        self.user._state.db = 'replica'
+        self.assertTrue(self.router.allow_relation(transaction, self.user))
+
+
+class ConnectionHealthTests(TestCase):
+    def setUp(self):
+        connection.ensure_connection()
+        self.addCleanup(setattr, connection, 'last_used_at', None)
+
+    def check(self, usable=True):
+        with mock.patch.object(connection, 'is_usable',
+                               return_value=usable) as is_usable, \
+                mock.patch.object(connection, 'close') as close:
+            db.check_connections()
+        return is_usable.called, close.called
+
+    def test_broken_connection_is_closed(self):
+        connection.last_used_at = time.monotonic() - 60
+        self.assertEqual(self.check(usable=False), (True, True))
+
+    def test_working_connection_is_kept(self):
+        self.assertEqual(self.check(), (True, False))
+
+    def test_recently_used_connection_is_not_checked(self):
+        connection.last_used_at = time.monotonic()
+        self.assertEqual(self.check(usable=False), (False, False))
+
+    @override_settings(CONN_HEALTH_CHECK_SECONDS=None)
+    def test_checks_disabled(self):
+        self.assertEqual(self.check(usable=False), (False, False))
+
+    def test_request_marks_connection_used(self):
+        self.client.get(reverse('login'))
+        self.assertIsNotNone(connection.last_used_at)
+
+
+class BenchmarkConnectionsTests(TransactionTestCase):
+    """
+    The command closes and reopens connections, which a test wrapped in a
+    transaction would not survive
+    """
+    def test_benchmark_connections_command(self):
+        user = UserFactory()
+        TransactionFactory(user=user)
+        max_age = connection.settings_dict['CONN_MAX_AGE']
+        out = StringIO()
+        call_command('benchmark_connections', requests=3,
+                     username=user.username, stdout=out)
+        self.assertIn('new connection per request:', out.getvalue())
+        self.assertIn('requests/s', out.getvalue())
+        self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], max_age)
+
+        with self.assertRaises(CommandError):
+            call_command('benchmark_connections', username='nobody')
+
+
+class PurgeSessionsTests(TestCase):
+    def test_expired_sessions_are_deleted(self):
+        now = datetime.now(pytz.utc)
+        for n in range(3):
+            Session.objects.create(session_key='expired{}'.format(n),
+                                   session_data='',
+                                   expire_date=now - timedelta(days=n + 1))
+        Session.objects.create(session_key='active', session_data='',
+                               expire_date=now + timedelta(days=1))
+
+        out = StringIO()
+        call_command('purge_sessions', batch_size=2, pause=0, stdout=out)
+
+        self.assertEqual(list(Session.objects.values_list('session_key',
+                                                          flat=True)),
+                         ['active'])
+        self.assertIn('3 expired sessions deleted', out.getvalue())
+
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_engine_without_database(self):
+        with self.assertRaises(CommandError):
+            call_command('purge_sessions')
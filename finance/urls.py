@@ -6,11 +6,13 @@ from django.contrib import admin
 from accounts import urls as accounts_urls
 from books import urls as books_urls
 from finance.views import home as finance_views_home
+from finance.views import metrics as finance_views_metrics
 
 
 urlpatterns = [
     # Examples:
     url(r'^$', finance_views_home, name='home'),
+    url(r'^metrics$', finance_views_metrics, name='metrics'),
     # url(r'^blog/', include('blog.urls')),
 
     url(r'^admin/', include(admin.site.urls)),
@@ -1,8 +1,20 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.http import HttpResponseForbidden
 from django.urls import reverse
 from django.shortcuts import redirect
 
+from finance.metrics import render_metrics
+
 
 def home(request):
     if request.user.is_authenticated():
         return redirect(reverse('transaction_list'))
     return redirect(reverse('login'))
+
+
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(),
+                        content_type='text/plain; version=0.0.4')